@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from redis_client import REDIS_CLIENT
+from rdb.user import get_token_epoch, REVOCATION_CHANNEL
+
+# How long a verified user is trusted without asking Redis, in seconds
+AUTH_CACHE_TTL = float(os.getenv('auth_cache_ttl', 30))
+# Maximum number of users remembered per worker
+AUTH_CACHE_SIZE = int(os.getenv('auth_cache_size', 100000))
+
+class VerifiedUserCache:
+    """
+    Per-process cache of users known to exist, with their current token epoch.
+    Entries expire after `ttl` seconds. Revocations published on the Redis
+    revocation channel evict entries immediately; while that subscription is
+    not running the cache is bypassed, so a revocation is never missed.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_size: int = AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.subscribe_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revocations = 0
+        # Bumped whenever entries are dropped, so a lookup that raced with a
+        # revocation doesn't put the stale epoch back into the cache
+        self.generation = 0
+        self.pid = None
+        self.subscriber = None
+
+    def reset(self):
+        """Start over in a forked child: the parent's locks, thread and entries can't be trusted."""
+        self.lock = threading.Lock()
+        self.subscribe_lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation += 1
+        self.pid = None
+        self.subscriber = None
+
+    def _ensure_subscribed(self) -> bool:
+        """Start listening for revocations in this process; False if that isn't possible."""
+        if self.pid == os.getpid() and self.subscriber is not None and self.subscriber.is_alive():
+            return True
+        with self.subscribe_lock:
+            if self.pid != os.getpid():
+                # Threads don't survive fork, and the parent's entries are stale
+                self.pid = os.getpid()
+                self.subscriber = None
+            if self.subscriber is not None and self.subscriber.is_alive():
+                return True
+            try:
+                pubsub = REDIS_CLIENT.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{REVOCATION_CHANNEL: self._on_revocation})
+                self.subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self._on_subscriber_error)
+            except Exception as e:
+                print(f"Auth cache disabled, could not subscribe to revocations: {str(e)}")
+                self.subscriber = None
+            # Anything cached before the subscription may have missed a revocation
+            with self.lock:
+                self.entries.clear()
+                self.generation += 1
+            return self.subscriber is not None
+
+    def _on_revocation(self, message):
+        self.invalidate(message['data'].decode('utf-8'))
+
+    def invalidate(self, user_id: str):
+        """Forget a user, e.g. right after revoking their tokens in this worker."""
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.revocations += 1
+            self.generation += 1
+
+    def _on_subscriber_error(self, error, pubsub, thread):
+        print(f"Auth cache revocation listener stopped: {str(error)}")
+        thread.stop()
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def get_epoch(self, user_id: str):
+        """Get the current token epoch of a user, or None if the user doesn't exist."""
+        cacheable = self._ensure_subscribed()
+        if cacheable:
+            with self.lock:
+                generation = self.generation
+                entry = self.entries.get(user_id)
+                if entry and entry[1] > time.monotonic():
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+        else:
+            self.misses += 1
+
+        epoch = get_token_epoch(user_id)
+        if epoch is None or not cacheable:
+            return epoch
+        with self.lock:
+            if generation == self.generation:
+                self.entries[user_id] = (epoch, time.monotonic() + self.ttl)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return epoch
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'revocations': self.revocations,
+                'subscribed': self.subscriber is not None and self.subscriber.is_alive()
+            }
+
+VERIFIED_USERS = VerifiedUserCache()
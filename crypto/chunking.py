@@ -0,0 +1,98 @@
+import os
+import base64
+import hashlib
+import hmac
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from crypto.stream import StreamFormatError
+
+# Chunk sizes for content-defined chunking, in bytes
+MIN_CHUNK_SIZE = int(os.getenv('dedup_min_chunk', 16 * 1024))
+AVG_CHUNK_SIZE = int(os.getenv('dedup_avg_chunk', 64 * 1024))
+MAX_CHUNK_SIZE = int(os.getenv('dedup_max_chunk', 256 * 1024))
+
+# Gear table of the rolling hash. Chunk boundaries, and therefore what gets
+# deduplicated, depend on these values: they must never change.
+GEAR = [int.from_bytes(hashlib.sha256(b'0cloud gear %d' % i).digest()[:8], 'big') for i in range(256)]
+_MASK64 = (1 << 64) - 1
+
+def _high_bits(count: int) -> int:
+    # The high bits of a gear hash depend on the last 64 bytes, the low ones on far fewer
+    return ((1 << count) - 1) << (64 - count)
+
+def _cut_point(data, min_size: int, avg_size: int, max_size: int) -> int:
+    """Find the length of the next chunk at the start of `data` (FastCDC normalized chunking)."""
+    length = len(data)
+    if length <= min_size:
+        return length
+    stop = min(length, max_size)
+    normal = min(avg_size, stop)
+    bits = avg_size.bit_length() - 1
+    # Harder to match before the average size and easier after it, which keeps
+    # chunk sizes close to the average
+    strict, loose = _high_bits(bits + 1), _high_bits(bits - 1)
+    gear = GEAR
+    h = 0
+    i = min_size
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+        if not h & strict:
+            return i + 1
+        i += 1
+    while i < stop:
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+        if not h & loose:
+            return i + 1
+        i += 1
+    return stop
+
+def iter_chunks(source, min_size: int = MIN_CHUNK_SIZE, avg_size: int = AVG_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE):
+    """Split a binary file object into content-defined chunks, holding at most two chunks in memory."""
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = source.read(max_size)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        cut = _cut_point(buffer, min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+def _derive(key: bytes, info: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=info,
+    ).derive(base64.urlsafe_b64decode(key))
+
+class ChunkKeys:
+    """Per-user keys for deduplication, all derived from the user's Fernet key."""
+
+    def __init__(self, key: bytes):
+        # Chunk IDs are keyed hashes, so equal chunks of different users never match
+        self.digest_key = _derive(key, b'0cloud dedup id v1')
+        self.manifest_key = _derive(key, b'0cloud dedup manifest v1')
+        self.aead = AESGCM(_derive(key, b'0cloud dedup chunk v1'))
+
+    def digest(self, chunk: bytes) -> bytes:
+        return hmac.new(self.digest_key, chunk, hashlib.sha256).digest()
+
+    def manifest_mac(self):
+        return hmac.new(self.manifest_key, digestmod=hashlib.sha256)
+
+    def encrypt(self, digest: bytes, chunk: bytes) -> bytes:
+        nonce = os.urandom(12)
+        return nonce + self.aead.encrypt(nonce, chunk, digest)
+
+    def decrypt(self, digest: bytes, ciphertext: bytes) -> bytes:
+        try:
+            return self.aead.decrypt(ciphertext[:12], ciphertext[12:], digest)
+        except InvalidTag:
+            raise StreamFormatError('Chunk failed authentication')
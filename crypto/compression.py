@@ -0,0 +1,199 @@
+import os
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Whether uploads are compressed before they are encrypted
+COMPRESSION_ENABLED = os.getenv('compression_enabled', '0') == '1'
+# Codec used for compressible files: zstd, zlib or lzma
+COMPRESSION_CODEC = os.getenv('compression_codec', 'zstd' if zstandard else 'zlib')
+COMPRESSION_LEVEL = int(os.getenv('compression_level', 3 if COMPRESSION_CODEC == 'zstd' else 6))
+# Bytes compressed up front to see whether compressing the file is worth it
+COMPRESSION_SAMPLE_SIZE = int(os.getenv('compression_sample_size', 64 * 1024))
+# Files whose sample doesn't shrink below this share of its size are stored as is
+COMPRESSION_MAX_RATIO = float(os.getenv('compression_max_ratio', 0.9))
+# Most plaintext bytes produced from compressed data at a time, however well
+# it compressed, so a small stored piece can't blow up in memory
+DECOMPRESS_PIECE_SIZE = 64 * 1024
+
+# Policy by MIME type: True always tries compression, False never does, and
+# types not listed are only compressed when their sample compresses well
+MIME_POLICY = {
+    'application/json': True,
+    'application/xml': True,
+    'application/javascript': True,
+    'application/x-ndjson': True,
+    'application/sql': True,
+    'application/x-sh': True,
+    'application/rtf': True,
+    'image/svg+xml': True,
+    'image/bmp': True,
+    'application/zip': False,
+    'application/gzip': False,
+    'application/x-gzip': False,
+    'application/x-bzip2': False,
+    'application/x-xz': False,
+    'application/x-7z-compressed': False,
+    'application/x-rar-compressed': False,
+    'application/zstd': False,
+    'application/pdf': False,
+    'application/epub+zip': False,
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': False,
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': False,
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': False,
+}
+# Policy by top level type, used when the exact type isn't listed
+MIME_PREFIX_POLICY = {
+    'text/': True,
+    'image/': False,
+    'video/': False,
+    'audio/': False,
+    'font/woff': False,
+}
+
+class _PieceReader:
+    """Binary file object reading from an iterable of byte strings."""
+
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.buffer:
+            piece = next(self.pieces, None)
+            if piece is None:
+                return b''
+            self.buffer = piece
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+def _zlib_decompress(pieces, size: int):
+    decompressor = zlib.decompressobj()
+    for piece in pieces:
+        data = decompressor.decompress(piece, size)
+        yield data
+        # A full output may have more waiting behind it even with no input left
+        while decompressor.unconsumed_tail or len(data) == size:
+            data = decompressor.decompress(decompressor.unconsumed_tail, size)
+            if not data:
+                break
+            yield data
+    yield decompressor.flush()
+
+def _lzma_decompress(pieces, size: int):
+    decompressor = lzma.LZMADecompressor()
+    for piece in pieces:
+        if decompressor.eof:
+            break
+        yield decompressor.decompress(piece, size)
+        while not decompressor.needs_input and not decompressor.eof:
+            yield decompressor.decompress(b'', size)
+
+def _zstd_decompress(pieces, size: int):
+    reader = _PieceReader(pieces)
+    yield from zstandard.ZstdDecompressor().read_to_iter(reader, write_size=size)
+
+class _Codec:
+    def __init__(self, compressor, decompress):
+        self.compressor = compressor
+        # Generator of the plaintext of compressed pieces, at most `size` bytes at a time
+        self.decompress = decompress
+
+CODECS = {
+    'zlib': _Codec(
+        lambda level: zlib.compressobj(level),
+        _zlib_decompress
+    ),
+    'lzma': _Codec(
+        lambda level: lzma.LZMACompressor(preset=level),
+        _lzma_decompress
+    ),
+}
+if zstandard is not None:
+    CODECS['zstd'] = _Codec(
+        lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+        _zstd_decompress
+    )
+
+def mime_policy(mime_type: str):
+    """True, False or None (undecided) for a MIME type, see MIME_POLICY."""
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    if mime_type in MIME_POLICY:
+        return MIME_POLICY[mime_type]
+    for prefix, policy in MIME_PREFIX_POLICY.items():
+        if mime_type.startswith(prefix):
+            return policy
+    return None
+
+def choose_compression(mime_type: str, sample: bytes, codec: str = COMPRESSION_CODEC, level: int = COMPRESSION_LEVEL):
+    """
+    Pick the codec to store a file with, or None to store it uncompressed.
+    Args:
+        mime_type: MIME type guessed for the file
+        sample: First bytes of the file
+        codec: Codec to use when the file is compressible
+        level: Compression level of that codec
+    Compression is skipped for types that are already compressed and for
+    files whose sample doesn't shrink enough.
+    """
+    if not COMPRESSION_ENABLED or codec not in CODECS or not sample:
+        return None
+    if mime_policy(mime_type) is False:
+        return None
+    compressor = CODECS[codec].compressor(level)
+    compressed = compressor.compress(sample) + compressor.flush()
+    if len(compressed) > len(sample) * COMPRESSION_MAX_RATIO:
+        return None
+    return codec
+
+class CompressingReader:
+    """
+    Binary file object returning the compressed form of another one.
+    `raw_size` counts the uncompressed bytes read so far.
+    """
+
+    def __init__(self, source, codec: str, level: int = COMPRESSION_LEVEL):
+        self.source = source
+        self.compressor = CODECS[codec].compressor(level)
+        self.buffer = bytearray()
+        self.raw_size = 0
+        self.eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.source.read(max(size, COMPRESSION_SAMPLE_SIZE))
+            if data:
+                self.raw_size += len(data)
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+def iter_decompressed(pieces, codec: str, start: int = 0, stop: int = None):
+    """
+    Decompress an iterable of compressed pieces, yielding bytes [start, stop).
+    Compressed data can't be entered in the middle, so everything before
+    `start` is decompressed and thrown away. Output comes at most
+    DECOMPRESS_PIECE_SIZE bytes at a time.
+    """
+    offset = 0
+    for data in CODECS[codec].decompress(pieces, DECOMPRESS_PIECE_SIZE):
+        end = offset + len(data)
+        if end > start:
+            data = data[max(start - offset, 0):None if stop is None else max(stop - offset, 0)]
+            if data:
+                yield data
+        offset = end
+        if stop is not None and offset >= stop:
+            return
@@ -0,0 +1,97 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from crypto.keys import generate_key_from_password
+
+# Processes deriving keys; 0 derives inline in the request thread
+KDF_WORKERS = int(os.getenv('kdf_workers', os.cpu_count() or 1))
+# Derivations allowed to wait for a free process before new ones are rejected
+KDF_QUEUE_SIZE = int(os.getenv('kdf_queue_size', max(KDF_WORKERS, 1) * 4))
+# Longest a request waits for its derivation, in seconds
+KDF_TIMEOUT = float(os.getenv('kdf_timeout', 10))
+
+class KdfBusy(Exception):
+    """Raised when the key derivation pool is saturated and the request should be retried."""
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+_pid = None
+
+def _get_executor():
+    """Create the process pool lazily, once per process so it is never shared across fork."""
+    global _executor, _slots, _pid
+    with _lock:
+        if _pid != os.getpid() or _executor is None:
+            # Spawn rather than fork, forking a threaded server can deadlock the child
+            _executor = ProcessPoolExecutor(
+                max_workers=KDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _slots = threading.BoundedSemaphore(KDF_WORKERS + KDF_QUEUE_SIZE)
+            _pid = os.getpid()
+        return _executor, _slots
+
+def _reset_executor(broken):
+    global _executor
+    with _lock:
+        if _executor is broken:
+            _executor = None
+
+def reset_kdf_pool():
+    """Forget the parent's pool in a forked child; the next derivation starts a new one."""
+    global _lock, _executor, _slots, _pid
+    _lock = threading.Lock()
+    _executor = None
+    _slots = None
+    _pid = None
+
+def derive_key(password: str, salt: bytes) -> bytes:
+    """
+    Derive a key from a password on the key derivation pool.
+    Args:
+        password: User's password
+        salt: Salt stored with the user's private key
+    Returns:
+        Same result as crypto.keys.generate_key_from_password
+    Raises KdfBusy straight away when every process is busy and the queue is
+    full, so login bursts are shed instead of tying up request threads.
+    """
+    if KDF_WORKERS <= 0:
+        return generate_key_from_password(password, salt)
+
+    executor, slots = _get_executor()
+    if not slots.acquire(blocking=False):
+        raise KdfBusy('Too many concurrent logins, try again shortly')
+    try:
+        future = executor.submit(generate_key_from_password, password, salt)
+    except BaseException:
+        slots.release()
+        raise
+    # The slot is given back when the derivation really ends, not when the
+    # request stops waiting: one that already started can't be cancelled,
+    # and the slots must keep bounding the work queued on the pool
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=KDF_TIMEOUT)
+    except FutureTimeout:
+        future.cancel()
+        raise KdfBusy('Key derivation timed out, try again shortly')
+    except BrokenProcessPool:
+        # A worker died; start a fresh pool for the next request
+        _reset_executor(executor)
+        raise
+
+def kdf_stats() -> dict:
+    """Capacity of the key derivation pool in this process."""
+    in_use = 0
+    if _slots is not None and _pid == os.getpid():
+        in_use = KDF_WORKERS + KDF_QUEUE_SIZE - _slots._value
+    return {
+        'workers': KDF_WORKERS,
+        'queue_size': KDF_QUEUE_SIZE,
+        'in_flight': in_use
+    }
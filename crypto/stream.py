@@ -0,0 +1,208 @@
+import io
+import os
+import base64
+import struct
+from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from crypto.compression import CompressingReader
+
+# Blob layout:
+#   header  = MAGIC | segment size (u32, big endian) | salt (16 bytes)
+#   segment = AES-256-GCM(plaintext[i * size:(i + 1) * size]) including its 16 byte tag
+# Every segment but the last holds exactly `segment size` plaintext bytes, so the
+# position of any plaintext byte can be computed without reading the blob. The nonce
+# is the segment index plus a "last segment" flag, which makes truncation and
+# reordering detectable. The header is authenticated as associated data.
+MAGIC = b'0CS1'
+HEADER_SIZE = len(MAGIC) + 4 + 16
+TAG_SIZE = 16
+SEGMENT_SIZE = int(os.getenv('encryption_chunk_size', 64 * 1024))
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload exceeds the configured maximum size."""
+
+
+class StreamFormatError(ValueError):
+    """Raised when an encrypted blob is malformed or fails authentication."""
+
+
+def _derive_stream_key(key: bytes, salt: bytes) -> bytes:
+    """Derive a per-blob AES-256 key from the user's Fernet key."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=b'0cloud stream v1',
+    ).derive(base64.urlsafe_b64decode(key))
+
+
+def _nonce(index: int, last: bool) -> bytes:
+    return index.to_bytes(11, 'big') + (b'\x01' if last else b'\x00')
+
+
+def stream_header(segment_size: int, salt: bytes) -> bytes:
+    """Header of a segmented blob; also the associated data of every segment."""
+    return MAGIC + struct.pack('>I', segment_size) + salt
+
+
+def encrypt_part(key: bytes, salt: bytes, data: bytes, first_index: int, final: bool, segment_size: int = SEGMENT_SIZE) -> bytes:
+    """
+    Encrypt a run of consecutive segments of a segmented blob.
+    Args:
+        key: User's Fernet key in bytes
+        salt: Salt of the blob, the same for all of its parts
+        data: Plaintext of the run, a whole number of segments unless `final`
+        first_index: Index of the run's first segment within the blob
+        final: Whether the run ends the blob
+        segment_size: Plaintext bytes per segment
+    Parts encrypted separately, in any order, concatenate behind the header
+    into the same blob EncryptedStream would have produced.
+    """
+    if not final and (not data or len(data) % segment_size):
+        raise ValueError('Only the final part may end with a partial segment')
+    header = stream_header(segment_size, salt)
+    aead = AESGCM(_derive_stream_key(key, salt))
+    pieces = []
+    count = max(1, -(-len(data) // segment_size))
+    for i in range(count):
+        segment = data[i * segment_size:(i + 1) * segment_size]
+        last = final and i == count - 1
+        pieces.append(aead.encrypt(_nonce(first_index + i, last), segment, header))
+    return b''.join(pieces)
+
+
+def _read_full(source, size: int) -> bytes:
+    """Read up to `size` bytes, looping over short reads from raw streams."""
+    buffer = bytearray()
+    while len(buffer) < size:
+        data = source.read(size - len(buffer))
+        if not data:
+            break
+        buffer += data
+    return bytes(buffer)
+
+
+class EncryptedStream:
+    """
+    Iterable of ciphertext pieces for a plaintext file object.
+    Args:
+        source: Binary file object holding the plaintext
+        key: User's Fernet key in bytes
+        segment_size: Plaintext bytes per authenticated segment
+        max_size: Maximum number of plaintext bytes accepted, or None
+        compression: Codec from crypto.compression to compress with before
+            encrypting, or None
+    The plaintext is read one segment at a time, so memory use does not depend
+    on the size of the file. `plaintext_size` is set once iteration finishes;
+    for compressed files it is still the uncompressed size.
+    """
+
+    def __init__(self, source, key: bytes, segment_size: int = SEGMENT_SIZE, max_size: int = None, compression: str = None):
+        self.source = CompressingReader(source, compression) if compression else source
+        self.key = key
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.compression = compression
+        self.plaintext_size = 0
+
+    def _read_segment(self) -> bytes:
+        data = _read_full(self.source, self.segment_size)
+        if self.compression:
+            self.plaintext_size = self.source.raw_size
+        else:
+            self.plaintext_size += len(data)
+        if self.max_size is not None and self.plaintext_size > self.max_size:
+            raise UploadTooLarge(f'File exceeds the maximum upload size of {self.max_size} bytes')
+        return data
+
+    def __iter__(self):
+        salt = os.urandom(16)
+        header = stream_header(self.segment_size, salt)
+        aead = AESGCM(_derive_stream_key(self.key, salt))
+        yield header
+
+        # Read one segment ahead so the final segment can be flagged as such
+        index = 0
+        current = self._read_segment()
+        while True:
+            following = self._read_segment() if len(current) == self.segment_size else b''
+            last = not following
+            yield aead.encrypt(_nonce(index, last), current, header)
+            if last:
+                break
+            current = following
+            index += 1
+
+
+def is_stream_blob(prefix: bytes) -> bool:
+    """Check whether a blob uses the segmented layout rather than a Fernet token."""
+    return prefix[:len(MAGIC)] == MAGIC
+
+
+def _parse_header(header: bytes):
+    if len(header) != HEADER_SIZE or not is_stream_blob(header):
+        raise StreamFormatError('Invalid encrypted file header')
+    segment_size = struct.unpack('>I', header[len(MAGIC):len(MAGIC) + 4])[0]
+    return segment_size, header[len(MAGIC) + 4:]
+
+
+def _segment_count(blob_size: int, segment_size: int) -> int:
+    body = blob_size - HEADER_SIZE
+    count = -(-body // (segment_size + TAG_SIZE))
+    if count < 1 or body - count * TAG_SIZE < 0:
+        raise StreamFormatError('Encrypted file is truncated')
+    return count
+
+
+def plaintext_length(blob_size: int, segment_size: int) -> int:
+    """Compute the plaintext size of a segmented blob from its size on disk."""
+    return blob_size - HEADER_SIZE - _segment_count(blob_size, segment_size) * TAG_SIZE
+
+
+def decrypt_segments(fileobj, key: bytes, start: int = 0, stop: int = None):
+    """
+    Decrypt the plaintext byte range [start, stop) of a segmented blob.
+    Args:
+        fileobj: Seekable binary file object positioned anywhere
+        key: User's Fernet key in bytes
+        start: First plaintext byte to return
+        stop: Plaintext offset to stop at, or None for the end of the file
+    Returns:
+        Generator of plaintext pieces, at most one segment each
+    Only the segments overlapping the range are read and decrypted.
+    """
+    fileobj.seek(0)
+    header = fileobj.read(HEADER_SIZE)
+    segment_size, salt = _parse_header(header)
+    blob_size = fileobj.seek(0, os.SEEK_END)
+    count = _segment_count(blob_size, segment_size)
+    length = blob_size - HEADER_SIZE - count * TAG_SIZE
+    stop = length if stop is None else min(stop, length)
+    aead = AESGCM(_derive_stream_key(key, salt))
+
+    index = start // segment_size
+    # An empty range still authenticates the final segment of an empty file
+    last_index = max(stop - 1, 0) // segment_size if stop > start else index
+    fileobj.seek(HEADER_SIZE + index * (segment_size + TAG_SIZE))
+    while index <= min(last_index, count - 1):
+        ciphertext = _read_full(fileobj, segment_size + TAG_SIZE)
+        try:
+            plaintext = aead.decrypt(_nonce(index, index == count - 1), ciphertext, header)
+        except InvalidTag:
+            raise StreamFormatError(f'Segment {index} failed authentication')
+        offset = index * segment_size
+        piece = plaintext[max(start - offset, 0):stop - offset]
+        if piece:
+            yield piece
+        index += 1
+
+
+def decrypt_blob(encrypted_content: bytes, key: bytes) -> bytes:
+    """Decrypt a whole blob held in memory, whichever layout it was written with."""
+    if not is_stream_blob(encrypted_content):
+        return Fernet(key).decrypt(encrypted_content)
+    return b''.join(decrypt_segments(io.BytesIO(encrypted_content), key))
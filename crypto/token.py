@@ -3,19 +3,20 @@ import jwt
 from file_tools import load_key
 from datetime import timedelta
 from functools import wraps
-from flask import request, jsonify, g
-from rdb.user import user_exists
+from flask import request, jsonify, g, current_app
+from crypto.auth_cache import VERIFIED_USERS
 
 JWT_SECRET = load_key()  # Load the JWT signing key
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION = timedelta(days=1)  # Token expires in 1 day
 
-def create_jwt_token(user_id: str, email: str, display_name: str, private_key: str = None) -> str:
+def create_jwt_token(user_id: str, email: str, display_name: str, private_key: str = None, token_epoch: int = 0) -> str:
     """Create a JWT token for the user."""
     payload = {
         'user_id': user_id,
         'email': email,
         'display_name': display_name,
+        'epoch': token_epoch,  # Tokens from older epochs are revoked
         'exp': datetime.now() + JWT_EXPIRATION,
         'iat': datetime.now(),  # Issued at time
         'iss': 'crypi-api'  # Issuer
@@ -57,13 +58,18 @@ def require_jwt(f):
             # Decode the token
             data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
 
-            # Verify user exists in database
-            if not user_exists(data['user_id']):
+            # Verify user exists and the token hasn't been revoked, usually
+            # answered from the per-worker cache without a Redis round trip
+            epoch = VERIFIED_USERS.get_epoch(data['user_id'])
+            if epoch is None:
                 return jsonify({'error': 'User not found'}), 401
+            if data.get('epoch', 0) < epoch:
+                return jsonify({'error': 'Token has been revoked'}), 401
                 
             # Store user data in g for use in routes
             g.user = data
-            return f(*args, **kwargs)
+            # Async views are handed to the app's event loop
+            return current_app.ensure_sync(f)(*args, **kwargs)
             
         except jwt.ExpiredSignatureError:
             return jsonify({'error': 'Token has expired'}), 401
@@ -3,11 +3,10 @@ import os
 from datetime import datetime
 import uuid
 
-DB_PATH = 'files.db'
-ENCRYPTED_FILES_DIR = 'encrypted_files'
+# Blobs share the layout of storage.files
+from storage.files import ENCRYPTED_FILES_DIR, save_encrypted_file, get_encrypted_file, delete_encrypted_file
 
-# Ensure encrypted files directory exists
-os.makedirs(ENCRYPTED_FILES_DIR, exist_ok=True)
+DB_PATH = 'files.db'
 
 def init_db():
     """Initialize the database with required tables"""
@@ -58,25 +57,6 @@ def init_db():
     conn.commit()
     conn.close()
 
-def save_encrypted_file(file_id: str, encrypted_content: bytes) -> str:
-    """Save encrypted file to disk and return the file path."""
-    file_path = os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
-    with open(file_path, 'wb') as f:
-        f.write(encrypted_content)
-    return file_path
-
-def get_encrypted_file(file_id: str) -> bytes:
-    """Read encrypted file from disk."""
-    file_path = os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
-    with open(file_path, 'rb') as f:
-        return f.read()
-
-def delete_encrypted_file(file_id: str):
-    """Delete encrypted file from disk."""
-    file_path = os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
-    if os.path.exists(file_path):
-        os.remove(file_path)
-
 def save_file(encrypted_filename: str, original_filename: str, encrypted_content: bytes, file_size: int, user_id: str, parent_id: str = None, mime_type: str = 'application/octet-stream') -> dict:
     """Save a file to the database and encrypted content to disk."""
     conn = sqlite3.connect(DB_PATH)
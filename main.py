@@ -1,23 +1,42 @@
+import inspect
+from functools import wraps
 from flask import Flask, jsonify
 from flask_cors import CORS
 from routes import api_bp
+from routes.encrypt import MAX_UPLOAD_SIZE
 from database import init_db
+from utils.aio import IO_LOOP
+
+class ZeroCloud(Flask):
+    def ensure_sync(self, func):
+        """
+        Run async views on the process's shared event loop rather than a new loop per request.
+        The request's WSGI thread still waits for the view to finish, see utils.aio.EventLoopThread.
+        """
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            def run(*args, **kwargs):
+                return IO_LOOP.run(func(*args, **kwargs))
+            return run
+        return func
+
+app = ZeroCloud(__name__)
+
+# Reject oversized request bodies before they are parsed, leaving room for the
+# multipart envelope around the file itself
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 1024 * 1024
 
-app = Flask(__name__)
 CORS(app, resources={
     r"/*": {
         "origins": ["http://localhost:3000", "http://127.0.0.1:3000"],
-        "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+        "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization", "Accept", "Origin", "X-Requested-With"],
-        "expose_headers": ["Content-Type", "Authorization"],
+        "expose_headers": ["Content-Type", "Authorization", "ETag", "Content-Range", "X-Plaintext-Size", "X-Blob-Compression"],
         "supports_credentials": True,
         "max_age": 3600
     }
 })
 
-# Initialize database
-init_db()
-
 # Register blueprints
 app.register_blueprint(api_bp)
 
@@ -31,5 +50,7 @@ def handle_error(error):
     return response
 
 if __name__ == '__main__':
+    # Development server only, see serve.py for production
+    init_db()
     app.run(debug=True, port=8080)
   
\ No newline at end of file
@@ -0,0 +1,75 @@
+import argparse
+from rdb.user import backfill_email_index
+from rdb.files import reindex_files, recount_storage_usage
+from rdb.folders import reindex_folders
+from storage.files import migrate_blobs, remove_stale_temp_files
+from storage.packs import compact_packs
+from storage.uploads import collect_expired_uploads
+from storage.reaper import reap
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the 0cloud server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("backfill-email-index", help="Index the email address of every existing user.")
+    commands.add_parser("rebuild-indexes", help="Rebuild the per-folder listing indexes and the name search index.")
+    commands.add_parser("recount-usage", help="Recompute every user's storage usage counter from their files.")
+    migrate = commands.add_parser("migrate-blobs", help="Move blobs from the flat directory into the sharded layout.")
+    migrate.add_argument("--batch-size", type=int, default=1000, help="Blobs moved between pauses.")
+    migrate.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep after each batch.")
+    migrate.add_argument("--limit", type=int, default=None, help="Stop after moving this many blobs.")
+    compact = commands.add_parser("compact-packs", help="Reclaim the space of deleted blobs from pack segments.")
+    compact.add_argument("--min-dead-ratio", type=float, default=0.5, help="Only rewrite segments with at least this share of dead bytes.")
+
+    clean = commands.add_parser("clean-temp-files", help="Delete temporary blobs left behind by crashed uploads.")
+    clean.add_argument("--max-age", type=float, default=86400, help="Only delete files older than this many seconds.")
+    gc_uploads = commands.add_parser("gc-uploads", help="Delete the chunks of expired upload sessions and release their quota.")
+    gc_uploads.add_argument("--batch-size", type=int, default=1000, help="Sessions collected per round.")
+    empty_trash = commands.add_parser("empty-trash", help="Unlink the keys, unindex the names and remove the blobs of deleted folders.")
+    empty_trash.add_argument("--batch-size", type=int, default=100, help="Trash entries reclaimed per round.")
+    empty_trash.add_argument("--rate", type=float, default=200, help="Blobs removed per second at most, 0 for no limit.")
+
+    args = parser.parse_args()
+
+    if args.command == "backfill-email-index":
+        result = backfill_email_index()
+        print(f"Indexed {result['indexed']} users.")
+        for email in result["conflicts"]:
+            print(f"Duplicate email left pointing at its first owner: {email}")
+    elif args.command == "rebuild-indexes":
+        print(f"Indexed {reindex_folders()} folders.")
+        print(f"Indexed {reindex_files()} files.")
+    elif args.command == "recount-usage":
+        print(f"Recounted storage for {recount_storage_usage()} users.")
+    elif args.command == "migrate-blobs":
+        result = migrate_blobs(args.batch_size, args.pause, args.limit)
+        print(f"Moved {result['moved']} blobs, skipped {result['skipped']}.")
+    elif args.command == "compact-packs":
+        result = compact_packs(args.min_dead_ratio)
+        print(f"Compacted {result['segments']} segments, kept {result['copied']} blobs, dropped {result['dropped']}.")
+    elif args.command == "clean-temp-files":
+        print(f"Removed {remove_stale_temp_files(args.max_age)} temporary files.")
+    elif args.command == "gc-uploads":
+        collected = 0
+        while True:
+            batch = collect_expired_uploads(args.batch_size)
+            collected += batch
+            if batch < args.batch_size:
+                break
+        print(f"Collected {collected} expired upload sessions.")
+    elif args.command == "empty-trash":
+        keys = names = blobs = 0
+        while True:
+            result = reap(args.batch_size, args.rate)
+            if result is None:
+                print("The trash is being emptied by another process.")
+                break
+            keys += result["keys"]
+            names += result["names"]
+            blobs += result["blobs"]
+            if max(result.values()) < args.batch_size:
+                break
+        print(f"Unlinked {keys} keys, unindexed {names} names and removed {blobs} blobs.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+from redis_client import get_async_redis
+from rdb.batch import decode_hashes
+
+async def get_hashes(keys: list, client=None) -> list:
+    """Fetch many hashes in one pipelined round trip, None for the missing ones."""
+    if not keys:
+        return []
+    pipe = (client or get_async_redis()).pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    return decode_hashes(await pipe.execute())
@@ -0,0 +1,20 @@
+from redis_client import get_async_redis
+from rdb.contents import contents_steps, search_steps
+from rdb.search import SEARCH_DEFAULT_LIMIT
+
+async def get_folder_contents(folder_id: str, user_id: str, limit: int = None, cursor: str = None, order: str = 'name', include_path: bool = False) -> dict:
+    """Load a folder, its parent and one page of its contents, see rdb.contents.get_folder_contents."""
+    return await run_steps(contents_steps(get_async_redis(), folder_id, user_id, limit, cursor, order, include_path))
+
+async def search_names(user_id: str, term: str, limit: int = SEARCH_DEFAULT_LIMIT, kind: str = '', cursor: str = None) -> dict:
+    """Find a user's files and folders by name, see rdb.contents.search_names."""
+    return await run_steps(search_steps(get_async_redis(), user_id, term, limit, kind, cursor))
+
+async def run_steps(steps):
+    """Drive a generator of pipeline steps to completion on the asyncio client."""
+    try:
+        pipe = next(steps)
+        while True:
+            pipe = steps.send(await pipe.execute())
+    except StopIteration as done:
+        return done.value
@@ -0,0 +1,27 @@
+from redis_client import get_async_redis
+from utils.transformations import redis_to_dict
+from rdb.files import file_key, files_index_prefix
+from rdb.aio.batch import get_hashes
+from rdb.aio.index import page
+
+async def get_file_by_id(file_id: str, user_id: str) -> dict:
+    """Get a user's file metadata by its ID."""
+    file_data = await get_async_redis().hgetall(file_key(user_id, file_id))
+    if file_data:
+        return redis_to_dict(file_data)
+    return None
+
+async def page_files(parent_id=None, user_id=None, limit=None, cursor=None, order='created', search=None) -> tuple:
+    """List one page of a folder's files, see rdb.files.page_files."""
+    client = get_async_redis()
+    file_ids, next_cursor = await page(
+        client,
+        files_index_prefix(user_id, parent_id),
+        "files",
+        order=order,
+        limit=limit,
+        cursor=cursor,
+        search=search
+    )
+    files = await get_hashes([file_key(user_id, file_id) for file_id in file_ids], client)
+    return [file for file in files if file], next_cursor
@@ -0,0 +1,32 @@
+from redis_client import get_async_redis
+from utils.transformations import redis_to_dict
+from rdb.folders import folder_key, folders_index_prefix, queue_folder_path, decode_folder_path
+from rdb.aio.batch import get_hashes
+from rdb.aio.index import page
+
+async def get_folder(folder_id: str, user_id: str) -> dict:
+    """Get folder details"""
+    folder = await get_async_redis().hgetall(folder_key(user_id, folder_id))
+    if folder:
+        return redis_to_dict(folder)
+    return None
+
+async def get_folder_path(folder_id: str, user_id: str) -> list:
+    """Get the chain of folders from the top level down to a folder, see rdb.folders.get_folder_path."""
+    pipe = get_async_redis().pipeline(transaction=False)
+    queue_folder_path(pipe, folder_id, user_id)
+    return decode_folder_path((await pipe.execute())[0])
+
+async def page_folders(parent_id: str = None, user_id: str = None, limit: int = None, cursor: str = None, order: str = 'name') -> tuple:
+    """List one page of a folder's subfolders, returning (folders, next_cursor)."""
+    client = get_async_redis()
+    folder_ids, next_cursor = await page(
+        client,
+        folders_index_prefix(user_id, parent_id),
+        "folders",
+        order=order,
+        limit=limit,
+        cursor=cursor
+    )
+    folders = await get_hashes([folder_key(user_id, folder_id) for folder_id in folder_ids], client)
+    return [folder for folder in folders if folder], next_cursor
@@ -0,0 +1,7 @@
+from rdb.index import queue_page, read_page
+
+async def page(client, prefix: str, kind: str, order: str = 'created', limit: int = None, cursor: str = None, search: str = None) -> tuple:
+    """Read one page of item IDs from an index, see rdb.index.queue_page for the arguments."""
+    pipe = client.pipeline(transaction=False)
+    queue_page(pipe, prefix, kind, order, limit, cursor, search)
+    return read_page((await pipe.execute())[0], kind, order, limit)
@@ -0,0 +1,23 @@
+from redis_client import get_async_redis
+from rdb.user import email_key, decode_user, public_user
+
+async def get_token_epoch(user_id):
+    """Get the epoch tokens of a user must carry to be valid, or None if the user doesn't exist."""
+    user_found, epoch = await get_async_redis().hmget("user:" + user_id, "id", "token_epoch")
+    if user_found is None:
+        return None
+    return int(epoch) if epoch else 0
+
+async def get_user(user_id):
+    """Get user by ID."""
+    user_data = await get_async_redis().hgetall("user:" + user_id)
+    if user_data:
+        return decode_user(user_data)
+    return None
+
+async def get_user_by_email(email):
+    """Get user by email."""
+    user_id = await get_async_redis().get(email_key(email))
+    if user_id is None:
+        return None
+    return public_user(await get_user(user_id.decode('utf-8')), email)
@@ -0,0 +1,8 @@
+from redis_client import get_async_redis
+from rdb.versions import queue_etag, read_etag
+
+async def get_etag(user_id: str, folder_ids: list, exists_key: str = None):
+    """Read a listing's ETag value in one round trip, see rdb.versions.queue_etag."""
+    pipe = get_async_redis().pipeline(transaction=False)
+    queue_etag(pipe, user_id, folder_ids, exists_key)
+    return read_etag(user_id, await pipe.execute())
@@ -0,0 +1,15 @@
+from redis_client import REDIS_CLIENT
+from utils.transformations import redis_to_dict
+
+def get_hashes(keys: list, client=REDIS_CLIENT) -> list:
+    """Fetch many hashes in one pipelined round trip, None for the missing ones."""
+    if not keys:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    return decode_hashes(pipe.execute())
+
+def decode_hashes(results: list) -> list:
+    """Decode raw HGETALL replies taken from a larger pipeline, None for the missing ones."""
+    return [redis_to_dict(data) if data else None for data in results]
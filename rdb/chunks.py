@@ -0,0 +1,72 @@
+from redis_client import REDIS_CLIENT
+
+# Reference counts and generations of deduplicated chunks live in two hashes
+# per user, keyed by the hex chunk digest. A chunk file is named after its
+# digest and generation, and a digest gets a new generation every time it is
+# stored again after being freed. A file being deleted therefore never
+# removes a chunk file that a concurrent upload has just written.
+ACQUIRE_SCRIPT = REDIS_CLIENT.register_script("""
+local result = {}
+for i = 1, #ARGV, 2 do
+    local digest = ARGV[i]
+    local count = redis.call('HINCRBY', KEYS[1], digest, 1)
+    local generation = redis.call('HGET', KEYS[2], digest)
+    if count == 1 or not generation then
+        redis.call('HSET', KEYS[2], digest, ARGV[i + 1])
+        table.insert(result, ARGV[i + 1])
+        table.insert(result, 1)
+    else
+        table.insert(result, generation)
+        table.insert(result, 0)
+    end
+end
+return result
+""")
+
+RELEASE_SCRIPT = REDIS_CLIENT.register_script("""
+local freed = {}
+for i = 1, #ARGV do
+    local digest = ARGV[i]
+    if redis.call('HINCRBY', KEYS[1], digest, -1) <= 0 then
+        table.insert(freed, digest)
+        table.insert(freed, redis.call('HGET', KEYS[2], digest))
+        redis.call('HDEL', KEYS[1], digest)
+        redis.call('HDEL', KEYS[2], digest)
+    end
+end
+return freed
+""")
+
+def chunk_keys(user_id: str) -> list:
+    """Redis keys of a user's chunk reference counts and generations."""
+    return [f"user:{user_id}:chunks:refs", f"user:{user_id}:chunks:gens"]
+
+def acquire_chunks(user_id: str, digests: list, new_generations: list) -> list:
+    """
+    Take a reference on each chunk digest.
+    Args:
+        user_id: Owner of the chunks
+        digests: Hex chunk digests
+        new_generations: Hex generation to use for each digest that isn't stored yet
+    Returns:
+        List of (generation, is_new) tuples; new chunks must be written by the caller
+    """
+    args = []
+    for digest, generation in zip(digests, new_generations):
+        args.extend([digest, generation])
+    result = ACQUIRE_SCRIPT(keys=chunk_keys(user_id), args=args)
+    return [
+        (result[i].decode('utf-8'), result[i + 1] == 1)
+        for i in range(0, len(result), 2)
+    ]
+
+def release_chunks(user_id: str, digests: list) -> list:
+    """Drop a reference on each chunk digest, returning (digest, generation) of the chunks no longer used."""
+    if not digests:
+        return []
+    result = RELEASE_SCRIPT(keys=chunk_keys(user_id), args=digests)
+    return [
+        (result[i].decode('utf-8'), result[i + 1].decode('utf-8'))
+        for i in range(0, len(result), 2)
+        if result[i + 1] is not None
+    ]
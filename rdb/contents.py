@@ -0,0 +1,135 @@
+from redis_client import REDIS_CLIENT
+from rdb.batch import decode_hashes
+from rdb.files import file_key, files_index_prefix
+from rdb.folders import folder_key, folders_index_prefix, queue_folder_path, decode_folder_path
+from rdb.index import queue_page, read_page, decode_cursor, start_cursor
+from rdb.search import FILE_KIND, SEARCH_DEFAULT_LIMIT, queue_search, split_member, search_cursor, search_offset
+
+def get_folder_contents(folder_id: str, user_id: str, limit: int = None, cursor: str = None, order: str = 'name', include_path: bool = False) -> dict:
+    """
+    Load a folder, its parent and one page of its contents in two round trips.
+    Args:
+        folder_id: Folder to list, None for the root folder
+        user_id: Owner of the folder
+        limit: Maximum number of entries to return, or None for all of them
+        cursor: Cursor returned with the previous page
+        order: 'created' (newest first) or 'name' (alphabetical)
+        include_path: Also return the folders from the top level down to this
+            one, for breadcrumbs, at no extra round trip
+    Returns:
+        Dict with folder, parent, folders, files and next_cursor, plus path if
+        asked for, or None if the folder does not exist. Subfolders are listed
+        before files.
+    """
+    return run_steps(contents_steps(REDIS_CLIENT, folder_id, user_id, limit, cursor, order, include_path))
+
+def run_steps(steps):
+    """Drive a generator of pipeline steps to completion, returning its value."""
+    try:
+        pipe = next(steps)
+        while True:
+            pipe = steps.send(pipe.execute())
+    except StopIteration as done:
+        return done.value
+
+def contents_steps(client, folder_id: str, user_id: str, limit: int = None, cursor: str = None, order: str = 'name', include_path: bool = False):
+    """
+    Steps of get_folder_contents, independent of how pipelines are executed.
+    Yields each pipeline to run and expects its results to be sent back; the
+    contents are the generator's return value. Shared by the sync and asyncio
+    clients.
+    """
+    in_files = bool(cursor) and decode_cursor(cursor)[0].startswith('files:')
+
+    # First round trip: the folder itself and both index pages. Files are read
+    # speculatively with the full limit and trimmed once the folders are known.
+    pipe = client.pipeline(transaction=False)
+    if folder_id:
+        pipe.hgetall(folder_key(user_id, folder_id))
+    if folder_id and include_path:
+        queue_folder_path(pipe, folder_id, user_id)
+    if not in_files:
+        queue_page(pipe, folders_index_prefix(user_id, folder_id), 'folders', order, limit, cursor)
+    queue_page(pipe, files_index_prefix(user_id, folder_id), 'files', order, limit, cursor if in_files else None)
+    results = yield pipe
+
+    folder = None
+    if folder_id:
+        folder = decode_hashes([results.pop(0)])[0]
+        if not folder:
+            return None
+    path = []
+    if folder_id and include_path:
+        path = decode_folder_path(results.pop(0)) or []
+
+    folder_ids, next_cursor = [], None
+    if not in_files:
+        folder_ids, next_cursor = read_page(results.pop(0), 'folders', order, limit)
+    file_ids = []
+    if not next_cursor:
+        remaining = limit - len(folder_ids) if limit is not None else None
+        if remaining == 0:
+            next_cursor = start_cursor('files', order) if results[0] else None
+        else:
+            file_ids, next_cursor = read_page(results[0], 'files', order, remaining)
+
+    # Second round trip: the parent and every entry on the page
+    pipe = client.pipeline(transaction=False)
+    parent_id = folder['parent_id'] if folder and folder['parent_id'] != 'root' else None
+    if parent_id:
+        pipe.hgetall(folder_key(user_id, parent_id))
+    for child_id in folder_ids:
+        pipe.hgetall(folder_key(user_id, child_id))
+    for file_id in file_ids:
+        pipe.hgetall(file_key(user_id, file_id))
+    records = decode_hashes((yield pipe))
+
+    parent = records.pop(0) if parent_id else None
+    folders = records[:len(folder_ids)]
+    files = records[len(folder_ids):]
+    contents = {
+        'folder': folder,
+        'parent': parent,
+        'folders': [entry for entry in folders if entry],
+        'files': [entry for entry in files if entry],
+        'next_cursor': next_cursor
+    }
+    if include_path:
+        contents['path'] = path
+    return contents
+
+def search_names(user_id: str, term: str, limit: int = SEARCH_DEFAULT_LIMIT, kind: str = '', cursor: str = None) -> dict:
+    """
+    Find a user's files and folders whose names contain `term`, in two round trips.
+    Args:
+        user_id: Owner of the entries searched
+        term: Text to find anywhere in the names, case-insensitively
+        limit: Maximum number of entries to return
+        kind: 'f' or 'd' to search only files or folders
+        cursor: Cursor returned with the previous page of the same search
+    Returns:
+        Dict with the matching folders and files, best matches first, and
+        next_cursor, None on the last page
+    """
+    return run_steps(search_steps(REDIS_CLIENT, user_id, term, limit, kind, cursor))
+
+def search_steps(client, user_id: str, term: str, limit: int = SEARCH_DEFAULT_LIMIT, kind: str = '', cursor: str = None):
+    """Steps of search_names, see contents_steps."""
+    offset = search_offset(cursor, term) if cursor else 0
+    pipe = client.pipeline(transaction=False)
+    # One match more than asked for tells whether there is another page
+    queue_search(pipe, user_id, term, limit + 1, kind, offset)
+    matches = [split_member(member) for member in (yield pipe)[0]]
+    next_cursor = search_cursor(term, offset + limit) if len(matches) > limit else None
+    matches = matches[:limit]
+
+    pipe = client.pipeline(transaction=False)
+    for match_kind, item_id in matches:
+        pipe.hgetall(file_key(user_id, item_id) if match_kind == FILE_KIND else folder_key(user_id, item_id))
+    records = decode_hashes((yield pipe)) if matches else []
+
+    results = {'folders': [], 'files': [], 'next_cursor': next_cursor}
+    for (match_kind, _), record in zip(matches, records):
+        if record:
+            results['files' if match_kind == FILE_KIND else 'folders'].append(record)
+    return results
@@ -1,22 +1,123 @@
 from redis_client import REDIS_CLIENT
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from storage.files import save_encrypted_file
+from storage.files import save_encrypted_stream
 from storage.files import get_encrypted_file
 from storage.files import delete_encrypted_file
-from rdb.folders import get_folder
+from storage.dedup import release_file_chunks
+from rdb.folders import get_folder, folder_key
 from utils.transformations import redis_to_dict
+from rdb.index import add_to_indexes, remove_from_indexes, page
+from rdb.batch import get_hashes
+from rdb.search import FILE_KIND, index_name, unindex_name
+from rdb.versions import bump_versions
+from rdb.usage import reserve_storage, release_storage, set_storage_usage
+
+def file_key(user_id: str, file_id: str) -> str:
+    """Redis key of a file's metadata hash."""
+    return f"user:{user_id}:file:{file_id}"
+
+def files_index_prefix(user_id: str, parent_id: str = None) -> str:
+    """Key prefix of the indexes of a folder's files, or of all files for parent 'all'."""
+    return f"user:{user_id}:index:{parent_id or 'root'}:files"
+
+class ParentFolderMissing(Exception):
+    """Raised when a file's folder is deleted while the file is being saved."""
+
+def _commit_files(user_id: str, parent_id: str, files: list, unused: int):
+    """
+    Store file records with their index entries and give back `unused` reserved bytes, in one transaction.
+    The parent folder is WATCHed, so the commit only goes through if it still
+    exists: writing a blob can take long enough for the folder's subtree to be
+    deleted, and files committed under it would be out of every listing and
+    out of the reaper's reach.
+    """
+    watched = [] if parent_id == "root" else [folder_key(user_id, parent_id)]
+
+    def commit(pipe):
+        if watched and not pipe.exists(watched[0]):
+            raise ParentFolderMissing(f"Parent folder {parent_id} does not exist for user {user_id}.")
+        pipe.multi()
+        for file_data in files:
+            pipe.hset(file_key(user_id, file_data["id"]), mapping=file_data)
+            _index_file(pipe, file_data)
+        release_storage(user_id, unused, pipe)
+
+    REDIS_CLIENT.transaction(commit, *watched)
+
+def _abort(encrypted_content):
+    """Give back what a content stream holds, such as a ChunkedStream's chunk references."""
+    abort = getattr(encrypted_content, "abort", None)
+    if abort:
+        abort()
+
+def _index_file(pipe, file_data: dict):
+    for parent_id in (file_data["parent_id"], "all"):
+        add_to_indexes(
+            pipe,
+            files_index_prefix(file_data["user_id"], parent_id),
+            file_data["created_at"],
+            file_data["original_filename"],
+            file_data["id"]
+        )
+    index_name(pipe, file_data["user_id"], FILE_KIND, file_data["id"], file_data["original_filename"])
+    bump_versions(pipe, file_data["user_id"], file_data["parent_id"])
+
+def _unindex_file(pipe, file_data: dict):
+    for parent_id in (file_data["parent_id"], "all"):
+        remove_from_indexes(
+            pipe,
+            files_index_prefix(file_data["user_id"], parent_id),
+            file_data["created_at"],
+            file_data["original_filename"],
+            file_data["id"]
+        )
+    unindex_name(pipe, file_data["user_id"], FILE_KIND, file_data["id"], file_data["original_filename"])
+    bump_versions(pipe, file_data["user_id"], file_data["parent_id"])
+
+def _file_record(file_id, encrypted_filename, original_filename, file_size, parent_id, created_at, mime_type, user_id, encrypted_content) -> dict:
+    file_data = {
+        "id": file_id,
+        "encrypted_filename": encrypted_filename,
+        "original_filename": original_filename,
+        "file_size": file_size,
+        "parent_id": parent_id,
+        "created_at": created_at.isoformat(),
+        "mime_type": mime_type,
+        "user_id": user_id
+    }
+    compression = getattr(encrypted_content, 'compression', None)
+    if compression:
+        file_data["compression"] = compression
+    return file_data
 
 def save_file(
     encrypted_filename: str,
     original_filename: str,
-    encrypted_content: bytes,
+    encrypted_content,
     file_size: int,
     user_id: str,
     parent_id: str,
-    mime_type: str = 'application/octet-stream'
+    mime_type: str = 'application/octet-stream',
+    quota_reserved: bool = False
 ) -> dict:
-    """Save a file to the database and encrypted content to disk."""
+    """Save a file to the database and encrypted content to disk.
+
+    `encrypted_content` is either the whole ciphertext or an `EncryptedStream`,
+    which is written to disk piece by piece. When `file_size` is None it is
+    taken from the stream once it has been consumed. The codec of a
+    compressed stream is recorded as the file's `compression`.
+
+    Quota for `file_size` bytes, or for the stream's `max_size` when the size is
+    not known yet, is reserved before anything is written. The unused part of
+    the reservation is given back together with the metadata write. With
+    `quota_reserved` the caller has already reserved `file_size` bytes and
+    keeps ownership of them unless the file is saved. If the parent folder is
+    deleted while the blob is written, the blob is removed again and
+    ParentFolderMissing raised.
+    """
 
     # Generate a UUID for the file
     file_id = str(uuid.uuid4())
@@ -31,41 +132,112 @@ def save_file(
     else:
         parent_id = "root"
 
+    # Reserve quota before writing to disk; raises QuotaExceeded
+    reserved = file_size if file_size is not None else encrypted_content.max_size
+    if not quota_reserved:
+        reserve_storage(user_id, reserved)
+
     # Save encrypted content to disk
-    save_encrypted_file(file_id, encrypted_content)
+    try:
+        if isinstance(encrypted_content, bytes):
+            save_encrypted_file(file_id, encrypted_content)
+        else:
+            save_encrypted_stream(file_id, encrypted_content)
+    except BaseException:
+        if not quota_reserved:
+            release_storage(user_id, reserved)
+        # A chunked upload still holds its chunk references if storing its manifest failed
+        _abort(encrypted_content)
+        raise
+    if file_size is None:
+        file_size = encrypted_content.plaintext_size
+
+    file_data = _file_record(file_id, encrypted_filename, original_filename, file_size, parent_id, created_at, mime_type, user_id, encrypted_content)
 
-    # Save file to Redis
+    # Save file to Redis along with its index entries, settling the reservation
     try:
-        REDIS_CLIENT.hmset(
-        f"user:{user_id}:files:{parent_id}:{file_id}",
-        {
-            "id": file_id,
-            "encrypted_filename": encrypted_filename,
-            "original_filename": original_filename,
-            "file_size": file_size,
-            "parent_id": parent_id,
-            "created_at": created_at.isoformat(),
-            "mime_type": mime_type,
-            "user_id": user_id
-        }
-    )
+        _commit_files(user_id, parent_id, [file_data], reserved - file_size)
     except Exception as e:
         print(f"Error saving file to Redis: {str(e)}")
+        if not quota_reserved:
+            release_storage(user_id, reserved)
+        # Same cleanup as a delete, so a chunked blob gives back its chunk references
+        release_file_chunks(user_id, file_id)
+        delete_encrypted_file(file_id)
+        if isinstance(e, ParentFolderMissing):
+            raise
         return None
 
-    # Get the created file data
-    # file_data = REDIS_CLIENT.hgetall(f"file:{file_id}")
+    return file_data
 
-    return {
-        "id": file_id,
-        "encrypted_filename": encrypted_filename,
-        "original_filename": original_filename,
-        "file_size": file_size,
-        "parent_id": parent_id,
-        "created_at": created_at.isoformat(),
-        "mime_type": mime_type,
-        "user_id": user_id
-    }
+def save_files(uploads: list, user_id: str, parent_id: str, workers: int = 8) -> list:
+    """
+    Save many files to one folder, writing their blobs in parallel.
+    Args:
+        uploads: Dicts with encrypted_filename, original_filename, mime_type,
+            encrypted_content (an `EncryptedStream` or similar) and max_size
+        user_id: Owner of the files
+        parent_id: Folder to save the files in, empty for the root folder
+        workers: Threads encrypting and writing blobs at the same time
+    Returns:
+        For every upload, in order, its `file_data` dict or an Exception
+    The parent folder is checked and quota is reserved once for the whole
+    batch; QuotaExceeded is raised before anything is written. The metadata
+    of every file written is then committed in a single transaction.
+    """
+    if parent_id:
+        if not get_folder(parent_id, user_id):
+            raise Exception(f"Parent folder {parent_id} does not exist for user {user_id}.")
+    else:
+        parent_id = "root"
+
+    reserved = sum(upload["max_size"] for upload in uploads)
+    reserve_storage(user_id, reserved)
+
+    def write(upload):
+        file_id = str(uuid.uuid4())
+        try:
+            save_encrypted_stream(file_id, upload["encrypted_content"])
+        except BaseException:
+            _abort(upload["encrypted_content"])
+            raise
+        return file_id
+
+    # Encryption and hashing release the GIL, so the threads really run in parallel
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(uploads)))) as executor:
+        futures = [executor.submit(write, upload) for upload in uploads]
+    results = []
+    for upload, future in zip(uploads, futures):
+        try:
+            file_id = future.result()
+        except Exception as e:
+            results.append(e)
+            continue
+        content = upload["encrypted_content"]
+        results.append(_file_record(
+            file_id,
+            upload["encrypted_filename"],
+            upload["original_filename"],
+            content.plaintext_size,
+            parent_id,
+            datetime.now(),
+            upload["mime_type"],
+            user_id,
+            content
+        ))
+
+    saved = [result for result in results if isinstance(result, dict)]
+    try:
+        _commit_files(user_id, parent_id, saved, reserved - sum(file_data["file_size"] for file_data in saved))
+    except Exception as e:
+        print(f"Error saving files to Redis: {str(e)}")
+        release_storage(user_id, reserved)
+        for file_data in saved:
+            release_file_chunks(user_id, file_data["id"])
+            delete_encrypted_file(file_data["id"])
+        return [e if isinstance(result, dict) else result for result in results]
+
+    return results
 
 def get_file(encrypted_filename):
     """Get file from database"""
@@ -83,41 +255,118 @@ def get_file(encrypted_filename):
         }
     return None
 
-def get_file_by_id(file_id):
-    """Get file from database by its ID and read encrypted content from disk."""
-    return redis_to_dict(REDIS_CLIENT.hgetall(file_id))
+def get_file_by_id(file_id: str, user_id: str) -> dict:
+    """Get a user's file metadata by its ID."""
+    file_data = REDIS_CLIENT.hgetall(file_key(user_id, file_id))
+    if file_data:
+        return redis_to_dict(file_data)
+    return None
+
+def rename_file(file_id: str, user_id: str, name: str) -> dict:
+    """Rename a file, moving it in the name and search indexes; returns its metadata, or None if it doesn't exist."""
+    def rename(pipe):
+        file_data = redis_to_dict(pipe.hgetall(file_key(user_id, file_id)))
+        if not file_data:
+            return None
+        pipe.multi()
+        _unindex_file(pipe, file_data)
+        file_data["original_filename"] = name
+        pipe.hset(file_key(user_id, file_id), "original_filename", name)
+        _index_file(pipe, file_data)
+        return file_data
+
+    # WATCH the file so a concurrent rename or delete can't leave stale index entries
+    return REDIS_CLIENT.transaction(rename, file_key(user_id, file_id), value_from_callable=True)
 
-def delete_file(file_id):
+def delete_file(file_id: str, user_id: str):
     """Delete file from database and encrypted content from disk."""
-    REDIS_CLIENT.delete(f"user:{user_id}:file:{file_id}")
-    delete_encrypted_file(file_id)
+    def remove(pipe):
+        file_data = redis_to_dict(pipe.hgetall(file_key(user_id, file_id)))
+        if not file_data:
+            return False
+        pipe.multi()
+        pipe.delete(file_key(user_id, file_id))
+        _unindex_file(pipe, file_data)
+        release_storage(user_id, int(file_data["file_size"]), pipe)
+        return True
+
+    # WATCH the file so a concurrent delete can't release its size twice
+    if REDIS_CLIENT.transaction(remove, file_key(user_id, file_id), value_from_callable=True):
+        release_file_chunks(user_id, file_id)
+        delete_encrypted_file(file_id)
 
 def count_user_filesize(user_id):
-    """Count the total size of all files for a user from database."""
-    files = REDIS_CLIENT.keys(f"user:{user_id}:file:*")
-    file_size_sum = 0
-    for file in files:
-        file_data = REDIS_CLIENT.hgetall(file)
-        file_size_sum += int(file_data["file_size"])
-    return file_size_sum
+    """Count the total size of all files for a user by adding up their metadata.
 
-def list_files(parent_id=None, user_id=None):
-    """List all files with optional parent folder filtering"""
-    files = REDIS_CLIENT.keys(f"user:{user_id}:files:{parent_id or 'root'}:*")
-    files_list = []
+    Only used to rebuild the usage counter, see rdb.usage.get_storage_usage.
+    """
+    file_ids = page(REDIS_CLIENT, files_index_prefix(user_id, "all"), "files")[0]
+    pipe = REDIS_CLIENT.pipeline()
+    for file_id in file_ids:
+        pipe.hget(file_key(user_id, file_id), "file_size")
+    return sum(int(size) for size in pipe.execute() if size is not None)
 
-    for file in files:
-        data = get_file_by_id(file)
-        files_list.append(data)
-    
-    return files_list
+def page_files(parent_id=None, user_id=None, limit=None, cursor=None, order='created', search=None) -> tuple:
+    """
+    List one page of a folder's files.
+    Args:
+        parent_id: Folder to list, None for the root folder or 'all' for every file
+        user_id: Owner of the folder
+        limit: Maximum number of files to return, or None for all of them
+        cursor: Cursor returned with the previous page
+        order: 'created' (newest first) or 'name' (alphabetical)
+        search: Case-insensitive filename prefix, requires the 'name' order
+    Returns:
+        Tuple of (files, next_cursor)
+    """
+    file_ids, next_cursor = page(
+        REDIS_CLIENT,
+        files_index_prefix(user_id, parent_id),
+        "files",
+        order=order,
+        limit=limit,
+        cursor=cursor,
+        search=search
+    )
+    files = get_hashes([file_key(user_id, file_id) for file_id in file_ids])
+    return [file for file in files if file], next_cursor
+
+def list_files(parent_id=None, user_id=None):
+    """List all files with optional parent folder filtering, newest first"""
+    return page_files(parent_id, user_id)[0]
 
 def list_all_files(user_id):
     """List all files from database"""
-    files = REDIS_CLIENT.keys(f"user:{user_id}:file:*")
-    files_list = []
-    for file in files:
-        data = get_file_by_id(file)
-        files_list.append(data)
-    return files_list
+    return page_files("all", user_id)[0]
+
+def reindex_files(batch_size: int = 1000) -> int:
+    """Rebuild the file indexes from the file hashes, returning the number indexed.
+
+    Files stored under the old user:{id}:files:{parent}:{file} keys are moved
+    to their user:{id}:file:{file} key on the way.
+    """
+    indexed = 0
+    for key in REDIS_CLIENT.scan_iter(match="user:*:file*:*", count=batch_size, _type="HASH"):
+        file_data = redis_to_dict(REDIS_CLIENT.hgetall(key))
+        if not file_data.get("id"):
+            continue
+        canonical_key = file_key(file_data["user_id"], file_data["id"])
+        pipe = REDIS_CLIENT.pipeline()
+        if key.decode('utf-8') != canonical_key:
+            pipe.rename(key, canonical_key)
+        _index_file(pipe, file_data)
+        pipe.execute()
+        indexed += 1
+    return indexed
 
+def recount_storage_usage(batch_size: int = 1000) -> int:
+    """Reset every user's usage counter from their files, returning the number of users."""
+    users = 0
+    for key in REDIS_CLIENT.scan_iter(match="user:*", count=batch_size, _type="HASH"):
+        # User hashes are the only keys of the form user:{id}
+        if key.count(b":") != 1:
+            continue
+        user_id = key.decode('utf-8').split(":", 1)[1]
+        set_storage_usage(user_id, count_user_filesize(user_id))
+        users += 1
+    return users
@@ -2,6 +2,43 @@ from redis_client import REDIS_CLIENT
 import uuid
 from datetime import datetime
 from utils.transformations import redis_to_dict
+from rdb.index import add_to_indexes, remove_from_indexes, page
+from rdb.batch import get_hashes
+from rdb.search import FOLDER_KIND, index_name, unindex_name
+from rdb.versions import NAMES_VERSION, bump_versions
+
+# Deepest folder tree walked when resolving a folder's ancestors; also stops
+# the walk if a parent_id loop ever made it into the data
+MAX_FOLDER_DEPTH = 256
+
+# Walks up from a folder through parent_id, returning the chain of
+# [id, name, parent_id, created_at] from the folder itself to the top level.
+# Sent with EVAL so it can be queued on sync and asyncio pipelines alike.
+FOLDER_PATH_LUA = """
+local base = 'user:' .. ARGV[1] .. ':folders:'
+local folder_id = ARGV[2]
+local path = {}
+for _ = 1, tonumber(ARGV[3]) do
+    local folder = redis.call('HMGET', base .. folder_id, 'id', 'name', 'parent_id', 'created_at')
+    if not folder[1] then
+        break
+    end
+    table.insert(path, folder)
+    if not folder[3] or folder[3] == 'root' then
+        break
+    end
+    folder_id = folder[3]
+end
+return path
+"""
+
+def folder_key(user_id: str, folder_id: str) -> str:
+    """Redis key of a folder's metadata hash."""
+    return f"user:{user_id}:folders:{folder_id}"
+
+def folders_index_prefix(user_id: str, parent_id: str = None) -> str:
+    """Key prefix of the indexes of a folder's subfolders, or of all folders for parent 'all'."""
+    return f"user:{user_id}:index:{parent_id or 'root'}:folders"
 
 def create_folder(name: str, user_id: str, parent_id: str = None) -> dict:
     """Create a new folder."""
@@ -14,40 +51,115 @@ def create_folder(name: str, user_id: str, parent_id: str = None) -> dict:
         "created_at": created_at.isoformat(),
         "user_id": user_id
     }
-    REDIS_CLIENT.hset(f"user:{user_id}:folders:{folder_id}", mapping=mapping)
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.hset(folder_key(user_id, folder_id), mapping=mapping)
+    add_to_indexes(pipe, folders_index_prefix(user_id, mapping["parent_id"]), mapping["created_at"], name, folder_id)
+    add_to_indexes(pipe, folders_index_prefix(user_id, "all"), mapping["created_at"], name, folder_id)
+    index_name(pipe, user_id, FOLDER_KIND, folder_id, name)
+    bump_versions(pipe, user_id, mapping["parent_id"])
+    pipe.execute()
     return mapping
 
 def get_folder(folder_id: str, user_id: str) -> dict:
     """Get folder details"""
-    folder = REDIS_CLIENT.hgetall(f"user:{user_id}:folders:{folder_id}")
+    folder = REDIS_CLIENT.hgetall(folder_key(user_id, folder_id))
     if folder:
         return redis_to_dict(folder)
     return None
 
+def queue_folder_path(pipe, folder_id: str, user_id: str, max_depth: int = MAX_FOLDER_DEPTH):
+    """Queue the ancestor walk of a folder on a pipeline; decode its result with decode_folder_path."""
+    pipe.eval(FOLDER_PATH_LUA, 0, user_id, folder_id, max_depth)
+
+def decode_folder_path(result: list) -> list:
+    """Turn the ancestor walk's reply into folders ordered from the top level down, or None if the folder doesn't exist."""
+    if not result:
+        return None
+    fields = ("id", "name", "parent_id", "created_at")
+    return [
+        {field: value.decode('utf-8') if value is not None else None for field, value in zip(fields, folder)}
+        for folder in reversed(result)
+    ]
+
+def get_folder_path(folder_id: str, user_id: str) -> list:
+    """
+    Get the chain of folders from the top level down to a folder, in one round trip.
+    Returns None if the folder does not exist.
+    """
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    queue_folder_path(pipe, folder_id, user_id)
+    return decode_folder_path(pipe.execute()[0])
+
 def get_direct_folder(folder_id: str) -> dict:
     """Get folder details"""
     folder = REDIS_CLIENT.hgetall(folder_id)
     return redis_to_dict(folder)
 
-def list_folders(parent_id: str = None, user_id: str = None) -> list:
-    """List all folders with optional parent filtering"""
-    folders = REDIS_CLIENT.keys(f"user:{user_id}:folders:*")
+def delete_folder(folder_id: str, user_id: str):
+    """Delete a single folder record and its index entries."""
+    folder = get_folder(folder_id, user_id)
+    if not folder:
+        return
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.delete(folder_key(user_id, folder_id))
+    remove_from_indexes(pipe, folders_index_prefix(user_id, folder["parent_id"]), folder["created_at"], folder["name"], folder_id)
+    remove_from_indexes(pipe, folders_index_prefix(user_id, "all"), folder["created_at"], folder["name"], folder_id)
+    unindex_name(pipe, user_id, FOLDER_KIND, folder_id, folder["name"])
+    bump_versions(pipe, user_id, folder["parent_id"])
+    pipe.execute()
 
-    children_folders = []
+def rename_folder(folder_id: str, user_id: str, name: str) -> dict:
+    """Rename a folder, moving it in the name and search indexes; returns its metadata, or None if it doesn't exist."""
+    def rename(pipe):
+        folder = redis_to_dict(pipe.hgetall(folder_key(user_id, folder_id)))
+        if not folder:
+            return None
+        pipe.multi()
+        for parent_id in (folder["parent_id"], "all"):
+            remove_from_indexes(pipe, folders_index_prefix(user_id, parent_id), folder["created_at"], folder["name"], folder_id)
+            add_to_indexes(pipe, folders_index_prefix(user_id, parent_id), folder["created_at"], name, folder_id)
+        unindex_name(pipe, user_id, FOLDER_KIND, folder_id, folder["name"])
+        index_name(pipe, user_id, FOLDER_KIND, folder_id, name)
+        pipe.hset(folder_key(user_id, folder_id), "name", name)
+        bump_versions(pipe, user_id, folder["parent_id"], NAMES_VERSION)
+        folder["name"] = name
+        return folder
 
-    for folder_id in folders:
-        folder = get_direct_folder(folder_id)
-        if (parent_id is None):
-            if folder['parent_id'] == "root":
-                children_folders.append(folder_id)
-        if folder['parent_id'] == parent_id:
-            children_folders.append(folder_id)
-    return [
-        get_direct_folder(folder_id) for folder_id in children_folders
-    ]
+    # WATCH the folder so a concurrent rename or delete can't leave stale index entries
+    return REDIS_CLIENT.transaction(rename, folder_key(user_id, folder_id), value_from_callable=True)
 
-def list_all_folders(user_id: str = None) -> list:
+def page_folders(parent_id: str = None, user_id: str = None, limit: int = None, cursor: str = None, order: str = 'name') -> tuple:
+    """List one page of a folder's subfolders, returning (folders, next_cursor)."""
+    folder_ids, next_cursor = page(
+        REDIS_CLIENT,
+        folders_index_prefix(user_id, parent_id),
+        "folders",
+        order=order,
+        limit=limit,
+        cursor=cursor
+    )
+    folders = get_hashes([folder_key(user_id, folder_id) for folder_id in folder_ids])
+    return [folder for folder in folders if folder], next_cursor
+
+def list_folders(parent_id: str = None, user_id: str = None) -> list:
     """List all folders with optional parent filtering"""
-    folders = REDIS_CLIENT.keys(f"user:{user_id}:folders:{parent_id or 'root'}")
-    return [get_direct_folder(folder_id) for folder_id in folders]
+    return page_folders(parent_id, user_id)[0]
+
+def list_all_folders(user_id: str = None) -> list:
+    """List all folders of a user"""
+    return page_folders("all", user_id, order='created')[0]
 
+def reindex_folders(batch_size: int = 1000) -> int:
+    """Rebuild the folder indexes from the folder hashes, returning the number indexed."""
+    indexed = 0
+    for key in REDIS_CLIENT.scan_iter(match="user:*:folders:*", count=batch_size, _type="HASH"):
+        folder = redis_to_dict(REDIS_CLIENT.hgetall(key))
+        if not folder.get("id"):
+            continue
+        pipe = REDIS_CLIENT.pipeline()
+        add_to_indexes(pipe, folders_index_prefix(folder["user_id"], folder["parent_id"]), folder["created_at"], folder["name"], folder["id"])
+        add_to_indexes(pipe, folders_index_prefix(folder["user_id"], "all"), folder["created_at"], folder["name"], folder["id"])
+        index_name(pipe, folder["user_id"], FOLDER_KIND, folder["id"], folder["name"])
+        pipe.execute()
+        indexed += 1
+    return indexed
@@ -0,0 +1,108 @@
+import base64
+
+# Folder contents are indexed in sorted sets whose members all have score 0, so
+# Redis keeps them in lexical order and ZRANGEBYLEX can page through them.
+# Every member is "<sort value>\x00<id>": ISO timestamps sort chronologically
+# and lower-cased names alphabetically, while the id keeps members unique.
+ORDERS = ('created', 'name')
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+def index_member(sort_value: str, item_id: str) -> bytes:
+    return f"{sort_value}\x00{item_id}".encode('utf-8')
+
+def member_id(member: bytes) -> str:
+    return member.rsplit(b"\x00", 1)[1].decode('utf-8')
+
+def name_member(name: str, item_id: str) -> bytes:
+    return index_member(name.lower(), item_id)
+
+def index_keys(prefix: str) -> dict:
+    """Index keys for every supported order, e.g. {prefix}:created."""
+    return {order: f"{prefix}:{order}" for order in ORDERS}
+
+def add_to_indexes(pipe, prefix: str, created_at: str, name: str, item_id: str):
+    keys = index_keys(prefix)
+    pipe.zadd(keys['created'], {index_member(created_at, item_id): 0})
+    pipe.zadd(keys['name'], {name_member(name, item_id): 0})
+
+def remove_from_indexes(pipe, prefix: str, created_at: str, name: str, item_id: str):
+    keys = index_keys(prefix)
+    pipe.zrem(keys['created'], index_member(created_at, item_id))
+    pipe.zrem(keys['name'], name_member(name, item_id))
+
+def encode_cursor(kind: str, member: bytes) -> str:
+    return base64.urlsafe_b64encode(kind.encode('utf-8') + b"\x00" + member).decode('ascii')
+
+def decode_cursor(cursor: str) -> tuple:
+    """Split a cursor into the kind of listing it belongs to and its last member."""
+    try:
+        kind, member = base64.urlsafe_b64decode(cursor.encode('ascii')).split(b"\x00", 1)
+        return kind.decode('utf-8'), member
+    except Exception:
+        raise InvalidCursor('Invalid cursor')
+
+def start_cursor(kind: str, order: str) -> str:
+    """Cursor pointing at the beginning of a listing."""
+    return encode_cursor(f"{kind}:{order}", b"")
+
+def queue_page(pipe, prefix: str, kind: str, order: str = 'created', limit: int = None, cursor: str = None, search: str = None):
+    """
+    Queue the read of one page of an index on a pipeline.
+    Args:
+        pipe: Pipeline to queue the read on
+        prefix: Index key prefix, without the order suffix
+        kind: Listing name embedded in cursors, together with the order, so they
+            cannot be replayed against another listing
+        order: 'created' (newest first) or 'name' (alphabetical)
+        limit: Maximum number of IDs to return, or None for all of them
+        cursor: Cursor returned with the previous page
+        search: Case-insensitive name prefix, only valid with the 'name' order
+    The pipeline result is turned into a page by read_page. Cursors point at the
+    last member returned, so inserts and deletes elsewhere in the folder never
+    shift or repeat entries between pages.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Invalid order: {order}")
+    if limit is not None and limit < 1:
+        raise ValueError("Limit must be a positive number")
+    if search and order != 'name':
+        raise ValueError("Search requires the 'name' order")
+    key = index_keys(prefix)[order]
+    after = None
+    if cursor:
+        cursor_kind, after = decode_cursor(cursor)
+        if cursor_kind != f"{kind}:{order}":
+            raise InvalidCursor('Cursor does not belong to this listing')
+
+    # Fetch one extra member to know whether another page follows
+    num = {'start': 0, 'num': limit + 1} if limit is not None else {}
+    if order == 'created':
+        upper = b"(" + after if after else b"+"
+        pipe.zrevrangebylex(key, upper, b"-", **num)
+    else:
+        lower = b"-"
+        upper = b"+"
+        if search:
+            prefix_bytes = search.lower().encode('utf-8')
+            lower = b"[" + prefix_bytes
+            # 0xff never occurs in UTF-8, so it sorts after every continuation
+            upper = b"[" + prefix_bytes + b"\xff"
+        if after:
+            lower = b"(" + after
+        pipe.zrangebylex(key, lower, upper, **num)
+
+def read_page(members: list, kind: str, order: str = 'created', limit: int = None) -> tuple:
+    """Turn the members read by queue_page into a tuple of (ids, next_cursor)."""
+    next_cursor = None
+    if limit is not None and len(members) > limit:
+        members = members[:limit]
+        next_cursor = encode_cursor(f"{kind}:{order}", members[-1])
+    return [member_id(member) for member in members], next_cursor
+
+def page(client, prefix: str, kind: str, order: str = 'created', limit: int = None, cursor: str = None, search: str = None) -> tuple:
+    """Read one page of item IDs from an index, see queue_page for the arguments."""
+    pipe = client.pipeline(transaction=False)
+    queue_page(pipe, prefix, kind, order, limit, cursor, search)
+    return read_page(pipe.execute()[0], kind, order, limit)
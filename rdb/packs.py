@@ -0,0 +1,78 @@
+from redis_client import REDIS_CLIENT
+
+# Location of every packed blob, as "{segment}:{offset}:{length}" keyed by file ID
+PACK_INDEX_KEY = "packs:index"
+# Bytes of each segment taken by deleted or superseded entries
+PACK_DEAD_KEY = "packs:dead"
+
+# Remove an entry and account its bytes as dead in the same step
+DELETE_SCRIPT = REDIS_CLIENT.register_script("""
+local location = redis.call('HGET', KEYS[1], ARGV[1])
+if not location then
+    return nil
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+local segment, offset, length = string.match(location, '^(.+):(%d+):(%d+)$')
+redis.call('HINCRBY', KEYS[2], segment, tonumber(length) + tonumber(ARGV[2]))
+return location
+""")
+
+# Point an entry at its copy in a new segment, unless it changed since it was copied
+MOVE_SCRIPT = REDIS_CLIENT.register_script("""
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return 1
+""")
+
+def format_location(segment: str, offset: int, length: int) -> str:
+    return f"{segment}:{offset}:{length}"
+
+def parse_location(location) -> tuple:
+    """Split a stored location into (segment, offset, length)."""
+    if isinstance(location, bytes):
+        location = location.decode('utf-8')
+    segment, offset, length = location.rsplit(':', 2)
+    return segment, int(offset), int(length)
+
+def get_pack_location(file_id: str):
+    """Get (segment, offset, length) of a packed blob, or None if it isn't packed."""
+    location = REDIS_CLIENT.hget(PACK_INDEX_KEY, file_id)
+    return parse_location(location) if location else None
+
+def set_pack_location(file_id: str, segment: str, offset: int, length: int):
+    REDIS_CLIENT.hset(PACK_INDEX_KEY, file_id, format_location(segment, offset, length))
+
+def delete_pack_location(file_id: str, overhead: int = 0):
+    """
+    Remove a packed blob from the index.
+    Args:
+        file_id: ID of the file
+        overhead: Bytes the entry takes in its segment besides the blob itself
+    Returns:
+        Its former (segment, offset, length), or None if it wasn't packed
+    """
+    location = DELETE_SCRIPT(keys=[PACK_INDEX_KEY, PACK_DEAD_KEY], args=[file_id, overhead])
+    return parse_location(location) if location else None
+
+def move_pack_location(file_id: str, old_location: tuple, new_location: tuple) -> bool:
+    """Repoint a blob copied by compaction; False if it was deleted in the meantime."""
+    return MOVE_SCRIPT(
+        keys=[PACK_INDEX_KEY],
+        args=[file_id, format_location(*old_location), format_location(*new_location)]
+    ) == 1
+
+def add_dead_bytes(segment: str, size: int):
+    REDIS_CLIENT.hincrby(PACK_DEAD_KEY, segment, size)
+
+def get_dead_bytes() -> dict:
+    """Dead bytes of every segment that has any."""
+    return {
+        segment.decode('utf-8'): int(size)
+        for segment, size in REDIS_CLIENT.hgetall(PACK_DEAD_KEY).items()
+    }
+
+def forget_segment(segment: str):
+    """Drop the bookkeeping of a segment removed by compaction."""
+    REDIS_CLIENT.hdel(PACK_DEAD_KEY, segment)
@@ -0,0 +1,137 @@
+from rdb.index import InvalidCursor, encode_cursor, decode_cursor
+
+# Names of a user's files and folders are indexed by trigram: every run of three
+# characters of the lower-cased name, padded with two spaces in front and one
+# behind, maps to a set of the entries containing it. A search intersects the
+# sets of its term's trigrams and checks the few candidates left against the
+# names themselves. Members are "f:{file_id}" or "d:{folder_id}".
+TRIGRAM_PAD_START = '  '
+TRIGRAM_PAD_END = ' '
+FILE_KIND = 'f'
+FOLDER_KIND = 'd'
+
+# Results returned per page when no limit is given, and the most ever returned
+# in one page; further matches are reached with the page's cursor
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 1000
+
+# Finds, ranks and trims the matches of a term in one call.
+# KEYS: the names hash, then the sets of the term's trigrams
+# ARGV: lower-cased term, limit, kind to keep ('' for both), matches to skip
+# Matches rank by whole name, then prefix, then word start, then anywhere,
+# and within each by how early the term appears and how short the name is;
+# ties go by member, so the order is the same from one page to the next.
+# Members whose name is gone belong to deleted entries and are pruned.
+SEARCH_LUA = """
+local names = KEYS[1]
+local term, limit, kind, offset = ARGV[1], tonumber(ARGV[2]), ARGV[3], tonumber(ARGV[4])
+local candidates = redis.call('SINTER', unpack(KEYS, 2))
+local matches = {}
+for _, member in ipairs(candidates) do
+    if kind == '' or string.sub(member, 1, 1) == kind then
+        local name = redis.call('HGET', names, member)
+        if not name then
+            for i = 2, #KEYS do
+                redis.call('SREM', KEYS[i], member)
+            end
+        else
+            local position = string.find(name, term, 1, true)
+            if position then
+                local rank = 3
+                if name == term then
+                    rank = 0
+                elseif position == 1 then
+                    rank = 1
+                elseif not string.find(string.sub(name, position - 1, position - 1), '%w') then
+                    rank = 2
+                end
+                table.insert(matches, {rank * 1e9 + math.min(position, 9999) * 1e4 + math.min(#name, 9999), member})
+            end
+        end
+    end
+end
+table.sort(matches, function(a, b)
+    if a[1] ~= b[1] then
+        return a[1] < b[1]
+    end
+    return a[2] < b[2]
+end)
+local result = {}
+for i = offset + 1, math.min(offset + limit, #matches) do
+    table.insert(result, matches[i][2])
+end
+return result
+"""
+
+def names_key(user_id: str) -> str:
+    """Redis hash of the lower-cased name of every indexed entry."""
+    return f"user:{user_id}:search:names"
+
+def trigram_key(user_id: str, trigram: str) -> str:
+    return f"user:{user_id}:search:{trigram}"
+
+def trigrams(name: str) -> set:
+    """The trigrams a name is indexed under."""
+    padded = TRIGRAM_PAD_START + name.lower() + TRIGRAM_PAD_END
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def term_trigrams(term: str) -> set:
+    """
+    The trigrams every name containing `term` is indexed under.
+    Terms shorter than three characters are looked up by their padded
+    trigram, so they match at the start of the name or of a word in it.
+    """
+    term = term.lower()
+    if len(term) >= 3:
+        return {term[i:i + 3] for i in range(len(term) - 2)}
+    return {(TRIGRAM_PAD_START + term)[-3:]}
+
+def index_name(pipe, user_id: str, kind: str, item_id: str, name: str):
+    """Queue the indexing of a file or folder name on a pipeline."""
+    member = f"{kind}:{item_id}"
+    pipe.hset(names_key(user_id), member, name.lower())
+    for trigram in trigrams(name):
+        pipe.sadd(trigram_key(user_id, trigram), member)
+
+def unindex_name(pipe, user_id: str, kind: str, item_id: str, name: str):
+    """Queue the removal of a file or folder name from the index on a pipeline."""
+    member = f"{kind}:{item_id}"
+    pipe.hdel(names_key(user_id), member)
+    for trigram in trigrams(name):
+        pipe.srem(trigram_key(user_id, trigram), member)
+
+def queue_search(pipe, user_id: str, term: str, limit: int = SEARCH_DEFAULT_LIMIT, kind: str = '', offset: int = 0):
+    """
+    Queue a ranked name search on a pipeline; its result is a list of members.
+    Args:
+        pipe: Pipeline to queue the search on
+        user_id: Owner of the entries searched
+        term: Text to find anywhere in the names, case-insensitively
+        limit: Maximum number of matches to return
+        kind: FILE_KIND or FOLDER_KIND to search only files or folders
+        offset: Number of best matches to skip, for later pages
+    Sent with EVAL so it can be queued on sync and asyncio pipelines alike.
+    """
+    keys = [names_key(user_id)] + [trigram_key(user_id, trigram) for trigram in sorted(term_trigrams(term))]
+    pipe.eval(SEARCH_LUA, len(keys), *keys, term.lower(), limit, kind, offset)
+
+def search_cursor(term: str, offset: int) -> str:
+    """Cursor of the page of a search starting after `offset` matches."""
+    return encode_cursor('search', f"{offset}\x00{term.lower()}".encode('utf-8'))
+
+def search_offset(cursor: str, term: str) -> int:
+    """Matches to skip for a search cursor; InvalidCursor if it belongs to another listing or term."""
+    kind, member = decode_cursor(cursor)
+    try:
+        offset, cursor_term = member.decode('utf-8').split('\x00', 1)
+        offset = int(offset)
+    except ValueError:
+        raise InvalidCursor('Invalid cursor')
+    if kind != 'search' or cursor_term != term.lower() or offset < 0:
+        raise InvalidCursor('Cursor does not belong to this search')
+    return offset
+
+def split_member(member: bytes) -> tuple:
+    """Split a search result into its kind and ID."""
+    kind, item_id = member.decode('utf-8').split(':', 1)
+    return kind, item_id
@@ -0,0 +1,253 @@
+import uuid
+from redis_client import REDIS_CLIENT
+from rdb.folders import folder_key
+from rdb.usage import usage_key
+from rdb.search import names_key, unindex_name
+
+# Keys of deleted records, renamed out of the way and waiting to be unlinked
+TRASH_KEYS_KEY = "trash:keys"
+# Blobs of deleted files as "{user_id}:{file_id}", waiting to be removed from disk
+TRASH_BLOBS_KEY = "trash:blobs"
+# Names of deleted files and folders as "{user_id}:{kind}:{id}:{name}", whose
+# trigrams are still to be removed from the search index
+TRASH_NAMES_KEY = "trash:names"
+# Held by the one process emptying the trash, so nothing is reclaimed twice
+TRASH_LOCK_KEY = "trash:lock"
+# Tokens of the reapers that claimed trash entries and may not have reclaimed them all
+TRASH_CLAIMS_KEY = "trash:claims"
+
+class FolderChanged(Exception):
+    """Raised when a folder is renamed while it is being deleted."""
+
+# Detaches a folder and everything below it in one step. The folder is taken
+# out of its parent's and the global indexes, every descendant out of the
+# global indexes, and all of their keys are renamed into the trash, so the
+# subtree vanishes at once for every reader. The usage counter drops by the
+# size of the files right away; their blobs are queued for the reaper, and
+# so are their names, which leave the search results at once but whose
+# trigrams Lua can't compute. The versions of the parent and of the whole
+# tree are bumped, and those of the deleted folders discarded.
+# Name index members hold the Python-lowercased name, which Lua can't
+# reproduce, so the folder's own member is passed in and those of its
+# descendants are read from their parents' indexes. Keys below the folder are
+# found while walking, so this only runs on a single Redis instance.
+DETACH_SCRIPT = REDIS_CLIENT.register_script("""
+local usage, trash_keys, trash_blobs, trash_names, names = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local user_id, root, name, name_sort = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local base = 'user:' .. user_id
+local sep = string.char(0)
+
+local function index(parent, kind, order)
+    return base .. ':index:' .. parent .. ':' .. kind .. ':' .. order
+end
+local function discard(key)
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('RENAME', key, 'trash:' .. key)
+        redis.call('RPUSH', trash_keys, 'trash:' .. key)
+    end
+end
+local function forget_name(member)
+    local indexed = redis.call('HGET', names, member)
+    if indexed then
+        redis.call('HDEL', names, member)
+        redis.call('RPUSH', trash_names, user_id .. ':' .. member .. ':' .. indexed)
+    end
+end
+local function unindex(key, members)
+    for i = 1, #members, 1000 do
+        redis.call('ZREM', key, unpack(members, i, math.min(i + 999, #members)))
+    end
+end
+
+local folder = redis.call('HMGET', base .. ':folders:' .. root, 'parent_id', 'created_at', 'name')
+if not folder[2] then
+    return false
+end
+if folder[3] ~= name then
+    return -1
+end
+for _, parent in ipairs({folder[1], 'all'}) do
+    redis.call('ZREM', index(parent, 'folders', 'created'), folder[2] .. sep .. root)
+    redis.call('ZREM', index(parent, 'folders', 'name'), name_sort .. sep .. root)
+    redis.call('INCR', base .. ':version:' .. parent)
+end
+
+local folders, files, released = 0, 0, 0
+local stack = {root}
+while #stack > 0 do
+    local folder_id = table.remove(stack)
+    for _, kind in ipairs({'folders', 'files'}) do
+        for _, order in ipairs({'created', 'name'}) do
+            local members = redis.call('ZRANGE', index(folder_id, kind, order), 0, -1)
+            unindex(index('all', kind, order), members)
+            if order == 'created' then
+                for _, member in ipairs(members) do
+                    local child_id = string.sub(member, string.find(member, sep, 1, true) + 1)
+                    if kind == 'folders' then
+                        table.insert(stack, child_id)
+                    else
+                        local child_key = base .. ':file:' .. child_id
+                        released = released + (tonumber(redis.call('HGET', child_key, 'file_size')) or 0)
+                        discard(child_key)
+                        forget_name('f:' .. child_id)
+                        redis.call('RPUSH', trash_blobs, user_id .. ':' .. child_id)
+                        files = files + 1
+                    end
+                end
+            end
+            discard(index(folder_id, kind, order))
+        end
+    end
+    discard(base .. ':folders:' .. folder_id)
+    discard(base .. ':version:' .. folder_id)
+    forget_name('d:' .. folder_id)
+    folders = folders + 1
+end
+if released > 0 then
+    redis.call('DECRBY', usage, released)
+end
+return {folders, files}
+""")
+
+# Deletes the lock only if it is still ours
+UNLOCK_SCRIPT = REDIS_CLIENT.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# Moves up to ARGV[3] of the oldest entries of a trash list onto the claims
+# list of the lock holder, renewing the lock for ARGV[2] ms. Nothing is
+# claimed, and false returned, once the lock has run out or been taken over.
+CLAIM_SCRIPT = REDIS_CLIENT.register_script("""
+local lock, source, claimed, claims = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local token, ttl, count = ARGV[1], ARGV[2], tonumber(ARGV[3])
+if redis.call('GET', lock) ~= token then
+    return false
+end
+redis.call('PEXPIRE', lock, ttl)
+redis.call('SADD', claims, token)
+local entries = {}
+for i = 1, count do
+    local entry = redis.call('LMOVE', source, claimed, 'LEFT', 'RIGHT')
+    if not entry then
+        break
+    end
+    entries[i] = entry
+end
+return entries
+""")
+
+# Puts entries claimed by reapers that lost the lock back at the head of
+# their trash lists, in their original order, for the lock holder to reclaim.
+# The claims lists are named after the tokens, so this only runs on a single
+# Redis instance.
+RECOVER_SCRIPT = REDIS_CLIENT.register_script("""
+local lock, claims = KEYS[1], KEYS[2]
+local token = ARGV[1]
+if redis.call('GET', lock) ~= token then
+    return false
+end
+local recovered = 0
+for _, other in ipairs(redis.call('SMEMBERS', claims)) do
+    if other ~= token then
+        for i = 2, #ARGV do
+            while redis.call('LMOVE', ARGV[i] .. ':claimed:' .. other, ARGV[i], 'RIGHT', 'LEFT') do
+                recovered = recovered + 1
+            end
+        end
+        redis.call('SREM', claims, other)
+    end
+end
+return recovered
+""")
+
+def detach_folder(folder_id: str, user_id: str, retries: int = 3) -> dict:
+    """
+    Delete a folder and everything below it from the metadata, atomically.
+    Returns:
+        Dict with the number of folders and files deleted, or None if the
+        folder does not exist. Their keys and blobs are left in the trash for
+        the reaper.
+    """
+    for _ in range(retries):
+        folder = REDIS_CLIENT.hmget(folder_key(user_id, folder_id), "name")[0]
+        if folder is None:
+            return None
+        name = folder.decode('utf-8')
+        result = DETACH_SCRIPT(
+            keys=[usage_key(user_id), TRASH_KEYS_KEY, TRASH_BLOBS_KEY, TRASH_NAMES_KEY, names_key(user_id)],
+            args=[user_id, folder_id, name, name.lower()]
+        )
+        if result is None:
+            return None
+        if result != -1:
+            return {'folders': result[0], 'files': result[1]}
+    raise FolderChanged('Folder kept changing while it was being deleted')
+
+def lock_trash(ttl: int) -> str:
+    """Take the reaper lock for `ttl` seconds, returning its token, or None if another process holds it."""
+    token = uuid.uuid4().hex
+    if REDIS_CLIENT.set(TRASH_LOCK_KEY, token, nx=True, ex=ttl):
+        return token
+    return None
+
+def unlock_trash(token: str):
+    UNLOCK_SCRIPT(keys=[TRASH_LOCK_KEY], args=[token])
+
+def claimed_key(key: str, token: str) -> str:
+    """List of the entries of a trash list claimed by the holder of `token`."""
+    return f"{key}:claimed:{token}"
+
+def claim_trash(key: str, token: str, count: int, ttl: int) -> list:
+    """
+    Claim the oldest `count` entries of a trash list, renewing the lock for `ttl` seconds.
+    Returns:
+        The claimed entries, or None if the lock was lost, in which case the
+        caller must stop. Claimed entries leave the trash list at once, so
+        no other reaper sees them; they stay on the claims list until
+        release_claim, and are recovered from there if the claimer dies.
+    """
+    entries = CLAIM_SCRIPT(
+        keys=[TRASH_LOCK_KEY, key, claimed_key(key, token), TRASH_CLAIMS_KEY],
+        args=[token, ttl * 1000, count]
+    )
+    if entries is None:
+        return None
+    return [entry.decode('utf-8') for entry in entries]
+
+def release_claim(key: str, token: str):
+    """Forget the entries of a trash list claimed with `token`, once they are reclaimed."""
+    REDIS_CLIENT.delete(claimed_key(key, token))
+
+def recover_claims(token: str, keys: list) -> int:
+    """Return the entries claimed by earlier lock holders to the trash lists `keys`."""
+    return RECOVER_SCRIPT(keys=[TRASH_LOCK_KEY, TRASH_CLAIMS_KEY], args=[token] + keys) or 0
+
+def forget_claims(token: str):
+    """Drop a token from the claims once everything it claimed is reclaimed."""
+    REDIS_CLIENT.srem(TRASH_CLAIMS_KEY, token)
+
+def unlink_keys(keys: list):
+    """Delete keys without blocking Redis on freeing their memory."""
+    if keys:
+        REDIS_CLIENT.unlink(*keys)
+
+def unindex_names(entries: list):
+    """Remove the trigrams of names taken from the trash from the search index."""
+    if not entries:
+        return
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for entry in entries:
+        user_id, kind, item_id, name = entry.split(':', 3)
+        unindex_name(pipe, user_id, kind, item_id, name)
+    pipe.execute()
+
+def trash_size() -> dict:
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    pipe.llen(TRASH_KEYS_KEY)
+    pipe.llen(TRASH_NAMES_KEY)
+    pipe.llen(TRASH_BLOBS_KEY)
+    keys, names, blobs = pipe.execute()
+    return {'keys': keys, 'names': names, 'blobs': blobs}
@@ -0,0 +1,116 @@
+import os
+import time
+import uuid
+from datetime import datetime
+from redis_client import REDIS_CLIENT
+from utils.transformations import redis_to_dict
+from rdb.usage import reserve_storage, release_storage
+
+# Seconds an upload session lives without receiving a chunk
+UPLOAD_SESSION_TTL = int(os.getenv('upload_session_ttl', 24 * 3600))
+# Every open session as "{user_id}:{session_id}:{size}", scored by expiry time.
+# Session keys expire on their own; this is how the part files and the quota
+# reserved for them are found afterwards.
+UPLOAD_REGISTRY_KEY = "uploads:expiry"
+
+# HSETNX alone would bring back a session that just expired as an empty hash
+LOCK_SCRIPT = REDIS_CLIENT.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('HSETNX', KEYS[1], 'locked', 1)
+""")
+
+def session_key(user_id: str, session_id: str) -> str:
+    return f"user:{user_id}:upload:{session_id}"
+
+def parts_key(user_id: str, session_id: str) -> str:
+    """Redis set of the chunk numbers received by a session."""
+    return f"user:{user_id}:upload:{session_id}:parts"
+
+def _registry_member(user_id: str, session_id: str, size: int) -> str:
+    return f"{user_id}:{session_id}:{size}"
+
+def create_upload_session(user_id: str, filename: str, size: int, chunk_size: int, segment_size: int, parent_id: str, mime_type: str, salt: bytes) -> dict:
+    """Open an upload session, reserving quota for the whole file; raises QuotaExceeded."""
+    session_id = str(uuid.uuid4())
+    reserve_storage(user_id, size)
+    session = {
+        "id": session_id,
+        "user_id": user_id,
+        "filename": filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "chunk_count": max(1, -(-size // chunk_size)),
+        "segment_size": segment_size,
+        "parent_id": parent_id,
+        "mime_type": mime_type,
+        "salt": salt.hex(),
+        "created_at": datetime.now().isoformat()
+    }
+    try:
+        pipe = REDIS_CLIENT.pipeline()
+        pipe.hset(session_key(user_id, session_id), mapping=session)
+        pipe.expire(session_key(user_id, session_id), UPLOAD_SESSION_TTL)
+        pipe.zadd(UPLOAD_REGISTRY_KEY, {_registry_member(user_id, session_id, size): time.time() + UPLOAD_SESSION_TTL})
+        pipe.execute()
+    except Exception:
+        release_storage(user_id, size)
+        raise
+    session["expires_in"] = UPLOAD_SESSION_TTL
+    return session
+
+def get_upload_session(user_id: str, session_id: str) -> dict:
+    """Get an open session, with the sorted chunk numbers received so far, or None."""
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    pipe.hgetall(session_key(user_id, session_id))
+    pipe.smembers(parts_key(user_id, session_id))
+    pipe.ttl(session_key(user_id, session_id))
+    session, parts, ttl = pipe.execute()
+    if not session:
+        return None
+    session = redis_to_dict(session)
+    for field in ("size", "chunk_size", "chunk_count", "segment_size"):
+        session[field] = int(session[field])
+    session["received"] = sorted(int(part) for part in parts)
+    session["expires_in"] = max(ttl, 0)
+    return session
+
+def touch_upload_session(user_id: str, session_id: str, size: int, index: int = None):
+    """Push a session's expiry back, recording a stored chunk if `index` is given."""
+    pipe = REDIS_CLIENT.pipeline()
+    if index is not None:
+        pipe.sadd(parts_key(user_id, session_id), index)
+    pipe.expire(parts_key(user_id, session_id), UPLOAD_SESSION_TTL)
+    pipe.expire(session_key(user_id, session_id), UPLOAD_SESSION_TTL)
+    # XX: a session already taken by cleanup is not brought back
+    pipe.zadd(UPLOAD_REGISTRY_KEY, {_registry_member(user_id, session_id, size): time.time() + UPLOAD_SESSION_TTL}, xx=True)
+    pipe.execute()
+
+def lock_upload_session(user_id: str, session_id: str) -> bool:
+    """Mark a session as being committed or aborted; False if that is already happening."""
+    return LOCK_SCRIPT(keys=[session_key(user_id, session_id)]) == 1
+
+def unlock_upload_session(user_id: str, session_id: str):
+    REDIS_CLIENT.hdel(session_key(user_id, session_id), "locked")
+
+def close_upload_session(user_id: str, session_id: str, size: int):
+    """Forget a committed or aborted session."""
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.zrem(UPLOAD_REGISTRY_KEY, _registry_member(user_id, session_id, size))
+    pipe.delete(session_key(user_id, session_id), parts_key(user_id, session_id))
+    pipe.execute()
+
+def claim_expired_upload_sessions(limit: int = 100) -> list:
+    """Claim up to `limit` sessions past their expiry, returning (user_id, session_id, size) tuples."""
+    claimed = []
+    members = REDIS_CLIENT.zrangebyscore(UPLOAD_REGISTRY_KEY, "-inf", time.time(), start=0, num=limit)
+    for member in members:
+        user_id, session_id, size = member.decode('utf-8').rsplit(":", 2)
+        # A chunk may have arrived since the expiry was read, extending it
+        if REDIS_CLIENT.exists(session_key(user_id, session_id)):
+            continue
+        # ZREM is the claim, so concurrent cleaners never release quota twice
+        if REDIS_CLIENT.zrem(UPLOAD_REGISTRY_KEY, member):
+            claimed.append((user_id, session_id, int(size)))
+    return claimed
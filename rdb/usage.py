@@ -0,0 +1,43 @@
+import os
+from redis_client import REDIS_CLIENT
+
+# Storage allowance of every user, in bytes
+STORAGE_LIMIT = int(os.getenv('total_storage', 107374182400))
+
+# Check-and-increment in one step, so concurrent uploads can't both pass the check
+RESERVE_SCRIPT = REDIS_CLIENT.register_script("""
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local size = tonumber(ARGV[1])
+if used + size > tonumber(ARGV[2]) then
+    return -1
+end
+return redis.call('INCRBY', KEYS[1], size)
+""")
+
+class QuotaExceeded(ValueError):
+    """Raised when a reservation would take a user over their storage limit."""
+
+def usage_key(user_id: str) -> str:
+    """Redis key of the counter holding a user's stored bytes."""
+    return f"user:{user_id}:usage"
+
+def get_storage_usage(user_id: str) -> int:
+    """Get the number of bytes a user has stored or reserved."""
+    used = REDIS_CLIENT.get(usage_key(user_id))
+    return int(used) if used else 0
+
+def reserve_storage(user_id: str, size: int, limit: int = STORAGE_LIMIT) -> int:
+    """Reserve `size` bytes of a user's quota before writing them, returning the new usage."""
+    used = RESERVE_SCRIPT(keys=[usage_key(user_id)], args=[size, limit])
+    if used < 0:
+        raise QuotaExceeded('Storage quota exceeded')
+    return used
+
+def release_storage(user_id: str, size: int, pipe=None):
+    """Give back `size` bytes of a user's quota, optionally as part of a pipeline."""
+    if size:
+        (pipe or REDIS_CLIENT).decrby(usage_key(user_id), size)
+
+def set_storage_usage(user_id: str, size: int):
+    """Overwrite a user's usage counter, e.g. after recounting their files."""
+    REDIS_CLIENT.set(usage_key(user_id), size)
@@ -4,39 +4,68 @@ from datetime import datetime
 import base64
 from cryptography.fernet import Fernet
 import os
-from crypto.keys import generate_key_from_password
+from crypto.kdf import derive_key
+
+# Channel on which token revocations are announced to every worker
+REVOCATION_CHANNEL = "auth:revocations"
+
+def email_key(email: str) -> str:
+    """Redis key of the unique email -> user ID index entry."""
+    return f"email:{email}"
 
 def user_exists(user_id):
     """Check if a user exists by ID."""
     return REDIS_CLIENT.hget("user:" + user_id, "id") is not None
 
+def get_token_epoch(user_id):
+    """Get the epoch tokens of a user must carry to be valid, or None if the user doesn't exist."""
+    user_found, epoch = REDIS_CLIENT.hmget("user:" + user_id, "id", "token_epoch")
+    if user_found is None:
+        return None
+    return int(epoch) if epoch else 0
+
+def revoke_user_tokens(user_id: str) -> int:
+    """Invalidate every token issued to a user so far and return the new epoch."""
+    epoch = REDIS_CLIENT.hincrby("user:" + user_id, "token_epoch", 1)
+    REDIS_CLIENT.publish(REVOCATION_CHANNEL, user_id)
+    return epoch
+
+def decode_user(user_data: dict) -> dict:
+    """Turn a raw user hash into the dictionary returned by get_user."""
+    return {
+        "id": user_data[b"id"].decode('utf-8'),
+        "email": user_data[b"email"].decode('utf-8'),
+        "display_name": user_data[b"display_name"].decode('utf-8'),
+        "created_at": user_data[b"created_at"].decode('utf-8'),
+        "password_hash": user_data[b"password_hash"].decode('utf-8'),
+        "encrypted_private_key": user_data[b"encrypted_private_key"].decode('utf-8'),
+        "token_epoch": int(user_data.get(b"token_epoch", 0))
+    }
+
+def public_user(user_data: dict, email: str) -> dict:
+    """Profile fields of a user looked up by email, or None if the index entry was stale."""
+    if user_data and user_data["email"] == email:
+        return {
+            "id": user_data["id"],
+            "email": user_data["email"],
+            "display_name": user_data["display_name"],
+            "created_at": user_data["created_at"]
+        }
+    return None
+
 def get_user(user_id):
     """Get user by ID."""
     user_data = REDIS_CLIENT.hgetall("user:" + user_id)
     if user_data:
-        return {
-            "id": user_data[b"id"].decode('utf-8'),
-            "email": user_data[b"email"].decode('utf-8'),
-            "display_name": user_data[b"display_name"].decode('utf-8'),
-            "created_at": user_data[b"created_at"].decode('utf-8'),
-            "password_hash": user_data[b"password_hash"].decode('utf-8'),
-            "encrypted_private_key": user_data[b"encrypted_private_key"].decode('utf-8')
-        }
+        return decode_user(user_data)
     return None
 
 def get_user_by_email(email):
     """Get user by email."""
-    users = REDIS_CLIENT.scan_iter("user:*")
-    for user in users:
-        user_data = REDIS_CLIENT.hgetall(user)
-        if user_data.get(b'email') and user_data[b'email'].decode('utf-8') == email:
-            return {
-                "id": user_data[b"id"].decode('utf-8'),
-                "email": user_data[b"email"].decode('utf-8'),
-                "display_name": user_data[b"display_name"].decode('utf-8'),
-                "created_at": user_data[b"created_at"].decode('utf-8')
-            }
-    return None
+    user_id = REDIS_CLIENT.get(email_key(email))
+    if user_id is None:
+        return None
+    return public_user(get_user(user_id.decode('utf-8')), email)
 
 def user_exists_by_email(email):
     """Check if a user exists by email."""
@@ -44,34 +73,40 @@ def user_exists_by_email(email):
 
 
 def create_user(email, password_hash, encrypted_private_key, display_name):
-    """Create a new user."""
+    """Create a new user, atomically claiming the email address first."""
     user_id = str(uuid.uuid4())
     created_at = datetime.now()
 
-    REDIS_CLIENT.hmset(
-        "user:" + user_id,
-        {
-            "id": user_id,
-            "email": email,
-            "password_hash": password_hash,
-            "encrypted_private_key": encrypted_private_key,
-            "display_name": display_name,
-            "created_at": created_at.isoformat()
-        }
-    )
+    # SET NX makes concurrent registrations of the same email race-free
+    if not REDIS_CLIENT.set(email_key(email), user_id, nx=True):
+        raise ValueError("Email already registered")
+
+    try:
+        REDIS_CLIENT.hset(
+            "user:" + user_id,
+            mapping={
+                "id": user_id,
+                "email": email,
+                "password_hash": password_hash,
+                "encrypted_private_key": encrypted_private_key,
+                "display_name": display_name,
+                "created_at": created_at.isoformat()
+            }
+        )
+    except Exception:
+        # Release the claim so the email can be registered again
+        REDIS_CLIENT.delete(email_key(email))
+        raise
     return user_id
 
 def save_user(email: str, password: str, display_name: str, private_key: str = None) -> dict:
     """Save a new user to the database."""
     
-    # Generate a unique ID for the user
-    user_id = str(uuid.uuid4())
-    
     # Generate a salt for the password
     salt = os.urandom(16)
     
     # Generate a key from the password
-    key = generate_key_from_password(password, salt)
+    key = derive_key(password, salt)
     
     # Use provided private key or generate a new one
     if private_key:
@@ -101,10 +136,42 @@ def save_user(email: str, password: str, display_name: str, private_key: str = N
     encrypted_password_b64 = base64.b64encode(encrypted_password).decode('utf-8')
     
     # Save user to database
-    create_user(email, encrypted_password_b64, encrypted_private_key_with_salt, display_name)
+    user_id = create_user(email, encrypted_password_b64, encrypted_private_key_with_salt, display_name)
     
     return {
         'id': user_id,
         'email': email,
         'display_name': display_name
     }
+
+def backfill_email_index(batch_size: int = 1000) -> dict:
+    """Index the email of every existing user, keeping the first claim on duplicates."""
+    indexed = 0
+    conflicts = []
+    keys = []
+
+    def flush():
+        nonlocal indexed
+        pipe = REDIS_CLIENT.pipeline()
+        for key in keys:
+            pipe.hmget(key, "id", "email")
+        records = [record for record in pipe.execute() if record[0] and record[1]]
+        for user_id, email in records:
+            pipe.set(email_key(email.decode('utf-8')), user_id, nx=True)
+        for (user_id, email), claimed in zip(records, pipe.execute()):
+            if claimed:
+                indexed += 1
+            elif REDIS_CLIENT.get(email_key(email.decode('utf-8'))) != user_id:
+                conflicts.append(email.decode('utf-8'))
+        keys.clear()
+
+    # User hashes are the only keys of the form user:{id}; everything else has more segments
+    for key in REDIS_CLIENT.scan_iter(match="user:*", count=batch_size):
+        if key.count(b":") == 1:
+            keys.append(key)
+        if len(keys) >= batch_size:
+            flush()
+    if keys:
+        flush()
+
+    return {"indexed": indexed, "conflicts": conflicts}
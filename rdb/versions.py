@@ -0,0 +1,50 @@
+from redis_client import REDIS_CLIENT
+
+# Every folder has a counter bumped by each change to what it lists, in the
+# same transaction as the change. Listings are tagged with the counters they
+# depend on, so a client polling an unchanged folder is answered from the
+# counters alone. Besides folders, 'root' counts changes at the top level,
+# 'all' changes anywhere in the user's tree and 'names' folder renames, which
+# show up in the folder, parent and path embedded in other folders' listings.
+ALL_VERSION = 'all'
+NAMES_VERSION = 'names'
+
+def version_key(user_id: str, folder_id: str = None) -> str:
+    """Redis counter of a folder's version, or of 'all' or 'names'."""
+    return f"user:{user_id}:version:{folder_id or 'root'}"
+
+def bump_versions(pipe, user_id: str, *folder_ids: str):
+    """Queue the increment of folder versions on a pipeline, along with the 'all' version."""
+    for folder_id in dict.fromkeys(folder_ids + (ALL_VERSION,)):
+        pipe.incr(version_key(user_id, None if folder_id == 'root' else folder_id))
+
+def queue_etag(pipe, user_id: str, folder_ids: list, exists_key: str = None):
+    """
+    Queue the reads behind a listing's ETag on a pipeline; pass its results to read_etag.
+    Args:
+        pipe: Pipeline to queue the reads on
+        user_id: Owner of the listing
+        folder_ids: Versions the listing depends on
+        exists_key: Key that must exist for the listing to be valid, if any
+    """
+    pipe.mget([version_key(user_id, folder_id) for folder_id in folder_ids])
+    if exists_key:
+        pipe.exists(exists_key)
+
+def read_etag(user_id: str, results: list):
+    """
+    The weak ETag value of a listing from the results of queue_etag, or None if it doesn't exist.
+    The owner's ID leads the value: counters of different users often match,
+    and a browser shared between accounts must not revalidate one user's
+    cached listing for another.
+    """
+    versions = results[0]
+    if len(results) > 1 and not results[1]:
+        return None
+    return user_id + '.' + '.'.join(str(int(version or 0)) for version in versions)
+
+def get_etag(user_id: str, folder_ids: list, exists_key: str = None):
+    """Read a listing's ETag value in one round trip, see queue_etag."""
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    queue_etag(pipe, user_id, folder_ids, exists_key)
+    return read_etag(user_id, pipe.execute())
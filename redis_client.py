@@ -1,3 +1,139 @@
+import os
+import asyncio
+import weakref
+import threading
 import redis
+import redis.asyncio
+from redis.backoff import ExponentialBackoff
+from redis.commands.core import Script
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+from redis.asyncio.retry import Retry as AsyncRetry
 
-REDIS_CLIENT = redis.Redis(host='127.0.0.1', port=6379, db=0)
+# Connection settings; redis_socket (a unix socket path) takes precedence over host and port
+REDIS_HOST = os.getenv('redis_host', '127.0.0.1')
+REDIS_PORT = int(os.getenv('redis_port', 6379))
+REDIS_SOCKET = os.getenv('redis_socket')
+REDIS_DB = int(os.getenv('redis_db', 0))
+REDIS_PASSWORD = os.getenv('redis_password')
+
+# Pool settings: at most redis_max_connections per process, and callers wait up
+# to redis_pool_timeout seconds for a free connection before failing
+REDIS_MAX_CONNECTIONS = int(os.getenv('redis_max_connections', 50))
+REDIS_POOL_TIMEOUT = float(os.getenv('redis_pool_timeout', 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('redis_socket_timeout', 5))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('redis_connect_timeout', 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('redis_health_check_interval', 30))
+REDIS_RETRIES = int(os.getenv('redis_retries', 3))
+REDIS_BACKOFF_BASE = float(os.getenv('redis_backoff_base', 0.01))
+REDIS_BACKOFF_CAP = float(os.getenv('redis_backoff_cap', 0.5))
+
+_lock = threading.Lock()
+_client = None
+_pid = None
+_async_clients = weakref.WeakKeyDictionary()
+
+def _pool_options(asynchronous: bool = False) -> dict:
+    module = redis.asyncio if asynchronous else redis
+    options = {
+        'db': REDIS_DB,
+        'password': REDIS_PASSWORD,
+        'max_connections': REDIS_MAX_CONNECTIONS,
+        'timeout': REDIS_POOL_TIMEOUT,
+        'socket_timeout': REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': REDIS_CONNECT_TIMEOUT,
+        'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+        'retry': (AsyncRetry if asynchronous else Retry)(
+            ExponentialBackoff(cap=REDIS_BACKOFF_CAP, base=REDIS_BACKOFF_BASE), REDIS_RETRIES
+        ),
+        'retry_on_error': [ConnectionError, TimeoutError],
+    }
+    if REDIS_SOCKET:
+        options['connection_class'] = module.UnixDomainSocketConnection
+        options['path'] = REDIS_SOCKET
+        # TCP only settings
+        options.pop('socket_connect_timeout')
+    else:
+        options['host'] = REDIS_HOST
+        options['port'] = REDIS_PORT
+    return options
+
+def create_pool() -> redis.BlockingConnectionPool:
+    """Build a connection pool from the environment settings."""
+    return redis.BlockingConnectionPool(**_pool_options())
+
+def create_async_pool() -> redis.asyncio.BlockingConnectionPool:
+    """Build an asyncio connection pool from the environment settings."""
+    return redis.asyncio.BlockingConnectionPool(**_pool_options(asynchronous=True))
+
+def get_redis() -> redis.Redis:
+    """Get this process's Redis client, creating it on first use."""
+    global _client, _pid
+    if _client is None or _pid != os.getpid():
+        with _lock:
+            if _client is None or _pid != os.getpid():
+                _client = redis.Redis(connection_pool=create_pool())
+                _pid = os.getpid()
+    return _client
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """
+    Get the asyncio Redis client of the running event loop.
+    Asyncio connections belong to the loop that opened them, so every loop
+    gets a client of its own, dropped together with the loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = redis.asyncio.Redis(connection_pool=create_async_pool())
+            _async_clients[loop] = client
+    return client
+
+def reset_redis():
+    """Drop the clients inherited from a parent process; the next call creates new ones."""
+    global _client, _pid, _lock, _async_clients
+    # The parent's sockets must not be closed or reused from the child, and the
+    # lock may have been held by a thread that doesn't exist here
+    _lock = threading.Lock()
+    _client = None
+    _pid = None
+    _async_clients = weakref.WeakKeyDictionary()
+
+def pool_stats() -> dict:
+    """Utilisation of this process's connection pool."""
+    if _client is None or _pid != os.getpid():
+        return {'max_connections': REDIS_MAX_CONNECTIONS, 'created': 0, 'idle': 0, 'in_use': 0}
+    pool = _client.connection_pool
+    # Unlocked snapshot of the pool internals, good enough for monitoring
+    if isinstance(pool, redis.BlockingConnectionPool):
+        created = len(pool._connections)
+        idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    else:
+        created = pool._created_connections
+        idle = len(pool._available_connections)
+    return {
+        'max_connections': pool.max_connections,
+        'created': created,
+        'idle': idle,
+        'in_use': created - idle
+    }
+
+class RedisProxy:
+    """
+    Stand-in for a redis.Redis client that forwards to the current process's client.
+    Modules keep importing REDIS_CLIENT at import time, while the actual
+    connections are only made on first use and re-created after a fork.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_redis(), name)
+
+    def register_script(self, script) -> Script:
+        # Bind scripts to the proxy so they follow the client across forks
+        return Script(self, script)
+
+REDIS_CLIENT = RedisProxy()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_redis)
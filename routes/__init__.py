@@ -5,6 +5,10 @@ from .list import list_bp
 from .folders import folders_bp
 from .auth import auth_bp
 from .user import user_bp
+from .metrics import metrics_bp
+from .uploads import uploads_bp
+from .search import search_bp
+from .files import files_bp
 # Create main blueprint
 api_bp = Blueprint('api', __name__)
 
@@ -14,4 +18,8 @@ api_bp.register_blueprint(decrypt_bp)
 api_bp.register_blueprint(list_bp)
 api_bp.register_blueprint(folders_bp)
 api_bp.register_blueprint(auth_bp) 
-api_bp.register_blueprint(user_bp)
\ No newline at end of file
+api_bp.register_blueprint(user_bp)
+api_bp.register_blueprint(metrics_bp)
+api_bp.register_blueprint(uploads_bp)
+api_bp.register_blueprint(search_bp)
+api_bp.register_blueprint(files_bp)
\ No newline at end of file
@@ -1,6 +1,6 @@
 from flask import Blueprint, request, jsonify, g
 from rdb.user import user_exists_by_email, get_user_by_email, get_user, save_user
-from crypto.keys import generate_key_from_password
+from crypto.kdf import derive_key, KdfBusy
 from crypto.token import create_jwt_token, verify_jwt_token
 import base64
 from cryptography.fernet import Fernet
@@ -12,6 +12,7 @@ class LoginError:
     EMAIL_ALREADY_REGISTERED = 'Email already registered'
     MISSING_REQUIRED_FIELD = 'Missing required field'
     SERVER_ERROR = 'Server error'
+    SERVER_BUSY = 'Server busy, try again shortly'
 
 @auth_bp.route('/register', methods=['POST'])
 def register():
@@ -44,6 +45,8 @@ def register():
         
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
+    except KdfBusy:
+        return jsonify({'error': LoginError.SERVER_BUSY}), 503, {'Retry-After': '1'}
     except Exception as e:
         print(f"Registration error: {str(e)}")  # Debug print
         return jsonify({'error': str(e)}), 500
@@ -82,7 +85,7 @@ def login():
             salt = salt_and_encrypted[:16]
             encrypted_private_key = salt_and_encrypted[16:]
             
-            key = generate_key_from_password(password, salt)
+            key = derive_key(password, salt)
             f = Fernet(key)
             private_key_bytes = f.decrypt(encrypted_private_key)
             
@@ -94,7 +97,8 @@ def login():
                     user_id=user_data['id'],
                     email=user_email,
                     display_name=user_data['display_name'],
-                    private_key=private_key_bytes.decode()  # Include private key in token
+                    private_key=private_key_bytes.decode(),  # Include private key in token
+                    token_epoch=user_data['token_epoch']
                 )
                 return jsonify({
                     'token': token,
@@ -104,6 +108,8 @@ def login():
                         'display_name': user_data['display_name']
                     }
                 })
+        except KdfBusy:
+            return jsonify({'error': LoginError.SERVER_BUSY}), 503, {'Retry-After': '1'}
         except Exception as e:
             print(f"Login error: {str(e)}")  # Debug print
             return jsonify({'error': LoginError.SERVER_ERROR}), 500
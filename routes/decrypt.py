@@ -1,9 +1,12 @@
-from flask import Blueprint, request, jsonify, g
-from database import get_file_by_id
+from flask import Blueprint, Response, request, jsonify, g
+from rdb.files import get_file_by_id
+from storage.content import iter_plaintext, read_plaintext
+from rdb.aio.files import get_file_by_id as get_file_by_id_async
+from utils.aio import to_thread
+from urllib.parse import quote
 import base64
 import traceback
 import os
-from cryptography.fernet import Fernet
 from crypto.token import require_jwt
 
 decrypt_bp = Blueprint('decrypt', __name__)
@@ -29,7 +32,7 @@ def decrypt():
                 
         # Get file from database
         file_id = data['id']
-        file = get_file_by_id(file_id)
+        file = get_file_by_id(file_id, g.user['user_id'])
         
         if not file:
             return jsonify({'error': 'File not found'}), 404
@@ -45,8 +48,7 @@ def decrypt():
             
         # Decrypt the content using the user's private key
         try:
-            f = Fernet(private_key.encode())
-            decrypted_content = f.decrypt(file['encrypted_content'])
+            decrypted_content = read_plaintext(file, private_key.encode())
         except Exception as e:
             return jsonify({'error': f'Decryption failed: {str(e)}'}), 400
         
@@ -61,7 +63,7 @@ def decrypt():
             'id': file['id'],
             'encrypted_filename': file['encrypted_filename'],
             'original_filename': file['original_filename'],
-            'file_size': file['file_size'],
+            'file_size': int(file['file_size']),
             'mime_type': file['mime_type'],
             'parent_id': file['parent_id'],
             'created_at': file['created_at']
@@ -83,7 +85,7 @@ def decrypt_by_id(file_id):
     try:
                 
         # Get file from database
-        file = get_file_by_id(file_id)
+        file = get_file_by_id(file_id, g.user['user_id'])
         
         if not file:
             return jsonify({'error': 'File not found'}), 404
@@ -99,8 +101,7 @@ def decrypt_by_id(file_id):
             
         # Decrypt the content using the user's private key
         try:
-            f = Fernet(private_key.encode())
-            decrypted_content = f.decrypt(file['encrypted_content'])
+            decrypted_content = read_plaintext(file, private_key.encode())
         except Exception as e:
             return jsonify({'error': f'Decryption failed: {str(e)}'}), 400
         
@@ -115,7 +116,7 @@ def decrypt_by_id(file_id):
             'id': file['id'],
             'encrypted_filename': file['encrypted_filename'],
             'original_filename': file['original_filename'],
-            'file_size': file['file_size'],
+            'file_size': int(file['file_size']),
             'mime_type': file['mime_type'],
             'parent_id': file['parent_id'],
             'created_at': file['created_at']
@@ -129,4 +130,68 @@ def decrypt_by_id(file_id):
     except Exception as e:
         print(f"Decryption error: {str(e)}")  # Debug print
         print(f"Traceback: {traceback.format_exc()}")  # Print full traceback
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@decrypt_bp.route('/files/<file_id>/content', methods=['GET'])
+@require_jwt
+async def content(file_id):
+    """Stream the decrypted bytes of a file, honouring single byte ranges."""
+    try:
+        file = await get_file_by_id_async(file_id, g.user['user_id'])
+        
+        if not file:
+            return jsonify({'error': 'File not found'}), 404
+            
+        # Check if the file belongs to the user
+        if file['user_id'] != g.user['user_id']:
+            return jsonify({'error': 'Unauthorized access to file'}), 403
+            
+        # Get the private key from the JWT token
+        private_key = g.user.get('private_key')
+        if not private_key:
+            return jsonify({'error': 'No private key found in token'}), 401
+        
+        # Resolve the requested byte range; multi-range requests get the whole file
+        size = int(file['file_size'])
+        start, stop = 0, size
+        status = 200
+        if request.range and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+            start, stop = byte_range
+            status = 206
+        
+        # Decrypt the first piece up front so a bad key or corrupt blob is still
+        # reported as an error instead of a truncated 200 response. Opening the
+        # blob is blocking disk I/O, kept off the event loop.
+        body = iter_plaintext(file, private_key.encode(), start, stop)
+        try:
+            first = await to_thread(next, body, b'')
+        except Exception as e:
+            return jsonify({'error': f'Decryption failed: {str(e)}'}), 400
+        
+        def generate():
+            yield first
+            yield from body
+        
+        headers = {
+            'Content-Length': str(stop - start),
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': f"inline; filename*=UTF-8''{quote(file['original_filename'])}"
+        }
+        if status == 206:
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        
+        return Response(
+            generate(),
+            status=status,
+            mimetype=file['mime_type'],
+            headers=headers,
+            direct_passthrough=True
+        )
+        
+    except Exception as e:
+        print(f"Download error: {str(e)}")  # Debug print
+        print(f"Traceback: {traceback.format_exc()}")  # Print full traceback
+        return jsonify({'error': str(e)}), 500
@@ -1,12 +1,55 @@
 from flask import Blueprint, request, jsonify, g
+import os
 import uuid
-from cryptography.fernet import Fernet
-from rdb.files import save_file
+from rdb.files import save_file, save_files
 import mimetypes
 from crypto.token import require_jwt
+from crypto.stream import EncryptedStream, UploadTooLarge
+from rdb.usage import QuotaExceeded
+from storage.dedup import DEDUP_ENABLED, ChunkedStream
+from crypto.compression import COMPRESSION_SAMPLE_SIZE, choose_compression
 
 encrypt_bp = Blueprint('encrypt', __name__)
 
+# Largest plaintext accepted by a single upload, in bytes (default 5 GiB)
+MAX_UPLOAD_SIZE = int(os.getenv('max_upload_size', 5 * 1024 ** 3))
+# Files accepted by one batch upload, and how many are encrypted at once
+BATCH_UPLOAD_MAX_FILES = int(os.getenv('batch_upload_max_files', 1000))
+BATCH_UPLOAD_WORKERS = int(os.getenv('batch_upload_workers', min(8, os.cpu_count() or 1)))
+
+def guess_mime_type(filename: str) -> str:
+    mime_type, _ = mimetypes.guess_type(filename)
+    return mime_type or 'application/octet-stream'
+
+def spooled_size(file) -> int:
+    """Size of an uploaded file; multipart files are spooled before the view runs, so it is exact."""
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    return size
+
+def build_encrypted_stream(file, key: bytes, user_id: str, mime_type: str, max_size: int):
+    """Stream encrypting an uploaded file the way it should be stored."""
+    if DEDUP_ENABLED:
+        # Only chunks the user hasn't stored yet are written
+        return ChunkedStream(file.stream, key, user_id, max_size=max_size)
+    # Compress before encrypting when the type and a sample of the file
+    # say it is worth it; the upload is spooled, so it can be rewound
+    compression = choose_compression(mime_type, file.stream.read(COMPRESSION_SAMPLE_SIZE))
+    file.stream.seek(0)
+    return EncryptedStream(file.stream, key, max_size=max_size, compression=compression)
+
+def file_response(file_data: dict) -> dict:
+    return {
+        'id': file_data['id'],
+        'encrypted_filename': file_data['encrypted_filename'],
+        'original_filename': file_data['original_filename'],
+        'file_size': file_data['file_size'],
+        'parent_id': file_data['parent_id'],
+        'created_at': file_data['created_at'],
+        'mime_type': file_data['mime_type']
+    }
+
 @encrypt_bp.route('/files/encrypt', methods=['POST'])
 @require_jwt
 def encrypt_file():
@@ -28,42 +71,94 @@ def encrypt_file():
         encrypted_filename = f"{uuid.uuid4()}.enc"
         
         # Determine MIME type
-        mime_type, _ = mimetypes.guess_type(original_filename)
-        if not mime_type:
-            mime_type = 'application/octet-stream'
-        
-        # Read the file content
-        file_content = file.read()
+        mime_type = guess_mime_type(original_filename)
         
         # Get the private key from the JWT token
         private_key = g.user.get('private_key')
         if not private_key:
             return jsonify({'error': 'No private key found in token'}), 401
             
-        # Encrypt the file content using the user's private key
-        f = Fernet(private_key.encode())
-        encrypted_content = f.encrypt(file_content)
+        # Encrypt the upload segment by segment while it is written to disk,
+        # so memory use stays bounded by the segment size. The file's spooled
+        # size is what gets reserved from the quota, even for chunked requests
+        # without a Content-Length.
+        max_size = spooled_size(file)
+        if max_size > MAX_UPLOAD_SIZE:
+            return jsonify({'error': f'File exceeds the maximum upload size of {MAX_UPLOAD_SIZE} bytes'}), 413
+        encrypted_content = build_encrypted_stream(file, private_key.encode(), g.user['user_id'], mime_type, max_size)
         
         # Save the encrypted file
         file_data = save_file(
             encrypted_filename=encrypted_filename,
             original_filename=original_filename,
             encrypted_content=encrypted_content,
-            file_size=len(file_content),
+            file_size=None,
             user_id=g.user['user_id'],
             parent_id=parent_id if parent_id else "",
             mime_type=mime_type
         )
         
-        return jsonify({
-            'id': file_data['id'],
-            'encrypted_filename': file_data['encrypted_filename'],
-            'original_filename': file_data['original_filename'],
-            'file_size': file_data['file_size'],
-            'parent_id': file_data['parent_id'],
-            'created_at': file_data['created_at'],
-            'mime_type': file_data['mime_type']
-        })
+        return jsonify(file_response(file_data))
         
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 507
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@encrypt_bp.route('/files/encrypt/batch', methods=['POST'])
+@require_jwt
+def encrypt_files():
+    """
+    Upload many files to one folder in a single request.
+    Files are sent as repeated `files` parts; the response lists a result for
+    each of them in order, either the saved file or its error.
+    """
+    try:
+        files = [file for file in request.files.getlist('files') if file.filename]
+        if not files:
+            return jsonify({'error': 'No file provided'}), 400
+        if len(files) > BATCH_UPLOAD_MAX_FILES:
+            return jsonify({'error': f'At most {BATCH_UPLOAD_MAX_FILES} files can be uploaded at once'}), 400
+
+        private_key = g.user.get('private_key')
+        if not private_key:
+            return jsonify({'error': 'No private key found in token'}), 401
+
+        results = [None] * len(files)
+        uploads = []
+        positions = []
+        for position, file in enumerate(files):
+            # Exact size of the spooled file, reserved from the quota
+            size = spooled_size(file)
+            if size > MAX_UPLOAD_SIZE:
+                results[position] = {
+                    'original_filename': file.filename,
+                    'error': f'File exceeds the maximum upload size of {MAX_UPLOAD_SIZE} bytes'
+                }
+                continue
+            mime_type = guess_mime_type(file.filename)
+            uploads.append({
+                'encrypted_filename': f"{uuid.uuid4()}.enc",
+                'original_filename': file.filename,
+                'mime_type': mime_type,
+                'max_size': size,
+                'encrypted_content': build_encrypted_stream(file, private_key.encode(), g.user['user_id'], mime_type, size)
+            })
+            positions.append(position)
+
+        if uploads:
+            saved = save_files(uploads, g.user['user_id'], request.form.get('parent_id') or "", BATCH_UPLOAD_WORKERS)
+            for position, upload, result in zip(positions, uploads, saved):
+                if isinstance(result, Exception):
+                    results[position] = {'original_filename': upload['original_filename'], 'error': str(result)}
+                else:
+                    results[position] = file_response(result)
+
+        return jsonify({'files': results})
+
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 507
     except Exception as e:
-        return jsonify({'error': str(e)}), 500 
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
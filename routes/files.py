@@ -0,0 +1,83 @@
+from flask import Blueprint, Response, request, jsonify, g, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+import io
+import os
+from rdb.files import get_file_by_id, rename_file
+from storage.files import locate_blob
+from storage.dedup import MANIFEST_MAGIC, is_manifest
+from crypto.token import require_jwt
+
+files_bp = Blueprint('files', __name__)
+
+@files_bp.route('/files/<file_id>', methods=['PATCH'])
+@require_jwt
+def rename_file_route(file_id):
+    """Rename a file."""
+    try:
+        data = request.get_json(silent=True) or {}
+        name = data.get('original_filename')
+        if not name or not isinstance(name, str):
+            return jsonify({'error': 'Missing required field: original_filename'}), 400
+        
+        file_data = rename_file(file_id, g.user['user_id'], name)
+        if not file_data:
+            return jsonify({'error': 'File not found'}), 404
+        
+        return jsonify(file_data)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@files_bp.route('/files/<file_id>/blob', methods=['GET'])
+@require_jwt
+def blob(file_id):
+    """
+    Serve a file's stored ciphertext unchanged, for clients that decrypt it themselves.
+    Blobs in a file of their own are handed to the server as a path, so full
+    downloads go out with sendfile and Python never touches the bytes; single
+    byte ranges and conditional requests are supported. Blobs never change
+    under their file ID, so the ID is a strong ETag.
+    """
+    try:
+        file = get_file_by_id(file_id, g.user['user_id'])
+        if not file:
+            return jsonify({'error': 'File not found'}), 404
+        
+        headers = {'X-Plaintext-Size': str(file['file_size'])}
+        if file.get('compression'):
+            # The plaintext was compressed with this codec before it was encrypted
+            headers['X-Blob-Compression'] = file['compression']
+        
+        # A blob in its own file may be moved by the migrator between finding
+        # it and opening it; looking it up again finds its new place
+        for attempt in range(2):
+            path, data = locate_blob(file_id)
+            if path is None and data is None:
+                return jsonify({'error': 'Encrypted content not found'}), 404
+            try:
+                if path is not None:
+                    with open(path, 'rb') as f:
+                        head = f.read(len(MANIFEST_MAGIC))
+                else:
+                    head = data[:len(MANIFEST_MAGIC)]
+                # Deduplicated files are a manifest of chunks under their own keys
+                if is_manifest(head):
+                    return jsonify({'error': 'File is stored as deduplicated chunks, download it from /files/<id>/content'}), 409
+                
+                response = send_file(
+                    os.path.abspath(path) if path is not None else io.BytesIO(data),
+                    mimetype='application/octet-stream',
+                    conditional=True,
+                    etag=file_id
+                )
+                response.headers.update(headers)
+                return response
+            except FileNotFoundError:
+                if attempt:
+                    raise
+        
+    except RequestedRangeNotSatisfiable as e:
+        return Response(status=416, headers={'Content-Range': f'bytes */{e.length}'})
+    except Exception as e:
+        print(f"Blob download error: {str(e)}")  # Debug print
+        return jsonify({'error': str(e)}), 500
@@ -1,6 +1,16 @@
-from flask import Blueprint, request, jsonify, g
-from rdb.files import list_files, list_all_files
-from rdb.folders import get_folder, list_folders, create_folder
+from flask import Blueprint, Response, request, jsonify, g
+from urllib.parse import quote
+from rdb.files import list_all_files
+from rdb.folders import get_folder, list_folders, create_folder, rename_folder
+from rdb.aio.contents import get_folder_contents
+from rdb.aio.folders import get_folder_path
+from rdb.aio.versions import get_etag
+from rdb.folders import folder_key
+from rdb.versions import NAMES_VERSION
+from utils.http import tag_listing, not_modified
+from rdb.trash import detach_folder
+from storage.archive import iter_archive
+from storage.reaper import REAPER
 from crypto.token import require_jwt
 
 folders_bp = Blueprint('folders', __name__)
@@ -73,75 +83,131 @@ def get_folder_route(folder_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@folders_bp.route('/folders/<folder_id>', methods=['PATCH'])
+@require_jwt
+def rename_folder_route(folder_id):
+    try:
+        data = request.get_json(silent=True) or {}
+        name = data.get('name')
+        if not name or not isinstance(name, str):
+            return jsonify({'error': FolderError.MISSING_REQUIRED_FIELD}), 400
+        
+        folder = rename_folder(folder_id, g.user['user_id'], name)
+        if not folder:
+            return jsonify({'error': FolderError.FOLDER_NOT_FOUND}), 404
+        
+        return jsonify(folder)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @folders_bp.route('/folders/<folder_id>/contents', methods=['GET'])
 @require_jwt
-def list_contents(folder_id):
+async def list_contents(folder_id):
     try:
+        # Pagination parameters; without a limit the whole folder is returned
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        order = request.args.get('order', 'name')
+        # Breadcrumb from the top level down to this folder, in the same round trip
+        include_path = request.args.get('include_path', '').lower() in ('1', 'true')
+        user_id = g.user['user_id']
+        
+        # Polls of an unchanged folder are answered from its version counters
+        # alone; renamed folders may appear as its parent or in its path
+        if folder_id == '0':
+            etag = await get_etag(user_id, [None, NAMES_VERSION])
+        else:
+            etag = await get_etag(user_id, [folder_id, NAMES_VERSION], folder_key(user_id, folder_id))
+            if etag is None:
+                return jsonify({'error': 'Folder not found'}), 404
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        
         # Handle root folder (folder_id = 0)
         if folder_id == '0':
-            return jsonify({
-                'folder': {
-                    'id': '0',
-                    'name': 'root',
-                    'parent_id': None,
-                    'created_at': None,
-                    'user_id': g.user['user_id']
-                },
-                'parent': None,
-                'files': list_files(user_id=g.user['user_id']),
-                'folders': list_folders(None, user_id=g.user['user_id'])
-            })
+            contents = await get_folder_contents(None, user_id, limit, cursor, order, include_path)
+            contents['folder'] = {
+                'id': '0',
+                'name': 'root',
+                'parent_id': None,
+                'created_at': None,
+                'user_id': user_id
+            }
+            return tag_listing(jsonify(contents), etag)
             
-        # Get folder details
-        folder = get_folder(folder_id, g.user['user_id'])
-        if not folder:
+        # Get folder, parent, files and folders in a constant number of round trips
+        contents = await get_folder_contents(folder_id, user_id, limit, cursor, order, include_path)
+        if not contents:
             return jsonify({'error': 'Folder not found'}), 404
-            
-        # Get parent folder if exists
-        parent = None
-        if folder['parent_id']:
-            parent = get_folder(folder['parent_id'], g.user['user_id'])
-            
-        # Get files and folders in this folder for the current user
-        files = list_files(parent_id=folder_id, user_id=g.user['user_id'])
-        folders = list_folders(parent_id=folder_id, user_id=g.user['user_id'])
         
-        return jsonify({
-            'folder': folder,
-            'parent': parent,
-            'files': files,
-            'folders': folders
-        })
+        return tag_listing(jsonify(contents), etag)
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@folders_bp.route('/folders/<folder_id>', methods=['DELETE'])
+@folders_bp.route('/folders/<folder_id>/path', methods=['GET'])
 @require_jwt
-def delete_folder(folder_id):
+async def folder_path(folder_id):
+    """List the folders from the top level down to this one, for breadcrumbs."""
     try:
-        folder = get_folder(folder_id)
-        if not folder:
-            return jsonify({'error': 'Folder not found'}), 404
+        # The root folder has no ancestors
+        if folder_id == '0':
+            return jsonify({'path': []})
         
-        # Check if the folder belongs to the user
-        if folder['user_id'] != g.user['user_id']:
-            return jsonify({'error': FolderError.UNAUTHORIZED_ACCESS}), 403
+        path = await get_folder_path(folder_id, g.user['user_id'])
+        if not path:
+            return jsonify({'error': FolderError.FOLDER_NOT_FOUND}), 404
+        
+        return jsonify({'path': path})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@folders_bp.route('/folders/<folder_id>/archive', methods=['GET'])
+@require_jwt
+def archive_folder(folder_id):
+    """Stream a ZIP of a folder and everything below it, decrypted."""
+    try:
+        user_id = g.user['user_id']
+        private_key = g.user.get('private_key')
+        if not private_key:
+            return jsonify({'error': 'No private key found in token'}), 401
         
-        def delete_folder_contents(folder_id):
-            """Delete all files and folders in the given folder."""
-            files = list_files(parent_id=folder_id)
-            folders = list_folders(parent_id=folder_id)
-            for file in files:
-                delete_file(file['id'])
-            for folder in folders:
-                delete_folder_contents(folder['id'])
-                delete_folder(folder['id'])
+        # Handle root folder (folder_id = 0)
+        if folder_id == '0':
+            folder_id, name = None, 'root'
+        else:
+            folder = get_folder(folder_id, user_id)
+            if not folder:
+                return jsonify({'error': FolderError.FOLDER_NOT_FOUND}), 404
+            name = folder['name']
+        
+        # No Content-Length: the archive is built while it is sent
+        return Response(
+            iter_archive(folder_id, user_id, private_key.encode()),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name + '.zip')}"},
+            direct_passthrough=True
+        )
         
-        delete_folder_contents(folder_id)
-        delete_file(folder_id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@folders_bp.route('/folders/<folder_id>', methods=['DELETE'])
+@require_jwt
+def delete_folder_route(folder_id):
+    """Delete a folder and everything below it; blobs are removed in the background."""
+    try:
+        deleted = detach_folder(folder_id, g.user['user_id'])
+        if not deleted:
+            return jsonify({'error': FolderError.FOLDER_NOT_FOUND}), 404
         
+        REAPER.wake()
         return '', 204
         
     except Exception as e:
@@ -154,7 +220,7 @@ def delete_folder(folder_id):
 def debug_files():
     """Debug endpoint to list all files with their user_ids."""
     try:
-        files = list_all_files()
+        files = list_all_files(g.user['user_id'])
         return jsonify({
             'files': files,
             'current_user_id': g.user['user_id']
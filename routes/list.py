@@ -1,12 +1,17 @@
 from flask import Blueprint, request, jsonify, g
-from database import list_files
+from rdb.aio.files import page_files
+from rdb.aio.contents import search_names
+from rdb.search import FILE_KIND, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT
+from rdb.aio.versions import get_etag
+from rdb.versions import ALL_VERSION
+from utils.http import tag_listing, not_modified
 from crypto.token import require_jwt
 
 list_bp = Blueprint('list', __name__)
 
 @list_bp.route('/files/list', methods=['GET', 'OPTIONS'])
 @require_jwt
-def list():
+async def list():
     if request.method == 'OPTIONS':
         return '', 204
         
@@ -14,20 +19,48 @@ def list():
         # Get query parameters
         search_term = request.args.get('search', '')
         limit = request.args.get('limit', type=int)
-        offset = request.args.get('offset', type=int)
-        parent_id = request.args.get('parent_id')
+        cursor = request.args.get('cursor')
+        # Without a parent folder every file of the user is listed
+        parent_id = request.args.get('parent_id', 'all')
         
-        # Get files from database for current user
-        result = list_files(
-            search_term=search_term,
-            limit=limit,
-            offset=offset,
+        # Polls of an unchanged listing are answered from a version counter alone
+        version = ALL_VERSION if parent_id == 'all' else parent_id
+        etag = await get_etag(g.user['user_id'], [version])
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        
+        # Searching every file matches anywhere in the name, best matches first.
+        # Pages hold at most SEARCH_MAX_LIMIT files and the cursor leads to
+        # the next one. An explicit order keeps the ordered prefix match below.
+        order = request.args.get('order')
+        if search_term.strip() and parent_id == 'all' and order is None:
+            limit = min(limit or SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT)
+            results = await search_names(g.user['user_id'], search_term.strip(), limit, FILE_KIND, cursor)
+            return tag_listing(jsonify({
+                'files': results['files'],
+                'next_cursor': results['next_cursor']
+            }), etag)
+        
+        # Within a folder, filename search is a prefix match on the name index
+        order = order or ('name' if search_term else 'created')
+        
+        # Get one page of files from database for current user
+        files, next_cursor = await page_files(
             parent_id=parent_id,
-            user_id=g.user['user_id']  # Add current user's ID
+            user_id=g.user['user_id'],  # Add current user's ID
+            limit=limit,
+            cursor=cursor,
+            order=order,
+            search=search_term
         )
         
-        return jsonify(result)
+        return tag_listing(jsonify({
+            'files': files,
+            'next_cursor': next_cursor
+        }), etag)
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"List error: {str(e)}")  # Debug print
-        return jsonify({'error': str(e)}), 500 
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,34 @@
+import os
+from flask import Blueprint, jsonify, g
+from crypto.auth_cache import VERIFIED_USERS
+from crypto.kdf import kdf_stats
+from redis_client import pool_stats
+from storage.packs import SEGMENT_READER
+from storage.durability import GROUP_COMMIT
+from storage.reaper import REAPER
+from storage.cache import BLOB_CACHE
+from utils.aio import IO_LOOP
+from crypto.token import require_jwt
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Comma-separated IDs of the users allowed to read the metrics; nobody by default
+METRICS_USERS = {user_id.strip() for user_id in os.getenv('metrics_users', '').split(',') if user_id.strip()}
+
+@metrics_bp.route('/metrics', methods=['GET'])
+@require_jwt
+def metrics():
+    """Per-worker counters used to size caches and pools, for operators only."""
+    if g.user['user_id'] not in METRICS_USERS:
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({
+        'pid': os.getpid(),
+        'auth_cache': VERIFIED_USERS.stats(),
+        'kdf_pool': kdf_stats(),
+        'redis_pool': pool_stats(),
+        'pack_reader': SEGMENT_READER.stats(),
+        'group_commit': GROUP_COMMIT.stats(),
+        'reaper': REAPER.stats(),
+        'blob_cache': BLOB_CACHE.stats(),
+        'event_loop': IO_LOOP.stats()
+    })
@@ -0,0 +1,41 @@
+from flask import Blueprint, request, jsonify, g
+from rdb.aio.contents import search_names
+from rdb.search import FILE_KIND, FOLDER_KIND, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT
+from crypto.token import require_jwt
+
+search_bp = Blueprint('search', __name__)
+
+SEARCH_TYPES = {
+    'all': '',
+    'files': FILE_KIND,
+    'folders': FOLDER_KIND,
+}
+
+@search_bp.route('/search', methods=['GET'])
+@require_jwt
+async def search():
+    """
+    Find files and folders anywhere in the user's tree by part of their name.
+    Returns at most `limit` matches, capped at SEARCH_MAX_LIMIT, and a
+    next_cursor for the following page.
+    """
+    try:
+        term = request.args.get('q', '').strip()
+        limit = request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int)
+        search_type = request.args.get('type', 'all')
+        cursor = request.args.get('cursor')
+        if not term:
+            return jsonify({'error': 'Missing required parameter: q'}), 400
+        if search_type not in SEARCH_TYPES:
+            return jsonify({'error': f'Invalid type: {search_type}'}), 400
+        if limit < 1:
+            return jsonify({'error': 'Limit must be a positive number'}), 400
+        
+        results = await search_names(g.user['user_id'], term, min(limit, SEARCH_MAX_LIMIT), SEARCH_TYPES[search_type], cursor)
+        return jsonify(results)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Search error: {str(e)}")  # Debug print
+        return jsonify({'error': str(e)}), 500
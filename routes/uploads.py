@@ -0,0 +1,199 @@
+from flask import Blueprint, request, jsonify, g
+import os
+import uuid
+import mimetypes
+from crypto.token import require_jwt
+from crypto.stream import SEGMENT_SIZE, encrypt_part, stream_header
+from rdb.files import save_file
+from rdb.folders import get_folder
+from rdb.usage import QuotaExceeded, release_storage
+from rdb.uploads import (
+    create_upload_session, get_upload_session, touch_upload_session,
+    lock_upload_session, unlock_upload_session, close_upload_session
+)
+from storage.uploads import save_part, iter_parts, delete_parts
+from storage.reaper import REAPER
+from routes.encrypt import MAX_UPLOAD_SIZE
+
+uploads_bp = Blueprint('uploads', __name__)
+
+# Plaintext bytes per chunk of an upload session, a whole number of segments
+UPLOAD_CHUNK_SIZE = max(1, int(os.getenv('upload_chunk_size', 8 * 1024 * 1024)) // SEGMENT_SIZE) * SEGMENT_SIZE
+
+def session_response(session: dict) -> dict:
+    return {
+        'id': session['id'],
+        'filename': session['filename'],
+        'size': int(session['size']),
+        'chunk_size': int(session['chunk_size']),
+        'chunk_count': int(session['chunk_count']),
+        'received': session.get('received', []),
+        'expires_in': session.get('expires_in')
+    }
+
+@uploads_bp.route('/uploads', methods=['POST'])
+@require_jwt
+def create_upload():
+    """Open a resumable upload session for a file of known size."""
+    try:
+        data = request.get_json(silent=True) or {}
+        filename = data.get('filename')
+        size = data.get('size')
+        parent_id = data.get('parent_id') or ''
+        if not filename:
+            return jsonify({'error': 'Missing required field: filename'}), 400
+        if not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'size must be a non-negative integer'}), 400
+        if size > MAX_UPLOAD_SIZE:
+            return jsonify({'error': f'File exceeds the maximum upload size of {MAX_UPLOAD_SIZE} bytes'}), 413
+        if parent_id and not get_folder(parent_id, g.user['user_id']):
+            return jsonify({'error': 'Folder not found'}), 404
+
+        mime_type, _ = mimetypes.guess_type(filename)
+
+        # Sessions abandoned by other clients are collected in the background
+        REAPER.start()
+
+        session = create_upload_session(
+            g.user['user_id'],
+            filename,
+            size,
+            UPLOAD_CHUNK_SIZE,
+            SEGMENT_SIZE,
+            parent_id,
+            mime_type or 'application/octet-stream',
+            os.urandom(16)
+        )
+        return jsonify(session_response(session)), 201
+
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 507
+    except Exception as e:
+        print(f"Upload session error: {str(e)}")  # Debug print
+        return jsonify({'error': str(e)}), 500
+
+@uploads_bp.route('/uploads/<session_id>', methods=['GET'])
+@require_jwt
+def upload_status(session_id):
+    """Report which chunks of a session have been stored."""
+    session = get_upload_session(g.user['user_id'], session_id)
+    if not session:
+        return jsonify({'error': 'Upload session not found'}), 404
+    return jsonify(session_response(session))
+
+@uploads_bp.route('/uploads/<session_id>/chunks/<int:index>', methods=['PUT'])
+@require_jwt
+def upload_chunk(session_id, index):
+    """
+    Encrypt and store one chunk, sent as the raw request body.
+    Chunks may arrive in any order and in parallel; sending a chunk again
+    replaces it.
+    """
+    try:
+        user_id = g.user['user_id']
+        session = get_upload_session(user_id, session_id)
+        if not session:
+            return jsonify({'error': 'Upload session not found'}), 404
+        if session.get('locked'):
+            return jsonify({'error': 'Upload is being committed'}), 409
+        if index < 0 or index >= session['chunk_count']:
+            return jsonify({'error': 'Chunk number out of range'}), 400
+
+        private_key = g.user.get('private_key')
+        if not private_key:
+            return jsonify({'error': 'No private key found in token'}), 401
+
+        chunk_size = session['chunk_size']
+        expected = min(chunk_size, session['size'] - index * chunk_size)
+        # Checked before reading, so a wrong-sized body is never buffered.
+        # Clients may leave out the length of an empty body.
+        if request.content_length is None and expected:
+            return jsonify({'error': 'Content-Length is required'}), 411
+        if (request.content_length or 0) != expected:
+            return jsonify({'error': f'Chunk {index} must be {expected} bytes, got {request.content_length}'}), 400
+        data = request.stream.read(expected + 1)
+        if len(data) != expected:
+            return jsonify({'error': f'Chunk {index} must be {expected} bytes, got {len(data)}'}), 400
+
+        # Each chunk is a run of segments of the final blob, so it can be
+        # encrypted now and the parts only need concatenating on commit
+        final = index == session['chunk_count'] - 1
+        encrypted_part = encrypt_part(
+            private_key.encode(),
+            bytes.fromhex(session['salt']),
+            data,
+            index * chunk_size // session['segment_size'],
+            final,
+            session['segment_size']
+        )
+        save_part(session_id, index, encrypted_part)
+        touch_upload_session(user_id, session_id, session['size'], index)
+
+        return jsonify({'index': index, 'size': len(data)})
+
+    except Exception as e:
+        print(f"Upload chunk error: {str(e)}")  # Debug print
+        return jsonify({'error': str(e)}), 500
+
+@uploads_bp.route('/uploads/<session_id>/commit', methods=['POST'])
+@require_jwt
+def commit_upload(session_id):
+    """Assemble the stored chunks into a file once all of them have arrived."""
+    user_id = g.user['user_id']
+    session = get_upload_session(user_id, session_id)
+    if not session:
+        return jsonify({'error': 'Upload session not found'}), 404
+    missing = sorted(set(range(session['chunk_count'])) - set(session['received']))
+    if missing:
+        return jsonify({'error': 'Upload is incomplete', 'missing': missing}), 409
+    if not lock_upload_session(user_id, session_id):
+        return jsonify({'error': 'Upload is already being committed'}), 409
+
+    try:
+        # Keep the session alive for as long as the commit takes
+        touch_upload_session(user_id, session_id, session['size'])
+        header = stream_header(session['segment_size'], bytes.fromhex(session['salt']))
+        # The quota was reserved when the session was opened
+        file_data = save_file(
+            encrypted_filename=f"{uuid.uuid4()}.enc",
+            original_filename=session['filename'],
+            encrypted_content=iter_parts(session_id, session['chunk_count'], header),
+            file_size=session['size'],
+            user_id=user_id,
+            parent_id=session['parent_id'],
+            mime_type=session['mime_type'],
+            quota_reserved=True
+        )
+        if not file_data:
+            raise Exception('Could not save file metadata')
+    except Exception as e:
+        print(f"Upload commit error: {str(e)}")  # Debug print
+        unlock_upload_session(user_id, session_id)
+        return jsonify({'error': str(e)}), 500
+
+    close_upload_session(user_id, session_id, session['size'])
+    delete_parts(session_id)
+    return jsonify({
+        'id': file_data['id'],
+        'encrypted_filename': file_data['encrypted_filename'],
+        'original_filename': file_data['original_filename'],
+        'file_size': file_data['file_size'],
+        'parent_id': file_data['parent_id'],
+        'created_at': file_data['created_at'],
+        'mime_type': file_data['mime_type']
+    })
+
+@uploads_bp.route('/uploads/<session_id>', methods=['DELETE'])
+@require_jwt
+def abort_upload(session_id):
+    """Abandon a session, deleting its chunks and giving back its quota."""
+    user_id = g.user['user_id']
+    session = get_upload_session(user_id, session_id)
+    if not session:
+        return jsonify({'error': 'Upload session not found'}), 404
+    if not lock_upload_session(user_id, session_id):
+        return jsonify({'error': 'Upload is being committed'}), 409
+    close_upload_session(user_id, session_id, session['size'])
+    delete_parts(session_id)
+    release_storage(user_id, session['size'])
+    return '', 204
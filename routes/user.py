@@ -1,8 +1,8 @@
 from flask import Blueprint, request, jsonify, g
-from rdb.files import count_user_filesize
+from rdb.usage import get_storage_usage, STORAGE_LIMIT
 from crypto.token import require_jwt
-from rdb.user import get_user
-import os
+from crypto.auth_cache import VERIFIED_USERS
+from rdb.user import get_user, revoke_user_tokens
 
 user_bp = Blueprint('user', __name__)
 
@@ -23,10 +23,23 @@ def me():
             'email': user['email'],
             'display_name': user['display_name'],
             'storage': {
-                'allocated': count_user_filesize(user['id']),
-                'available': os.getenv('total_storage', 107374182400),
+                'allocated': get_storage_usage(user['id']),
+                'available': STORAGE_LIMIT,
             }
         })
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({'error': 'Internal error'}), 500
+
+@user_bp.route('/user/revoke-tokens', methods=['POST'])
+@require_jwt
+def revoke_tokens():
+    """Sign the user out everywhere by invalidating all of their tokens."""
+    try:
+        revoke_user_tokens(g.user['user_id'])
+        # Other workers are told over pub/sub; don't wait for it in this one
+        VERIFIED_USERS.invalidate(g.user['user_id'])
+        return '', 204
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': 'Internal error'}), 500
@@ -0,0 +1,87 @@
+import os
+import multiprocessing
+from gunicorn.app.base import BaseApplication
+
+# Worker settings, all overridable from the environment
+SERVER_BIND = os.getenv('server_bind', '0.0.0.0:8080')
+# sync: one request per process; gthread: a thread pool per process.
+# Green thread workers (gevent, eventlet) are not supported: the preloaded app
+# imports redis and starts threads before they could monkey-patch anything.
+SERVER_WORKER_CLASS = os.getenv('server_worker_class', 'gthread')
+SERVER_WORKERS = int(os.getenv('server_workers', multiprocessing.cpu_count() * 2 + 1))
+# Every request holds one of these threads until its response is sent, async
+# views included, so this bounds the slow clients a worker serves at once
+SERVER_THREADS = int(os.getenv('server_threads', 8))
+# Recycle workers after this many requests, with jitter so they don't all restart at once
+SERVER_MAX_REQUESTS = int(os.getenv('server_max_requests', 10000))
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv('server_max_requests_jitter', 1000))
+SERVER_TIMEOUT = int(os.getenv('server_timeout', 120))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv('server_graceful_timeout', 30))
+SERVER_KEEPALIVE = int(os.getenv('server_keepalive', 5))
+
+# Every worker starts its own key derivation pool, so share the cores out
+# between them rather than giving each worker one process per core. Set
+# before the app is imported, which reads it.
+os.environ.setdefault('kdf_workers', str(max(1, multiprocessing.cpu_count() // SERVER_WORKERS)))
+
+def on_starting(server):
+    """Runs once in the master before any worker is forked."""
+    from database import init_db
+    init_db()
+
+def post_fork(server, worker):
+    """
+    Give every worker its own connections, pools and threads.
+    The app is preloaded in the master, so workers inherit its module state.
+    Sockets, locks and background threads must not be shared across processes.
+    """
+    from redis_client import reset_redis
+    from crypto.kdf import reset_kdf_pool
+    from crypto.auth_cache import VERIFIED_USERS
+    from storage.reaper import REAPER
+    reset_redis()
+    reset_kdf_pool()
+    VERIFIED_USERS.reset()
+    # Expired upload sessions and leftover trash are collected even when
+    # nothing in this worker deletes a folder or opens a session
+    REAPER.start()
+    server.log.info(f"Worker {worker.pid} ready")
+
+class Server(BaseApplication):
+    """Gunicorn running the preloaded Flask app with the settings above."""
+
+    def __init__(self, options: dict = None):
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key.lower(), value)
+
+    def load(self):
+        from main import app
+        return app
+
+def server_options() -> dict:
+    """Gunicorn settings taken from the environment."""
+    return {
+        'bind': SERVER_BIND,
+        'worker_class': SERVER_WORKER_CLASS,
+        'workers': SERVER_WORKERS,
+        'threads': SERVER_THREADS,
+        'max_requests': SERVER_MAX_REQUESTS,
+        'max_requests_jitter': SERVER_MAX_REQUESTS_JITTER,
+        'timeout': SERVER_TIMEOUT,
+        'graceful_timeout': SERVER_GRACEFUL_TIMEOUT,
+        'keepalive': SERVER_KEEPALIVE,
+        # Import the app and load the signing key once in the master; workers
+        # are forked with it already in memory. SIGHUP gracefully replaces the
+        # workers with the same preloaded code; deploy new code with USR2.
+        'preload_app': True,
+        'on_starting': on_starting,
+        'post_fork': post_fork,
+    }
+
+if __name__ == '__main__':
+    Server(server_options()).run()
@@ -0,0 +1,189 @@
+import os
+import queue
+import threading
+import zipfile
+from datetime import datetime
+from rdb.files import page_files
+from rdb.folders import page_folders
+from storage.content import iter_plaintext
+
+# Entries listed per round trip while walking a folder tree
+ARCHIVE_PAGE_SIZE = int(os.getenv('archive_page_size', 500))
+# Decrypted pieces buffered ahead of the ZIP writer; bounds the memory used
+# by an archive download whatever the size of the tree
+ARCHIVE_READ_AHEAD = int(os.getenv('archive_read_ahead', 16))
+# stored: no compression, the cheapest and fastest; deflated: smaller archives
+ARCHIVE_COMPRESSION = os.getenv('archive_compression', 'stored')
+
+COMPRESSION_METHODS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+}
+
+# Seconds between checks that the download is still wanted while the queue is full
+_PUT_TIMEOUT = 1.0
+
+def _safe_name(name: str) -> str:
+    """A file or folder name usable as one component of a ZIP path."""
+    name = (name or '').replace('/', '_').replace('\\', '_').strip()
+    if name in ('', '.', '..'):
+        return '_'
+    return name
+
+def _unique_name(name: str, used: set) -> str:
+    """`name`, or `name (n).ext` if a sibling already took it."""
+    candidate = name
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while candidate.lower() in used:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    used.add(candidate.lower())
+    return candidate
+
+def _date_time(created_at: str) -> tuple:
+    try:
+        stamp = datetime.fromisoformat(created_at)
+    except (TypeError, ValueError):
+        stamp = datetime.now()
+    # ZIP timestamps can't go before 1980
+    return max(stamp, datetime(1980, 1, 1)).timetuple()[:6]
+
+def walk_tree(folder_id: str, user_id: str, page_size: int = ARCHIVE_PAGE_SIZE):
+    """
+    Yield ('folder', path, folder) and ('file', path, file) for everything below a folder.
+    Args:
+        folder_id: Folder to walk, None for the root folder
+        user_id: Owner of the tree
+        page_size: Entries loaded per round trip
+    Paths are relative to the folder, use '/' and are unique among siblings.
+    Folders are walked depth first and listed a page at a time, so only the
+    folders still to visit are held in memory.
+    """
+    stack = [(folder_id, '')]
+    while stack:
+        parent_id, prefix = stack.pop()
+        used = set()
+        subfolders = []
+        cursor = None
+        while True:
+            folders, cursor = page_folders(parent_id, user_id, page_size, cursor, 'name')
+            for folder in folders:
+                path = prefix + _unique_name(_safe_name(folder['name']), used)
+                yield 'folder', path, folder
+                subfolders.append((folder['id'], path + '/'))
+            if not cursor:
+                break
+        while True:
+            files, cursor = page_files(parent_id, user_id, page_size, cursor, 'name')
+            for file in files:
+                yield 'file', prefix + _unique_name(_safe_name(file['original_filename']), used), file
+            if not cursor:
+                break
+        # Reversed so subfolders are visited in name order
+        stack.extend(reversed(subfolders))
+
+class _Sink:
+    """Write-only, unseekable file object collecting what ZipFile writes."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def _read_ahead(folder_id: str, user_id: str, key: bytes, pieces: queue.Queue, stopped: threading.Event):
+    """Walk the tree and decrypt its files into `pieces`, until done or stopped."""
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                pieces.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for kind, path, entry in walk_tree(folder_id, user_id):
+            if not put((kind, path, entry)):
+                return
+            if kind == 'file':
+                for data in iter_plaintext(entry, key):
+                    if not put(('data', None, data)):
+                        return
+        put(('end', None, None))
+    except Exception as e:
+        put(('error', None, e))
+
+def iter_archive(folder_id: str, user_id: str, key: bytes, compression: str = ARCHIVE_COMPRESSION):
+    """
+    Yield a ZIP archive of the decrypted tree below a folder, as it is built.
+    Args:
+        folder_id: Folder to archive, None for the root folder
+        user_id: Owner of the tree
+        key: User's Fernet key in bytes
+        compression: 'stored' or 'deflated'
+    A background thread walks the tree and decrypts files into a bounded queue
+    while the archive is written, so reading, decrypting and sending overlap.
+    Entries carry data descriptors and ZIP64 records where needed, so no
+    size has to be known up front and nothing is seeked back to. Apart from
+    the central directory, which the format puts at the end, memory use does
+    not grow with the tree. Errors after the first byte can only cut the
+    download short.
+    """
+    method = COMPRESSION_METHODS[compression]
+    pieces = queue.Queue(maxsize=ARCHIVE_READ_AHEAD)
+    stopped = threading.Event()
+    reader = threading.Thread(
+        target=_read_ahead,
+        args=(folder_id, user_id, key, pieces, stopped),
+        name='archive-read-ahead',
+        daemon=True
+    )
+    reader.start()
+
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, 'w', compression=method, allowZip64=True)
+    try:
+        dest = None
+        while True:
+            kind, path, item = pieces.get()
+            if kind == 'data':
+                dest.write(item)
+            else:
+                if dest is not None:
+                    dest.close()
+                    dest = None
+                if kind == 'folder':
+                    info = zipfile.ZipInfo(path + '/', _date_time(item.get('created_at')))
+                    info.external_attr = 0o40755 << 16 | 0x10
+                    archive.writestr(info, b'')
+                elif kind == 'file':
+                    info = zipfile.ZipInfo(path, _date_time(item.get('created_at')))
+                    info.compress_type = method
+                    info.external_attr = 0o644 << 16
+                    # Known up front so ZipFile picks ZIP64 records for big files
+                    info.file_size = int(item.get('file_size') or 0)
+                    dest = archive.open(info, 'w')
+                elif kind == 'error':
+                    raise item
+                else:
+                    break
+            data = sink.drain()
+            if data:
+                yield data
+        # Only a complete archive gets its central directory; a failed one is
+        # left without it so clients can't mistake it for a whole tree
+        archive.close()
+        yield sink.drain()
+    finally:
+        stopped.set()
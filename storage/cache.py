@@ -0,0 +1,161 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Keep recently read ciphertext in memory, per worker. Plaintext is never cached.
+BLOB_CACHE_ENABLED = os.getenv('blob_cache_enabled', '0') == '1'
+# Bytes of ciphertext the cache may hold
+BLOB_CACHE_SIZE = int(os.getenv('blob_cache_size', 256 * 1024 * 1024))
+# Blobs larger than this are always read from disk, so one big download can't
+# flush the whole cache
+BLOB_CACHE_MAX_ITEM = int(os.getenv('blob_cache_max_item', 8 * 1024 * 1024))
+
+class FrequencySketch:
+    """
+    Approximate access counts of many keys in fixed memory (a count-min sketch).
+    Counts are halved every `sample_size` increments, so the sketch follows
+    what is popular now rather than what was popular once.
+    """
+
+    ROWS = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width: int):
+        self.width = max(16, width)
+        self.table = [[0] * self.width for _ in range(self.ROWS)]
+        self.sample_size = self.width * 10
+        self.additions = 0
+
+    def _slots(self, key: str):
+        return [(row, hash((row, key)) % self.width) for row in range(self.ROWS)]
+
+    def increment(self, key: str):
+        for row, slot in self._slots(key):
+            if self.table[row][slot] < self.MAX_COUNT:
+                self.table[row][slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.table = [[count // 2 for count in row] for row in self.table]
+            self.additions //= 2
+
+    def frequency(self, key: str) -> int:
+        return min(self.table[row][slot] for row, slot in self._slots(key))
+
+class BlobCache:
+    """
+    Byte-budgeted LRU cache of encrypted blobs, with TinyLFU admission.
+    Every lookup is counted in a frequency sketch. A blob only gets in when
+    it has been asked for more often than every entry it would push out, so
+    a stream of one-off downloads can't evict the files that keep being
+    downloaded. Blobs are immutable under their key, so entries only need
+    invalidating when they are deleted; another worker's stale copy of a
+    deleted blob is unreachable and ages out.
+    """
+
+    def __init__(self, size: int = BLOB_CACHE_SIZE, max_item: int = BLOB_CACHE_MAX_ITEM, enabled: bool = BLOB_CACHE_ENABLED):
+        self.size = size
+        self.max_item = min(max_item, size)
+        self.enabled = enabled and size > 0
+        self.reset()
+
+    def reset(self):
+        """Start empty, e.g. in a forked child, whose parent's lock may be held."""
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # Sized for the number of entries the budget holds when they average 16 KiB
+        self.sketch = FrequencySketch(self.size // (16 * 1024) * 4 if self.enabled else 0)
+        self.hits = 0
+        self.misses = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        """The cached bytes of a blob, or None."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.sketch.increment(key)
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def _victims(self, key: str, size: int):
+        """Entries to evict to make room for a blob, or None if it shouldn't be admitted."""
+        if size > self.max_item:
+            return None
+        victims = []
+        freed = self.size - self.bytes
+        frequency = self.sketch.frequency(key)
+        for victim, data in self.entries.items():
+            if freed >= size:
+                break
+            if self.sketch.frequency(victim) >= frequency:
+                return None
+            victims.append(victim)
+            freed += len(data)
+        return victims
+
+    def admits(self, key: str, size: int) -> bool:
+        """Whether a blob of `size` bytes would be cached right now; checked before reading it whole."""
+        if not self.enabled:
+            return False
+        with self.lock:
+            if self._victims(key, size) is None:
+                self.rejected += 1
+                return False
+            return True
+
+    def put(self, key: str, data: bytes) -> bool:
+        """Cache a blob if admission lets it in, returning whether it was."""
+        if not self.enabled:
+            return False
+        with self.lock:
+            if key in self.entries:
+                return True
+            victims = self._victims(key, len(data))
+            if victims is None:
+                self.rejected += 1
+                return False
+            for victim in victims:
+                self.bytes -= len(self.entries.pop(victim))
+                self.evictions += 1
+            self.entries[key] = data
+            self.bytes += len(data)
+            self.admitted += 1
+            return True
+
+    def invalidate(self, key: str):
+        """Drop a blob from the cache, e.g. because it was deleted."""
+        if not self.enabled:
+            return
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.bytes -= len(data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'size': self.size,
+            'max_item': self.max_item,
+            'bytes': self.bytes,
+            'items': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'evictions': self.evictions
+        }
+
+BLOB_CACHE = BlobCache()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=BLOB_CACHE.reset)
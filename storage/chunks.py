@@ -0,0 +1,61 @@
+import os
+import uuid
+from storage.durability import durable_replace_many
+from storage.cache import BLOB_CACHE
+
+# Deduplicated chunks, one directory per user fanned out by digest prefix
+ENCRYPTED_CHUNKS_DIR = 'encrypted_chunks'
+os.makedirs(ENCRYPTED_CHUNKS_DIR, exist_ok=True)
+
+def chunk_path(user_id: str, digest: str, generation: str) -> str:
+    return os.path.join(ENCRYPTED_CHUNKS_DIR, user_id, digest[:2], f"{digest}-{generation}.chunk")
+
+def _cache_key(user_id: str, digest: str, generation: str) -> str:
+    return f"chunk:{user_id}:{digest}:{generation}"
+
+def chunk_exists(user_id: str, digest: str, generation: str) -> bool:
+    return os.path.exists(chunk_path(user_id, digest, generation))
+
+def save_chunks(user_id: str, chunks: list):
+    """
+    Write many encrypted chunks durably, each replaced atomically if it already exists.
+    Args:
+        user_id: Owner of the chunks
+        chunks: (digest, generation, encrypted_chunk) tuples
+    All the chunks are written before any is flushed, so the whole batch
+    waits for the disk twice rather than twice per chunk.
+    """
+    replacements = []
+    try:
+        for digest, generation, encrypted_chunk in chunks:
+            file_path = chunk_path(user_id, digest, generation)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+            replacements.append((temp_path, file_path))
+            with open(temp_path, 'wb') as f:
+                f.write(encrypted_chunk)
+        durable_replace_many(replacements)
+        for digest, generation, _ in chunks:
+            BLOB_CACHE.invalidate(_cache_key(user_id, digest, generation))
+    except BaseException:
+        for temp_path, _ in replacements:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+
+def get_chunk(user_id: str, digest: str, generation: str) -> bytes:
+    """Read an encrypted chunk from the blob cache or from disk."""
+    key = _cache_key(user_id, digest, generation)
+    data = BLOB_CACHE.get(key)
+    if data is None:
+        with open(chunk_path(user_id, digest, generation), 'rb') as f:
+            data = f.read()
+        BLOB_CACHE.put(key, data)
+    return data
+
+def delete_chunk(user_id: str, digest: str, generation: str):
+    """Delete an encrypted chunk from disk."""
+    BLOB_CACHE.invalidate(_cache_key(user_id, digest, generation))
+    file_path = chunk_path(user_id, digest, generation)
+    if os.path.exists(file_path):
+        os.remove(file_path)
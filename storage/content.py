@@ -0,0 +1,41 @@
+from crypto.stream import HEADER_SIZE, decrypt_segments, decrypt_blob, is_stream_blob
+from storage.files import open_encrypted_file
+from storage.dedup import is_manifest, iter_manifest_plaintext
+from crypto.compression import iter_decompressed
+
+def iter_plaintext(file: dict, key: bytes, start: int = 0, stop: int = None):
+    """
+    Yield the decrypted bytes [start, stop) of a stored file.
+    Args:
+        file: Metadata of the file whose blob should be read
+        key: User's Fernet key in bytes
+        start: First plaintext byte to return
+        stop: Plaintext offset to stop at, or None for the end of the file
+    Segmented blobs are decrypted lazily, one segment at a time, and only the
+    segments covering the range are read. Legacy Fernet blobs have to be
+    decrypted as a whole before the range can be sliced out. Deduplicated files
+    read their manifest and then only the chunks covering the range. Compressed
+    files are decompressed on the fly from their start.
+    """
+    if file.get('compression'):
+        yield from iter_decompressed(_iter_stored(file, key), file['compression'], start, stop)
+        return
+    yield from _iter_stored(file, key, start, stop)
+
+def _iter_stored(file: dict, key: bytes, start: int = 0, stop: int = None):
+    """Yield the decrypted bytes [start, stop) of a file's blob as stored."""
+    with open_encrypted_file(file['id']) as f:
+        header = f.read(HEADER_SIZE)
+        if is_stream_blob(header):
+            yield from decrypt_segments(f, key, start, stop)
+            return
+        f.seek(0)
+        blob = f.read()
+    if is_manifest(header):
+        yield from iter_manifest_plaintext(file['user_id'], key, blob, start, stop)
+        return
+    yield decrypt_blob(blob, key)[start:stop]
+
+def read_plaintext(file: dict, key: bytes) -> bytes:
+    """Decrypt a whole stored file into memory."""
+    return b''.join(iter_plaintext(file, key))
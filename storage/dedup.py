@@ -0,0 +1,155 @@
+import os
+import uuid
+import hmac
+import struct
+from crypto.chunking import ChunkKeys, iter_chunks
+from crypto.stream import UploadTooLarge, StreamFormatError
+from rdb.chunks import acquire_chunks, release_chunks
+from storage.chunks import save_chunks, get_chunk, delete_chunk, chunk_exists
+from storage.files import open_encrypted_file
+
+# Whether uploads are split into deduplicated chunks. Chunking runs in pure
+# Python and is much slower than encryption alone, so it is opt-in.
+DEDUP_ENABLED = os.getenv('dedup_enabled', '0') == '1'
+# Chunks whose references are taken in one Redis round trip
+DEDUP_BATCH = 16
+
+# Manifest layout, stored as the file's blob:
+#   MANIFEST_MAGIC | entry* | HMAC-SHA256 of everything before it
+#   entry = chunk digest (32 bytes) | generation (16 bytes) | plaintext size (u32)
+# Entries carry no plaintext, so a manifest can be released without the user's
+# key; the MAC stops anyone from reordering or swapping the user's chunks.
+MANIFEST_MAGIC = b'0CM1'
+ENTRY = struct.Struct('>32s16sI')
+MAC_SIZE = 32
+
+def is_manifest(prefix: bytes) -> bool:
+    """Check whether a blob is a chunk manifest."""
+    return prefix[:len(MANIFEST_MAGIC)] == MANIFEST_MAGIC
+
+class ChunkedStream:
+    """
+    Iterable producing the manifest of a plaintext file object, storing its chunks on the way.
+    Args:
+        source: Binary file object holding the plaintext
+        key: User's Fernet key in bytes
+        user_id: Owner of the chunks
+        max_size: Maximum number of plaintext bytes accepted, or None
+    Chunks already stored for the user only gain a reference; new ones are
+    encrypted and written. If the upload fails, every reference taken is given
+    back, by the stream itself when reading fails and by abort() when storing
+    the manifest does. Has the same interface as crypto.stream.EncryptedStream.
+    """
+
+    def __init__(self, source, key: bytes, user_id: str, max_size: int = None):
+        self.source = source
+        self.key = key
+        self.user_id = user_id
+        self.max_size = max_size
+        self.plaintext_size = 0
+        self.new_chunks = 0
+        self.reused_chunks = 0
+        self.acquired = []
+
+    def abort(self):
+        """Give back every chunk reference taken, e.g. when the manifest couldn't be stored; safe to call twice."""
+        acquired, self.acquired = self.acquired, []
+        if acquired:
+            _free(self.user_id, release_chunks(self.user_id, acquired))
+
+    def _store(self, keys: ChunkKeys, batch: list, acquired: list) -> bytes:
+        digests = [keys.digest(chunk) for chunk in batch]
+        hex_digests = [digest.hex() for digest in digests]
+        results = acquire_chunks(self.user_id, hex_digests, [uuid.uuid4().hex for _ in batch])
+        acquired.extend(hex_digests)
+
+        entries = bytearray()
+        new_chunks = []
+        for chunk, digest, hex_digest, (generation, is_new) in zip(batch, digests, hex_digests, results):
+            # A chunk referenced by an upload still in flight may not be on disk yet
+            if is_new or not chunk_exists(self.user_id, hex_digest, generation):
+                new_chunks.append((hex_digest, generation, keys.encrypt(digest, chunk)))
+            else:
+                self.reused_chunks += 1
+            entries += ENTRY.pack(digest, bytes.fromhex(generation), len(chunk))
+        # Flushed together, so the batch waits for the disk once
+        save_chunks(self.user_id, new_chunks)
+        self.new_chunks += len(new_chunks)
+        return bytes(entries)
+
+    def __iter__(self):
+        keys = ChunkKeys(self.key)
+        mac = keys.manifest_mac()
+        mac.update(MANIFEST_MAGIC)
+        yield MANIFEST_MAGIC
+
+        acquired = self.acquired
+        try:
+            batch = []
+            for chunk in iter_chunks(self.source):
+                self.plaintext_size += len(chunk)
+                if self.max_size is not None and self.plaintext_size > self.max_size:
+                    raise UploadTooLarge(f'File exceeds the maximum upload size of {self.max_size} bytes')
+                batch.append(chunk)
+                if len(batch) >= DEDUP_BATCH:
+                    entries = self._store(keys, batch, acquired)
+                    batch = []
+                    mac.update(entries)
+                    yield entries
+            if batch:
+                entries = self._store(keys, batch, acquired)
+                mac.update(entries)
+                yield entries
+            yield mac.digest()
+        except BaseException:
+            self.abort()
+            raise
+
+def _free(user_id: str, freed: list):
+    for digest, generation in freed:
+        delete_chunk(user_id, digest, generation)
+
+def parse_manifest(data: bytes, key: bytes = None) -> list:
+    """Split a manifest into (digest, generation, size) entries, verifying it when the key is given."""
+    body = data[len(MANIFEST_MAGIC):len(data) - MAC_SIZE]
+    if not is_manifest(data) or len(data) < len(MANIFEST_MAGIC) + MAC_SIZE or len(body) % ENTRY.size:
+        raise StreamFormatError('Invalid chunk manifest')
+    if key is not None:
+        mac = ChunkKeys(key).manifest_mac()
+        mac.update(data[:len(data) - MAC_SIZE])
+        if not hmac.compare_digest(mac.digest(), data[len(data) - MAC_SIZE:]):
+            raise StreamFormatError('Chunk manifest failed authentication')
+    return [ENTRY.unpack_from(body, offset) for offset in range(0, len(body), ENTRY.size)]
+
+def iter_manifest_plaintext(user_id: str, key: bytes, manifest: bytes, start: int = 0, stop: int = None):
+    """Yield the decrypted bytes [start, stop) of a chunked file, reading only the chunks in range."""
+    keys = ChunkKeys(key)
+    offset = 0
+    for digest, generation, size in parse_manifest(manifest, key):
+        end = offset + size
+        if stop is not None and offset >= stop:
+            break
+        if end > start:
+            chunk = keys.decrypt(digest, get_chunk(user_id, digest.hex(), generation.hex()))
+            piece = chunk[max(start - offset, 0):None if stop is None else stop - offset]
+            if piece:
+                yield piece
+        offset = end
+
+def release_manifest(user_id: str, manifest: bytes, batch_size: int = 1000):
+    """Drop the references a deleted file held on its chunks and delete the chunks no longer used."""
+    digests = [digest.hex() for digest, _, _ in parse_manifest(manifest)]
+    for i in range(0, len(digests), batch_size):
+        _free(user_id, release_chunks(user_id, digests[i:i + batch_size]))
+
+def release_file_chunks(user_id: str, file_id: str):
+    """Release the chunks of a stored file if it is chunked; other blobs are left alone."""
+    try:
+        with open_encrypted_file(file_id, cache=False) as f:
+            if not is_manifest(f.read(len(MANIFEST_MAGIC))):
+                return
+            f.seek(0)
+            manifest = f.read()
+    except FileNotFoundError:
+        return
+    release_manifest(user_id, manifest)
@@ -0,0 +1,159 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# How blob writes are made durable:
+#   group  - fsyncs of concurrent writes are batched by a background thread
+#   always - every write fsyncs on its own
+#   off    - no fsync; writes are still atomic, but may be lost on power failure
+FSYNC_MODE = os.getenv('fsync_mode', 'group')
+# Longest a write waits for others to join its flush, in seconds
+FSYNC_WINDOW = float(os.getenv('fsync_window', 0.005))
+# Paths of one flush synced at the same time; fsync releases the GIL, and
+# devices with deep queues finish several faster than one after the other
+FSYNC_THREADS = int(os.getenv('fsync_threads', 4))
+
+def _fsync_path(path: str):
+    # Any descriptor of a file flushes all of its data, so paths are enough and
+    # a writer may close or rotate its own descriptor in the meantime
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class _Request:
+    def __init__(self, paths):
+        self.paths = paths
+        self.done = threading.Event()
+        self.error = None
+
+class GroupCommit:
+    """
+    Batches fsyncs of concurrent writers into flush windows.
+    A writer queues the files and directories it needs flushed and blocks. When
+    other writers are already waiting, the flusher thread waits up to the
+    window for more to join; a lone writer is flushed at once. Every distinct
+    path is then synced once, several at a time, and all the writers woken.
+    Under load a single fsync of a segment or directory covers many uploads,
+    and the filesystem journal commits the rest together.
+    """
+
+    def __init__(self, window: float = FSYNC_WINDOW, threads: int = FSYNC_THREADS):
+        self.window = window
+        self.threads = threads
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = False
+        self.executor = None
+        self.flushes = 0
+        self.synced_paths = 0
+        self.requests = 0
+
+    def reset(self):
+        """Forget the parent's state in a forked child, whose flusher thread is gone."""
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = False
+        self.executor = None
+
+    def _run(self):
+        condition = self.condition
+        while True:
+            with condition:
+                while not self.pending:
+                    condition.wait()
+                concurrent = len(self.pending) > 1
+            # Let concurrent writers join this flush; waiting on a lone writer
+            # would only add the window to every write
+            if concurrent and self.window > 0:
+                time.sleep(self.window)
+            with condition:
+                batch, self.pending = self.pending, []
+            self._flush(batch)
+
+    def _sync(self, path: str):
+        try:
+            _fsync_path(path)
+        except OSError as e:
+            return e
+        return None
+
+    def _flush(self, batch: list):
+        paths = list(dict.fromkeys(path for request in batch for path in request.paths))
+        if len(paths) > 1 and self.threads > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='fsync')
+            results = self.executor.map(self._sync, paths)
+        else:
+            results = map(self._sync, paths)
+        errors = {path: error for path, error in zip(paths, results) if error is not None}
+        for request in batch:
+            request.error = next((errors[path] for path in request.paths if path in errors), None)
+            request.done.set()
+        self.flushes += 1
+        self.synced_paths += len(paths)
+        self.requests += len(batch)
+
+    def sync(self, *paths: str):
+        """Block until every file or directory in `paths` is flushed to disk."""
+        request = _Request(paths)
+        with self.condition:
+            if not self.running:
+                threading.Thread(target=self._run, name='group-commit', daemon=True).start()
+                self.running = True
+            self.pending.append(request)
+            self.condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def stats(self) -> dict:
+        return {
+            'mode': FSYNC_MODE,
+            'window': self.window,
+            'threads': self.threads,
+            'flushes': self.flushes,
+            'synced_paths': self.synced_paths,
+            'requests': self.requests
+        }
+
+GROUP_COMMIT = GroupCommit()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=GROUP_COMMIT.reset)
+
+def make_durable(*paths: str):
+    """Flush files or directories to disk according to the fsync mode."""
+    if FSYNC_MODE == 'off' or not paths:
+        return
+    if FSYNC_MODE == 'always':
+        for path in paths:
+            _fsync_path(path)
+        return
+    GROUP_COMMIT.sync(*paths)
+
+def durable_replace(temp_path: str, file_path: str):
+    """
+    Publish a fully written temporary file under its final name.
+    The data is flushed before the rename and the directory after it, so after
+    a crash the final path holds either nothing or the complete file.
+    """
+    make_durable(temp_path)
+    os.replace(temp_path, file_path)
+    make_durable(os.path.dirname(file_path) or '.')
+
+def durable_replace_many(replacements: list):
+    """
+    Publish many fully written temporary files under their final names.
+    Args:
+        replacements: (temp_path, file_path) pairs
+    Like durable_replace, but all the data is flushed in one request before
+    any rename and all the directories in one after, instead of two waits
+    per file.
+    """
+    make_durable(*(temp_path for temp_path, _ in replacements))
+    for temp_path, file_path in replacements:
+        os.replace(temp_path, file_path)
+    make_durable(*dict.fromkeys(os.path.dirname(file_path) or '.' for _, file_path in replacements))
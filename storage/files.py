@@ -1,24 +1,195 @@
 import os
+import time
+import uuid
+import hashlib
+import io
+from storage.durability import durable_replace
+from storage.cache import BLOB_CACHE
+from storage.packs import PACK_ENABLED, PACK_THRESHOLD, pack_blob, read_packed_blob, open_packed_blob, delete_packed_blob
 
 # Ensure encrypted files directory exists
 ENCRYPTED_FILES_DIR = 'encrypted_files'
 os.makedirs(ENCRYPTED_FILES_DIR, exist_ok=True)
+# Blobs being written; on the same filesystem so they can be renamed into place
+TEMP_FILES_DIR = os.path.join(ENCRYPTED_FILES_DIR, '.tmp')
+os.makedirs(TEMP_FILES_DIR, exist_ok=True)
+
+# Blobs are fanned out over two levels of 256 directories each, keyed on a hash
+# of the file ID, so no single directory grows past a few thousand entries
+SHARD_LEVELS = 2
+
+def blob_path(file_id: str) -> str:
+    """Path of a file's blob in the sharded layout, e.g. encrypted_files/3f/a2/{id}.enc"""
+    digest = hashlib.md5(file_id.encode()).hexdigest()
+    shards = [digest[i * 2:i * 2 + 2] for i in range(SHARD_LEVELS)]
+    return os.path.join(ENCRYPTED_FILES_DIR, *shards, f"{file_id}.enc")
+
+def legacy_blob_path(file_id: str) -> str:
+    """Path of a file's blob in the old flat layout."""
+    return os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
+
+def _open_blob(file_id: str):
+    try:
+        return open(blob_path(file_id), 'rb')
+    except FileNotFoundError:
+        pass
+    try:
+        return open(legacy_blob_path(file_id), 'rb')
+    except FileNotFoundError:
+        pass
+    packed = open_packed_blob(file_id)
+    if packed is not None:
+        return packed
+    # The migrator may have moved it between the attempts
+    return open(blob_path(file_id), 'rb')
+
+def locate_blob(file_id: str) -> tuple:
+    """
+    Find where a blob is stored, for serving it without reading it through Python.
+    Returns:
+        (path, None) for a blob in a file of its own, (None, bytes) for a
+        packed blob, or (None, None) if there is no blob
+    """
+    for file_path in (blob_path(file_id), legacy_blob_path(file_id)):
+        if os.path.exists(file_path):
+            return file_path, None
+    data = read_packed_blob(file_id)
+    if data is not None:
+        return None, data
+    # The migrator may have moved it between the checks
+    if os.path.exists(blob_path(file_id)):
+        return blob_path(file_id), None
+    return None, None
+
+def _remove(file_path: str):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
 
 def save_encrypted_file(file_id: str, encrypted_content: bytes) -> str:
-    """Save encrypted file to disk and return the file path."""
-    file_path = os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
-    with open(file_path, 'wb') as f:
-        f.write(encrypted_content)
-    return file_path
+    """Save encrypted file to disk and return the file path, or None if it was packed."""
+    return save_encrypted_stream(file_id, [encrypted_content])
 
 def get_encrypted_file(file_id: str) -> bytes:
     """Read encrypted file from disk."""
-    file_path = os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
-    with open(file_path, 'rb') as f:
+    with open_encrypted_file(file_id) as f:
         return f.read()
 
+def open_encrypted_file(file_id: str, cache: bool = True):
+    """
+    Open encrypted file for random access reads.
+    Blobs held by the blob cache are served from memory. Others are read from
+    disk, and kept in the cache if its admission policy lets them in; pass
+    cache=False for reads that shouldn't count as downloads.
+    """
+    if not cache:
+        return _open_blob(file_id)
+    data = BLOB_CACHE.get(file_id)
+    if data is not None:
+        return io.BytesIO(data)
+    f = _open_blob(file_id)
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    if not BLOB_CACHE.admits(file_id, size):
+        return f
+    with f:
+        data = f.read()
+    BLOB_CACHE.put(file_id, data)
+    return io.BytesIO(data)
+
 def delete_encrypted_file(file_id: str):
     """Delete encrypted file from disk."""
-    file_path = os.path.join(ENCRYPTED_FILES_DIR, f"{file_id}.enc")
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    BLOB_CACHE.invalidate(file_id)
+    # Old location first: if the migrator moves the blob in between, the
+    # second removal still catches it
+    _remove(legacy_blob_path(file_id))
+    _remove(blob_path(file_id))
+    delete_packed_blob(file_id)
+
+def save_encrypted_stream(file_id: str, chunks) -> str:
+    """Write an iterable of encrypted chunks to disk and return the file path, or None if it was packed."""
+    chunks = iter(chunks)
+    head = []
+    if PACK_ENABLED:
+        # Buffer up to the threshold; blobs ending before it go into a pack segment
+        buffered = 0
+        for chunk in chunks:
+            head.append(chunk)
+            buffered += len(chunk)
+            if buffered > PACK_THRESHOLD:
+                break
+        else:
+            pack_blob(file_id, b''.join(head))
+            return None
+
+    file_path = blob_path(file_id)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # The blob only appears under its name once complete and on disk, so
+    # metadata saved after this returns never points at a truncated file
+    temp_path = os.path.join(TEMP_FILES_DIR, f"{file_id}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in head:
+                f.write(chunk)
+            for chunk in chunks:
+                f.write(chunk)
+        durable_replace(temp_path, file_path)
+    except BaseException:
+        # Never leave a partial blob behind when the upload is aborted
+        _remove(temp_path)
+        raise
+    return file_path
+
+def remove_stale_temp_files(max_age: float = 86400) -> int:
+    """Delete temporary blobs left behind by a crash, returning how many were removed."""
+    removed = 0
+    cutoff = time.time() - max_age
+    with os.scandir(TEMP_FILES_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.name.endswith('.tmp') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return removed
+
+def migrate_blobs(batch_size: int = 1000, pause: float = 0.0, limit: int = None) -> dict:
+    """
+    Move blobs from the flat layout into the sharded one while the server is running.
+    Args:
+        batch_size: Blobs moved between pauses
+        pause: Seconds to sleep after each batch, to limit the I/O load
+        limit: Stop after moving this many blobs, or None to move all of them
+    Returns:
+        Dictionary with the number of blobs moved and skipped
+    Moves are renames within the same filesystem, so readers see the blob in
+    one of the two places at all times. Only unmigrated blobs are left in the
+    top level directory, which makes the migration resumable: running it
+    again continues where it stopped.
+    """
+    moved = skipped = 0
+    with os.scandir(ENCRYPTED_FILES_DIR) as entries:
+        for entry in entries:
+            if limit is not None and moved >= limit:
+                break
+            if not entry.name.endswith('.enc') or not entry.is_file(follow_symlinks=False):
+                continue
+            file_id = entry.name[:-len('.enc')]
+            target = blob_path(file_id)
+            if os.path.exists(target):
+                # Never overwrite a blob already written to the new layout
+                print(f"Skipping {entry.name}, {target} already exists")
+                skipped += 1
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.rename(entry.path, target)
+            except FileNotFoundError:
+                # Deleted while we were looking at it
+                continue
+            moved += 1
+            if pause and moved % batch_size == 0:
+                time.sleep(pause)
+    return {'moved': moved, 'skipped': skipped}
@@ -0,0 +1,285 @@
+import io
+import os
+import uuid
+import fcntl
+import struct
+import threading
+from collections import OrderedDict
+from storage.durability import make_durable
+from rdb.packs import (
+    get_pack_location, set_pack_location, delete_pack_location,
+    move_pack_location, add_dead_bytes, get_dead_bytes, forget_segment
+)
+
+# Whether small blobs are appended to shared pack segments instead of getting
+# a file each
+PACK_ENABLED = os.getenv('pack_enabled', '0') == '1'
+# Blobs up to this many bytes are packed
+PACK_THRESHOLD = int(os.getenv('pack_threshold', 64 * 1024))
+# Segments are rotated once they reach this size
+PACK_SEGMENT_SIZE = int(os.getenv('pack_segment_size', 256 * 1024 * 1024))
+# Segment file descriptors kept open for reads, per process
+PACK_OPEN_FILES = int(os.getenv('pack_open_files', 64))
+
+ENCRYPTED_PACKS_DIR = 'encrypted_packs'
+os.makedirs(ENCRYPTED_PACKS_DIR, exist_ok=True)
+
+# Segment layout: SEGMENT_MAGIC | entry*
+#   entry = ENTRY_HEADER(file ID length, blob length) | file ID | blob
+# Entries describe themselves so compaction can walk a segment without the index.
+SEGMENT_MAGIC = b'0CP1'
+ENTRY_HEADER = struct.Struct('>HI')
+
+def segment_path(segment: str) -> str:
+    return os.path.join(ENCRYPTED_PACKS_DIR, f"{segment}.pack")
+
+def entry_overhead(file_id: str) -> int:
+    """Bytes an entry takes in its segment besides the blob."""
+    return ENTRY_HEADER.size + len(file_id.encode('utf-8'))
+
+class PackWriter:
+    """
+    Appends blobs to this process's open segment.
+    Every process writes to a segment of its own, so offsets are known without
+    coordination. The segment is flock'ed while open, which tells compaction
+    it is still being written to. Appends stay pending until their caller has
+    indexed them and called release(); a segment rotated out with appends
+    still pending keeps its lock until the last is released, so compaction
+    never takes an entry that is about to be indexed for dead.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+        self.segment = None
+        self.size = 0
+        self.pending = {}
+        self.retired = {}
+
+    def _open_segment(self):
+        if self.pid != os.getpid():
+            # The parent's segments, descriptors and pending appends are its own
+            self.pending = {}
+            self.retired = {}
+        elif self.fd is not None:
+            if self.pending.get(self.segment):
+                self.retired[self.segment] = self.fd
+            else:
+                os.close(self.fd)
+        self.segment = uuid.uuid4().hex
+        self.fd = os.open(segment_path(self.segment), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.write(self.fd, SEGMENT_MAGIC)
+        self.size = len(SEGMENT_MAGIC)
+        self.pid = os.getpid()
+        make_durable(ENCRYPTED_PACKS_DIR)
+
+    def append(self, file_id: str, data: bytes) -> tuple:
+        """Append a blob, returning its (segment, offset, length); pass the segment to release() once it is indexed."""
+        name = file_id.encode('utf-8')
+        record = ENTRY_HEADER.pack(len(name), len(data)) + name + data
+        with self.lock:
+            # A forked child must not append to its parent's segment
+            if self.pid != os.getpid() or self.size + len(record) > PACK_SEGMENT_SIZE:
+                self._open_segment()
+            try:
+                written = os.write(self.fd, record)
+            except OSError:
+                # Whatever made it to disk is garbage, find out where the segment ends now
+                self.size = os.fstat(self.fd).st_size
+                raise
+            offset = self.size + ENTRY_HEADER.size + len(name)
+            self.size += written
+            if written != len(record):
+                raise OSError(f'Short write to pack segment {self.segment}')
+            self.pending[self.segment] = self.pending.get(self.segment, 0) + 1
+        return self.segment, offset, len(data)
+
+    def release(self, segment: str):
+        """Mark an append to `segment` as indexed, or abandoned, unlocking the segment if it was rotated out."""
+        with self.lock:
+            count = self.pending.get(segment, 0) - 1
+            if count > 0:
+                self.pending[segment] = count
+                return
+            self.pending.pop(segment, None)
+            fd = self.retired.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+
+class _OpenSegment:
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.users = 0
+        self.evicted = False
+
+class SegmentReader:
+    """LRU cache of read-only segment file descriptors, read from with pread."""
+
+    def __init__(self, max_open: int = PACK_OPEN_FILES):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.pid = None
+        self.segments = OrderedDict()
+
+    def _acquire(self, segment: str) -> _OpenSegment:
+        with self.lock:
+            if self.pid != os.getpid():
+                # Descriptors inherited across fork are left to the parent
+                self.segments = OrderedDict()
+                self.pid = os.getpid()
+            entry = self.segments.get(segment)
+            if entry is None:
+                entry = _OpenSegment(os.open(segment_path(segment), os.O_RDONLY))
+                self.segments[segment] = entry
+                while len(self.segments) > self.max_open:
+                    _, old = self.segments.popitem(last=False)
+                    old.evicted = True
+                    if not old.users:
+                        os.close(old.fd)
+            else:
+                self.segments.move_to_end(segment)
+            entry.users += 1
+            return entry
+
+    def _release(self, entry: _OpenSegment):
+        with self.lock:
+            entry.users -= 1
+            # Evicted while in use, close it now that the last reader is done
+            if entry.evicted and not entry.users:
+                os.close(entry.fd)
+
+    def read(self, segment: str, offset: int, length: int) -> bytes:
+        entry = self._acquire(segment)
+        try:
+            data = os.pread(entry.fd, length, offset)
+        finally:
+            self._release(entry)
+        if len(data) != length:
+            raise OSError(f'Pack segment {segment} is truncated')
+        return data
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'open_segments': len(self.segments), 'max_open': self.max_open}
+
+PACK_WRITER = PackWriter()
+SEGMENT_READER = SegmentReader()
+
+def pack_blob(file_id: str, data: bytes):
+    """Store a small blob in a pack segment and index it once it is on disk."""
+    location = PACK_WRITER.append(file_id, data)
+    try:
+        # Concurrent appends to the segment share this flush
+        make_durable(segment_path(location[0]))
+        set_pack_location(file_id, *location)
+    except BaseException:
+        add_dead_bytes(location[0], location[2] + entry_overhead(file_id))
+        raise
+    finally:
+        PACK_WRITER.release(location[0])
+
+def read_packed_blob(file_id: str):
+    """Read a packed blob, or return None if the file isn't packed."""
+    for _ in range(2):
+        location = get_pack_location(file_id)
+        if location is None:
+            return None
+        try:
+            return SEGMENT_READER.read(*location)
+        except FileNotFoundError:
+            # Compaction moved the blob and removed the segment; look it up again
+            continue
+    raise FileNotFoundError(f'Packed blob {file_id} is missing')
+
+def open_packed_blob(file_id: str):
+    """Packed blob as a file object, or None if the file isn't packed."""
+    data = read_packed_blob(file_id)
+    return io.BytesIO(data) if data is not None else None
+
+def delete_packed_blob(file_id: str) -> bool:
+    """Remove a blob from the pack index; its bytes are reclaimed by compaction."""
+    return delete_pack_location(file_id, entry_overhead(file_id)) is not None
+
+def _iter_entries(f):
+    """Yield (file_id, offset, length) for every entry of an open segment."""
+    if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+        raise ValueError('Not a pack segment')
+    position = len(SEGMENT_MAGIC)
+    size = os.fstat(f.fileno()).st_size
+    while True:
+        header = f.read(ENTRY_HEADER.size)
+        if len(header) < ENTRY_HEADER.size:
+            # A torn header at the end is an append that never finished
+            return
+        name_length, length = ENTRY_HEADER.unpack(header)
+        file_id = f.read(name_length).decode('utf-8', 'replace')
+        offset = position + ENTRY_HEADER.size + name_length
+        if offset + length > size:
+            return
+        yield file_id, offset, length
+        f.seek(offset + length)
+        position = offset + length
+
+def compact_segment(segment: str) -> dict:
+    """Copy the live blobs of a segment into the current one and remove it."""
+    copied = dropped = 0
+    with open(segment_path(segment), 'rb') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Still being appended to, or compacted by someone else
+            return {'copied': 0, 'dropped': 0, 'skipped': True}
+        moves = []
+        try:
+            for file_id, offset, length in _iter_entries(f):
+                old_location = (segment, offset, length)
+                if get_pack_location(file_id) != old_location:
+                    dropped += 1
+                    continue
+                new_location = PACK_WRITER.append(file_id, os.pread(f.fileno(), length, offset))
+                moves.append((file_id, old_location, new_location))
+            # The copies must be on disk before the index points at them
+            make_durable(*{segment_path(new_location[0]) for _, _, new_location in moves})
+            for file_id, old_location, new_location in moves:
+                if move_pack_location(file_id, old_location, new_location):
+                    copied += 1
+                else:
+                    # Deleted while being copied
+                    add_dead_bytes(new_location[0], new_location[2] + entry_overhead(file_id))
+                    dropped += 1
+        finally:
+            for _, _, new_location in moves:
+                PACK_WRITER.release(new_location[0])
+        # Readers holding the old location retry after the file is gone
+        os.remove(segment_path(segment))
+    forget_segment(segment)
+    return {'copied': copied, 'dropped': dropped, 'skipped': False}
+
+def compact_packs(min_dead_ratio: float = 0.5) -> dict:
+    """
+    Rewrite segments in which at least `min_dead_ratio` of the bytes are dead.
+    Returns:
+        Dictionary with the number of segments compacted and blobs copied and dropped
+    """
+    dead = get_dead_bytes()
+    totals = {'segments': 0, 'copied': 0, 'dropped': 0}
+    for name in os.listdir(ENCRYPTED_PACKS_DIR):
+        if not name.endswith('.pack'):
+            continue
+        segment = name[:-len('.pack')]
+        if segment == PACK_WRITER.segment:
+            continue
+        try:
+            size = os.path.getsize(segment_path(segment))
+        except FileNotFoundError:
+            continue
+        if dead.get(segment, 0) < size * min_dead_ratio:
+            continue
+        result = compact_segment(segment)
+        if not result['skipped']:
+            totals['segments'] += 1
+            totals['copied'] += result['copied']
+            totals['dropped'] += result['dropped']
+    return totals
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+from rdb.trash import (
+    TRASH_KEYS_KEY, TRASH_BLOBS_KEY, TRASH_NAMES_KEY,
+    lock_trash, unlock_trash, claim_trash, release_claim, recover_claims, forget_claims,
+    unlink_keys, unindex_names
+)
+from storage.files import open_encrypted_file, delete_encrypted_file
+from storage.dedup import MANIFEST_MAGIC, is_manifest, release_manifest
+from storage.uploads import collect_expired_uploads
+
+# Trash entries reclaimed per round
+REAPER_BATCH = int(os.getenv('reaper_batch', 100))
+# Blobs removed per second at most, so a big delete doesn't starve uploads and downloads of disk I/O
+REAPER_RATE = float(os.getenv('reaper_rate', 200))
+# Seconds between looks at the trash when nothing woke the reaper, to pick up
+# work left by other processes
+REAPER_INTERVAL = float(os.getenv('reaper_interval', 60))
+# Seconds the reaper lock is held for at most; a crashed reaper's work is
+# picked up once it runs out
+REAPER_LOCK_TTL = int(os.getenv('reaper_lock_ttl', 60))
+
+def reclaim_blob(user_id: str, file_id: str):
+    """
+    Remove a deleted file's blob and release its chunks if it is chunked.
+    The blob goes first: if the process dies in between, chunks leak instead
+    of being released twice.
+    """
+    manifest = None
+    try:
+        with open_encrypted_file(file_id, cache=False) as f:
+            if is_manifest(f.read(len(MANIFEST_MAGIC))):
+                f.seek(0)
+                manifest = f.read()
+    except FileNotFoundError:
+        pass
+    delete_encrypted_file(file_id)
+    if manifest:
+        release_manifest(user_id, manifest)
+
+def reap(batch_size: int = REAPER_BATCH, rate: float = REAPER_RATE) -> dict:
+    """
+    Empty one batch of the trash, returning how many keys, names and blobs were reclaimed.
+    Returns None if another process is already emptying it. Entries are
+    claimed before they are reclaimed and released after, renewing the lock
+    each time, so a reaper that loses its lock stops before taking anything
+    another may be working on. Entries claimed by a reaper that died are put
+    back for this one.
+    """
+    token = lock_trash(REAPER_LOCK_TTL)
+    if token is None:
+        return None
+    result = {'keys': 0, 'names': 0, 'blobs': 0}
+    try:
+        recover_claims(token, [TRASH_KEYS_KEY, TRASH_NAMES_KEY, TRASH_BLOBS_KEY])
+
+        keys = claim_trash(TRASH_KEYS_KEY, token, batch_size, REAPER_LOCK_TTL)
+        if keys is None:
+            return result
+        unlink_keys(keys)
+        release_claim(TRASH_KEYS_KEY, token)
+        result['keys'] = len(keys)
+
+        names = claim_trash(TRASH_NAMES_KEY, token, batch_size, REAPER_LOCK_TTL)
+        if names is None:
+            return result
+        unindex_names(names)
+        release_claim(TRASH_NAMES_KEY, token)
+        result['names'] = len(names)
+
+        # One blob at a time, so a lock lost to a slow disk or a low rate
+        # costs at most the blob in hand
+        interval = 1 / rate if rate > 0 else 0
+        deadline = time.monotonic()
+        for _ in range(batch_size):
+            blobs = claim_trash(TRASH_BLOBS_KEY, token, 1, REAPER_LOCK_TTL)
+            if not blobs:
+                break
+            user_id, file_id = blobs[0].split(':', 1)
+            reclaim_blob(user_id, file_id)
+            release_claim(TRASH_BLOBS_KEY, token)
+            result['blobs'] += 1
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        forget_claims(token)
+        return result
+    finally:
+        unlock_trash(token)
+
+class Reaper:
+    """
+    Background thread emptying the trash at a throttled rate.
+    It starts on the first start() or wake() in a process, and every
+    REAPER_INTERVAL seconds, or when woken by a delete, drains the trash and
+    collects expired upload sessions, giving back the quota they reserved.
+    """
+
+    def __init__(self, batch_size: int = REAPER_BATCH, rate: float = REAPER_RATE, interval: float = REAPER_INTERVAL):
+        self.batch_size = batch_size
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.running = False
+        self.keys = 0
+        self.names = 0
+        self.blobs = 0
+        self.uploads = 0
+        self.errors = 0
+
+    def reset(self):
+        """Forget the parent's state in a forked child, whose reaper thread is gone."""
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.running = False
+
+    def start(self):
+        """Start the thread if needed, to look at the trash and uploads on the next interval."""
+        with self.lock:
+            if not self.running:
+                threading.Thread(target=self._run, name='reaper', daemon=True).start()
+                self.running = True
+
+    def wake(self):
+        """Have the trash emptied soon, starting the thread if needed."""
+        self.start()
+        self.event.set()
+
+    def _run(self):
+        event = self.event
+        while True:
+            event.wait(self.interval)
+            event.clear()
+            # A failure in one job doesn't hold up the other
+            for job in (self._empty_trash, self._collect_uploads):
+                try:
+                    job()
+                except Exception as e:
+                    print(f"Reaper error: {str(e)}")  # Debug print
+                    self.errors += 1
+
+    def _empty_trash(self):
+        while True:
+            result = reap(self.batch_size, self.rate)
+            # Another process holds the lock and will do the work
+            if result is None:
+                return
+            self.keys += result['keys']
+            self.names += result['names']
+            self.blobs += result['blobs']
+            if max(result.values()) < self.batch_size:
+                return
+
+    def _collect_uploads(self):
+        # Sessions are claimed one by one, so every process may collect at once
+        while True:
+            collected = collect_expired_uploads(self.batch_size)
+            self.uploads += collected
+            if collected < self.batch_size:
+                return
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'rate': self.rate,
+            'keys': self.keys,
+            'names': self.names,
+            'blobs': self.blobs,
+            'uploads': self.uploads,
+            'errors': self.errors
+        }
+
+REAPER = Reaper()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=REAPER.reset)
@@ -0,0 +1,54 @@
+import os
+import uuid
+import shutil
+from storage.durability import durable_replace
+from rdb.uploads import claim_expired_upload_sessions
+from rdb.usage import release_storage
+
+# Encrypted chunks of upload sessions, one directory per session
+UPLOAD_PARTS_DIR = 'encrypted_uploads'
+os.makedirs(UPLOAD_PARTS_DIR, exist_ok=True)
+
+# Bytes copied at a time when parts are joined into the final blob
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def part_path(session_id: str, index: int) -> str:
+    return os.path.join(UPLOAD_PARTS_DIR, session_id, f"{index}.part")
+
+def save_part(session_id: str, index: int, encrypted_part: bytes):
+    """Store an encrypted chunk durably; storing the same chunk again replaces it."""
+    file_path = part_path(session_id, index)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(encrypted_part)
+        durable_replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def iter_parts(session_id: str, count: int, header: bytes = b''):
+    """Yield the blob made of `header` followed by parts 0 to count - 1, in pieces."""
+    if header:
+        yield header
+    for index in range(count):
+        with open(part_path(session_id, index), 'rb') as f:
+            while True:
+                data = f.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                yield data
+
+def delete_parts(session_id: str):
+    """Delete every stored chunk of a session."""
+    shutil.rmtree(os.path.join(UPLOAD_PARTS_DIR, session_id), ignore_errors=True)
+
+def collect_expired_uploads(limit: int = 100) -> int:
+    """Delete the chunks of expired sessions and give back their quota, returning how many were collected."""
+    sessions = claim_expired_upload_sessions(limit)
+    for user_id, session_id, size in sessions:
+        delete_parts(session_id)
+        release_storage(user_id, size)
+    return len(sessions)
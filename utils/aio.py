@@ -0,0 +1,79 @@
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Threads available to async views for blocking work such as blob reads
+AIO_IO_THREADS = int(os.getenv('aio_io_threads', 32))
+
+class EventLoopThread:
+    """
+    One event loop per process, running in a background thread.
+    Async views of every request thread run on this loop, so its asyncio Redis
+    client and connections are shared across requests instead of being set up
+    for a new loop each time.
+    This does not make the server asynchronous: under WSGI every request, an
+    async view's included, keeps its worker thread blocked in run() until the
+    response is built, and a streamed body holds it until it is sent. Slow
+    clients still need a thread each; only their Redis work is multiplexed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.executor = None
+
+    def reset(self):
+        """Forget the parent's loop in a forked child, whose loop thread is gone."""
+        self.lock = threading.Lock()
+        self.loop = None
+        self.executor = None
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                self.executor = ThreadPoolExecutor(max_workers=AIO_IO_THREADS, thread_name_prefix='aio-io')
+                loop.set_default_executor(self.executor)
+                threading.Thread(target=loop.run_forever, name='aio-loop', daemon=True).start()
+                self.loop = loop
+            return self.loop
+
+    def run(self, coroutine):
+        """Run a coroutine on the loop and block the calling thread until it is done; the thread is not freed meanwhile."""
+        loop = self.get_loop()
+        future = Future()
+
+        def start():
+            task = loop.create_task(coroutine)
+            task.add_done_callback(lambda done: _copy_result(done, future))
+
+        # The task inherits the caller's context, which holds Flask's request and g
+        loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return future.result()
+
+    def stats(self) -> dict:
+        return {
+            'running': self.loop is not None,
+            'io_threads': AIO_IO_THREADS
+        }
+
+def _copy_result(task: asyncio.Task, future: Future):
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+IO_LOOP = EventLoopThread()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=IO_LOOP.reset)
+
+async def to_thread(func, *args, **kwargs):
+    """Run blocking work, such as blob I/O, on the loop's bounded thread pool."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, lambda: context.run(func, *args, **kwargs))
@@ -0,0 +1,13 @@
+from flask import Response
+
+def tag_listing(response: Response, etag: str) -> Response:
+    """Mark a listing with its weak ETag and have clients revalidate it on every use."""
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    # The same URL lists something else for every user
+    response.vary.add('Authorization')
+    return response
+
+def not_modified(etag: str) -> Response:
+    """An empty 304 answer to a revalidation whose ETag still matches."""
+    return tag_listing(Response(status=304), etag)